@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Doqu is a lightweight schema/query framework for document databases.
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of Docu.
+#
+#    Doqu is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Doqu is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with Docu.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Benchmarks
+==========
+
+Measures the hot paths of Doqu on synthetic datasets and writes the results
+to a JSON file, so that they can be compared across commits::
+
+    $ python benchmarks/run.py --size 10000 --size 1000000 -o new.json
+    $ python benchmarks/run.py --compare old.json new.json
+
+The datasets are generated with a fixed seed, so they are the same for all
+runs of a given size. Only local storages are used: shelve, Shove memory and
+file stores, and MongoDB if `mongomock` is installed or a `mongod` is
+listening on the default port. Backends that are not available are skipped.
+
+Each benchmark is run several times and the best time is reported. The
+dataset is streamed into the storage, so it does not have to fit in memory.
+"""
+import datetime
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# run against the working copy rather than an installed version
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from doqu import Document
+from doqu.fields import Field
+
+
+DEFAULT_SIZE = 10000
+DEFAULT_REPEAT = 3
+SEED = 42
+
+# number of operations for benchmarks that do not depend on dataset size
+LOOKUPS = 1000
+COMPILES = 1000
+CONVERSIONS = 10000
+
+# a benchmark is considered a regression if it is this much slower
+DEFAULT_THRESHOLD = 1.2
+
+
+class Person(Document):
+    name = Field(unicode, index=True)
+    age = Field(int)
+    score = Field(float)
+    is_active = Field(bool)
+    born = Field(datetime.date)
+
+
+#------------+
+#  Datasets  |
+#------------+
+
+FIRST_NAMES = (u'Alice', u'Bob', u'Carol', u'Dave', u'Eve', u'Frank',
+               u'Grace', u'Heidi', u'Ivan', u'Judy')
+
+def make_records(size, seed=SEED):
+    "Yields `size` dictionaries with pseudo-random but reproducible values."
+    rand = random.Random(seed)
+    epoch = datetime.date(1950, 1, 1)
+    for i in xrange(size):
+        yield {
+            'name': u'{0} {1}'.format(rand.choice(FIRST_NAMES), i),
+            'age': rand.randint(0, 99),
+            'score': rand.random() * 100,
+            'is_active': rand.random() < 0.5,
+            'born': epoch + datetime.timedelta(days=rand.randint(0, 20000)),
+        }
+
+
+#------------+
+#  Backends  |
+#------------+
+
+class Unavailable(Exception):
+    "Raised by a backend factory if the backend cannot be used here."
+
+
+def _get_db(**settings):
+    # imported here because it is not needed to compare results
+    from doqu import get_db
+    try:
+        return get_db(**settings)
+    except Exception as e:
+        # missing library, server not running, etc.
+        raise Unavailable(e)
+
+def make_shelve(tmp_dir):
+    return _get_db(backend='doqu.ext.shelve_db',
+                   path=os.path.join(tmp_dir, 'shelve.db'))
+
+def make_shove_memory(tmp_dir):
+    return _get_db(backend='doqu.ext.shove_db', store_uri='memory://')
+
+def make_shove_file(tmp_dir):
+    return _get_db(backend='doqu.ext.shove_db',
+                   store_uri='file://' + os.path.join(tmp_dir, 'shove'))
+
+def make_mongo(tmp_dir):
+    try:
+        import mongomock
+    except ImportError:
+        mongomock = None
+    else:
+        # make the adapter pick a mock instead of connecting to a server
+        # (see doqu.ext.mongodb._acquire_connection)
+        try:
+            import doqu.ext.mongodb as backend
+        except Exception as e:
+            raise Unavailable(e)
+        key = ('127.0.0.1', 27017, ())
+        # the extra reference keeps the mock from being disconnected
+        backend._connections[key] = [mongomock.MongoClient(), 1]
+    db = _get_db(backend='doqu.ext.mongodb', database='doqu_benchmarks',
+                 collection='people')
+    db.clear()
+    return db
+
+# name --> factory(tmp_dir) that returns an empty storage adapter
+BACKENDS = (
+    ('shelve', make_shelve),
+    ('shove-memory', make_shove_memory),
+    ('shove-file', make_shove_file),
+    ('mongo', make_mongo),
+)
+
+# backends whose converter managers are benchmarked without a database
+DETACHED_BACKENDS = (
+    ('tokyo_cabinet', 'doqu.ext.tokyo_cabinet'),
+    ('tokyo_tyrant', 'doqu.ext.tokyo_tyrant'),
+)
+
+
+#--------------+
+#  Benchmarks  |
+#--------------+
+
+def measure(func, repeat):
+    "Returns the best time (in seconds) of given number of calls."
+    times = []
+    for i in range(repeat):
+        started = time.time()
+        func()
+        times.append(time.time() - started)
+    return min(times)
+
+def bench_converters(storage, records, repeat):
+    "Conversion between raw records and documents (no database access)."
+    raw = [dict((name, storage.value_to_db(value))
+                for name, value in data.iteritems())
+           for data in records]
+    documents = [Person(**data) for data in records]
+
+    def decorate():
+        for i, data in enumerate(raw):
+            storage._decorate(Person, i, data)
+
+    def encode():
+        # same as Document.save() minus validation and writing
+        for document in documents:
+            for name in Person.meta.structure:
+                document._encode_value(storage, name, document._data[name])
+
+    return [
+        ('decorate', measure(decorate, repeat), len(raw)),
+        ('encode', measure(encode, repeat), len(documents)),
+    ]
+
+def bench_documents(records, repeat):
+    "Backend-agnostic document operations."
+    def init():
+        for data in records:
+            Person(**data)
+
+    return [('document_init', measure(init, repeat), len(records))]
+
+def bench_storage(storage, size, repeat):
+    """
+    Writes and queries (the dataset is saved once). Each timed call builds
+    its own query, so the results are not taken from the query cache.
+    """
+    results = []
+
+    def get_items():
+        for data in make_records(size):
+            yield None, dict((name, storage.value_to_db(value))
+                             for name, value in data.iteritems())
+
+    started = time.time()
+    keys = storage.save_many(get_items())
+    results.append(('save_many', time.time() - started, size))
+
+    rand = random.Random(SEED)
+    sample = [rand.choice(keys) for i in range(LOOKUPS)]
+    del keys
+
+    def get():
+        for key in sample:
+            storage.get(Person, key)
+
+    def compile_where():
+        # the queries are lazy, so only the conditions are processed
+        for i in xrange(COMPILES):
+            Person.objects(storage).where(age__gte=30, name__startswith=u'A')
+
+    def scan():
+        len(Person.objects(storage).where(age__gte=50, is_active=True))
+
+    def scan_documents():
+        for document in Person.objects(storage).where(age__gte=50):
+            pass
+
+    def order_by():
+        list(Person.objects(storage).order_by('age'))
+
+    def order_by_limit():
+        Person.objects(storage).order_by('age')[:10]
+
+    def values():
+        list(Person.objects(storage).values('age'))
+
+    def count():
+        Person.objects(storage).where(age__lt=10).count()
+
+    tests = [
+        ('get', get, LOOKUPS),
+        ('where_compile', compile_where, COMPILES),
+        ('full_scan', scan, size),
+        ('full_scan_documents', scan_documents, size),
+        ('order_by', order_by, size),
+        ('order_by_limit', order_by_limit, size),
+        ('values', values, size),
+        ('count', count, size),
+    ]
+
+    try:
+        storage.ensure_indexes(Person)
+    except NotImplementedError:
+        # the backend does not support indexes
+        pass
+    else:
+        names = [storage.get(Person, key).name for key in sample]
+
+        def indexed_lookup():
+            for name in names:
+                list(Person.objects(storage).where(name=name))
+
+        tests.append(('indexed_lookup', indexed_lookup, LOOKUPS))
+
+    for name, func, items in tests:
+        results.append((name, measure(func, repeat), items))
+    return results
+
+def run(sizes, repeat, only=None, log=None):
+    """
+    Runs the benchmarks for given dataset sizes and returns a dictionary
+    ready for JSON serialization.
+    """
+    results = {}
+
+    def add(size, backend, items):
+        for name, seconds, count in items:
+            key = '{0}/{1}/{2}'.format(name, backend, size)
+            results[key] = {
+                'seconds': seconds,
+                'items': count,
+                'items_per_second': count / seconds if seconds else None,
+            }
+            if log:
+                log('{0:<45} {1:10.4f}s'.format(key, seconds))
+
+    for size in sizes:
+        # the benchmarks that do not depend on dataset size use a sample
+        records = list(make_records(min(size, CONVERSIONS)))
+        add(size, 'core', bench_documents(records, repeat))
+
+        for backend, module_name in DETACHED_BACKENDS:
+            if only and backend not in only:
+                continue
+            try:
+                __import__(module_name)
+            except Exception as e:
+                if log:
+                    log('{0}: skipped ({1})'.format(backend, e))
+                continue
+            storage = sys.modules[module_name].StorageAdapter._get_detached()
+            add(size, backend, bench_converters(storage, records, repeat))
+
+        for backend, factory in BACKENDS:
+            if only and backend not in only:
+                continue
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                try:
+                    storage = factory(tmp_dir)
+                except Unavailable as e:
+                    if log:
+                        log('{0}: skipped ({1})'.format(backend, e))
+                    continue
+                add(size, backend, bench_converters(storage, records, repeat))
+                add(size, backend, bench_storage(storage, size, repeat))
+                storage.disconnect()
+            finally:
+                shutil.rmtree(tmp_dir)
+
+    return {'meta': get_meta(sizes, repeat), 'results': results}
+
+
+#-----------+
+#  Reports  |
+#-----------+
+
+def get_commit():
+    try:
+        output = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  cwd=os.path.dirname(__file__) or None
+                                  ).communicate()[0]
+    except OSError:
+        return None
+    return output.strip() or None
+
+def get_meta(sizes, repeat):
+    return {
+        'commit': get_commit(),
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': sizes,
+        'repeat': repeat,
+        'seed': SEED,
+    }
+
+def compare(old, new, threshold=DEFAULT_THRESHOLD):
+    """
+    Returns a list of `(key, old seconds, new seconds, ratio)` for benchmarks
+    present in both results, and a list of keys which are slower than given
+    threshold.
+    """
+    rows = []
+    regressions = []
+    for key in sorted(set(old['results']) & set(new['results'])):
+        before = old['results'][key]['seconds']
+        after = new['results'][key]['seconds']
+        ratio = after / before if before else None
+        rows.append((key, before, after, ratio))
+        if ratio and threshold < ratio:
+            regressions.append(key)
+    return rows, regressions
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options]\n       %prog --compare OLD.json NEW.json')
+    parser.add_option('-s', '--size', dest='sizes', type='int',
+                      action='append', metavar='N',
+                      help='number of records (can be repeated) '
+                           '[{0}]'.format(DEFAULT_SIZE))
+    parser.add_option('-r', '--repeat', type='int', default=DEFAULT_REPEAT,
+                      help='number of runs per benchmark [%default]')
+    parser.add_option('-b', '--backend', dest='backends', action='append',
+                      metavar='NAME', help='only run given backend '
+                      '(can be repeated)')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the results to a JSON file')
+    parser.add_option('-c', '--compare', action='store_true', default=False,
+                      help='compare two result files')
+    parser.add_option('-t', '--threshold', type='float',
+                      default=DEFAULT_THRESHOLD,
+                      help='slowdown ratio reported as regression [%default]')
+    options, args = parser.parse_args(argv)
+
+    def log(message):
+        sys.stderr.write(message + '\n')
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error('expected two result files')
+        old, new = [json.load(open(path)) for path in args]
+        rows, regressions = compare(old, new, options.threshold)
+        for key, before, after, ratio in rows:
+            mark = ' !' if key in regressions else ''
+            print '{0:<45} {1:10.4f}s {2:10.4f}s {3:6.2f}x{4}'.format(
+                key, before, after, ratio or 0, mark)
+        if regressions:
+            log('{0} regression(s) found.'.format(len(regressions)))
+            return 1
+        return 0
+
+    data = run(options.sizes or [DEFAULT_SIZE], options.repeat,
+               only=options.backends, log=log)
+    output = json.dumps(data, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
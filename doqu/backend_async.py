@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+#    Doqu is a lightweight schema/query framework for document databases.
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of Docu.
+#
+#    Doqu is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Doqu is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with Docu.  If not, see <http://gnu.org/licenses/>.
+
+
+"""
+Background I/O
+==============
+
+Non-blocking wrappers for storage and query adapters. Each operation is
+performed by a background worker and returns a
+:class:`~doqu.utils.concurrency.Future` immediately, so the caller does not
+have to wait for the database::
+
+    db = doqu.get_db(backend='doqu.ext.tokyo_tyrant', pool_size=8)
+    async_db = AsyncStorageAdapter(db)
+
+    # all requests are sent concurrently
+    futures = [async_db.get(Person, pk) for pk in keys]
+    people = [f.result() for f in futures]
+
+    # queries are built as usual and executed in background
+    query = Person.objects(async_db).where(age__gt=30).order_by('name')
+    count = query.count()
+    first_page = query.fetch(0, 20)
+    print count.result(), first_page.result()
+
+The wrappers share the converter and lookup managers and the document
+decoration logic with the wrapped adapter: all the actual work is done by the
+adapter itself, only in another thread.
+
+Adapters that cannot be used by multiple threads at once, e.g. shelve or Tokyo
+Cabinet (see the `is_thread_safe` attribute of
+:class:`~doqu.backend_base.BaseStorageAdapter`), are served by a single worker;
+the calls are still performed in background but one at a time.
+
+.. note::
+
+    Doqu targets Python 2 which has no `asyncio`, so the operations are
+    offloaded to threads instead of being multiplexed on an event loop.
+    A :class:`~doqu.utils.concurrency.Future` can be waited for with
+    `result()` or handled with a callback (see
+    :meth:`~doqu.utils.concurrency.Future.add_done_callback`).
+
+"""
+
+from utils.concurrency import WorkerPool
+
+
+__all__ = ['AsyncStorageAdapter', 'AsyncQueryAdapter']
+
+
+DEFAULT_WORKERS = 4
+
+
+class AsyncStorageAdapter(object):
+    """
+    Wraps given storage adapter. All methods that access the database return
+    futures.
+
+    :param storage:
+        a storage adapter instance.
+    :param workers:
+        the number of background workers. By default it is 1 for adapters
+        that are not thread-safe and :data:`DEFAULT_WORKERS` for others.
+        Raises `ValueError` if more than one worker is requested for an
+        adapter that is not thread-safe.
+
+    """
+    def __init__(self, storage, workers=None):
+        if workers is None:
+            workers = DEFAULT_WORKERS if storage.is_thread_safe else 1
+        if 1 < workers and not storage.is_thread_safe:
+            raise ValueError('Storage adapter {0} is not thread-safe and '
+                             'cannot be used by multiple workers.'.format(
+                                 type(storage).__name__))
+        self.storage = storage
+        self._workers = WorkerPool(workers)
+
+    def __repr__(self):
+        return '<AsyncStorageAdapter {0}>'.format(repr(self.storage))
+
+    #--------------+
+    #  Public API  |
+    #--------------+
+
+    def close(self):
+        """
+        Waits until pending operations are finished and stops the workers.
+        The wrapped adapter is not disconnected.
+        """
+        self._workers.shutdown()
+
+    def delete(self, primary_key):
+        return self.submit(self.storage.delete, primary_key)
+
+    def get(self, doc_class, primary_key):
+        return self.submit(self.storage.get, doc_class, primary_key)
+
+    def get_many(self, doc_class, primary_keys):
+        return self.submit(self.storage.get_many, doc_class, primary_keys)
+
+    def get_query(self, model):
+        return AsyncQueryAdapter(self, model)
+
+    def save(self, data, primary_key=None):
+        return self.submit(self.storage.save, data=data,
+                           primary_key=primary_key)
+
+    def save_many(self, items):
+        return self.submit(self.storage.save_many, items)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedules an arbitrary call to be performed by a background worker
+        (e.g. ``async_db.submit(document.save, async_db.storage)``). Returns a
+        future.
+        """
+        return self._workers.submit(func, *args, **kwargs)
+
+    def update(self, primary_key, data):
+        return self.submit(self.storage.update, primary_key, data)
+
+
+class AsyncQueryAdapter(object):
+    """
+    A query for :class:`AsyncStorageAdapter`. Methods :meth:`where`,
+    :meth:`where_not` and :meth:`order_by` return new queries immediately;
+    the real query is built and executed by a background worker when results
+    are requested.
+    """
+    def __init__(self, storage, model, calls=()):
+        self.storage = storage
+        self.model = model
+        self._calls = calls
+
+    def _build(self):
+        # called by the worker
+        query = self.storage.storage.get_query(self.model)
+        for name, args, kwargs in self._calls:
+            query = getattr(query, name)(*args, **kwargs)
+        return query
+
+    def _clone(self, name, *args, **kwargs):
+        calls = self._calls + ((name, args, kwargs),)
+        return self.__class__(self.storage, self.model, calls)
+
+    def _submit(self, func):
+        return self.storage.submit(lambda: func(self._build()))
+
+    #--------------+
+    #  Public API  |
+    #--------------+
+
+    def count(self):
+        return self._submit(lambda q: q.count())
+
+    def delete(self):
+        return self._submit(lambda q: q.delete())
+
+    def fetch(self, start=0, stop=None):
+        """
+        Returns a future for the list of documents that match the query. The
+        list can be sliced in advance (which is usually much cheaper than
+        fetching all documents).
+        """
+        def fetch(query):
+            if not start and stop is None:
+                return list(query)
+            return list(query[start:stop])
+        return self._submit(fetch)
+
+    def increment(self, name, by=1):
+        return self._submit(lambda q: q.increment(name, by))
+
+    def order_by(self, *args, **kwargs):
+        return self._clone('order_by', *args, **kwargs)
+
+    def update(self, **fields):
+        return self._submit(lambda q: q.update(**fields))
+
+    def values(self, name):
+        return self._submit(lambda q: list(q.values(name)))
+
+    def where(self, **conditions):
+        return self._clone('where', **conditions)
+
+    def where_not(self, **conditions):
+        return self._clone('where_not', **conditions)
@@ -33,13 +33,22 @@ The backends do not have to subclass :class:`BaseStorageAdapter` and
 :class:`BaseQueryAdapter`. However, they must closely follow their API.
 """
 
+import datetime
+import decimal
 import logging
+import multiprocessing
+import re
+import time
+from collections import deque
+from itertools import islice
 
 import document_base
+from utils import instrumentation
+from utils.columns import make_column
 
 
 __all__ = [
-    'BaseStorageAdapter', 'BaseQueryAdapter',
+    'BaseStorageAdapter', 'BaseQueryAdapter', 'QueryCache',
     'ProcessorDoesNotExist',
     'LookupManager', 'LookupProcessorDoesNotExist',
     'ConverterManager', 'DataProcessorDoesNotExist',
@@ -48,6 +57,28 @@ __all__ = [
 log = logging.getLogger(__name__)
 
 
+# index types (see DocumentMetadata.indexes)
+INDEX_TYPES = ('lexical', 'decimal', 'token', 'q-gram')
+
+# the index named in a Tokyo Cabinet/Tyrant query hint (see explain), e.g.
+# 'using an index: "name" asc (STRDEC)'; full scans are reported as
+# 'scanning the whole table'
+TOKYO_HINT_INDEX = re.compile(r'using an (?:auxiliary )?index: "([^"]*)"')
+
+# datatypes for which numeric (decimal) index is picked by default
+DECIMAL_INDEX_DATATYPES = (int, long, float, decimal.Decimal, datetime.date)
+
+# maximum number of query plans cached per storage (see BaseQueryAdapter)
+QUERY_PLAN_CACHE_SIZE = 1000
+
+# defaults for the query result cache (see QueryCache)
+DEFAULT_QUERY_CACHE_SIZE = 1000
+DEFAULT_QUERY_CACHE_TTL = 60    # seconds
+
+# number of records sent to a worker process at once (see map_batches)
+DEFAULT_MAP_CHUNK_SIZE = 1000
+
+
 class BaseStorageAdapter(object):
     """
     Abstract adapter class for storage backends.
@@ -58,6 +89,9 @@ class BaseStorageAdapter(object):
     converter_manager = None
     lookup_manager = None
 
+    # whether the adapter can be used by multiple threads at once
+    is_thread_safe = False
+
     #--------------------+
     #  Magic attributes  |
     #--------------------+
@@ -67,10 +101,22 @@ class BaseStorageAdapter(object):
 
     def __init__(self, **kw):
         "Typical kwargs: host, port, name, user, password."
-        self._connection_options = kw
-        self.connection = None
+        self._init_state(kw)
         self.connect()
 
+    def _init_state(self, options):
+        self._connection_options = options
+        self.connection = None
+        # (document class, lookups, negate) --> query plan (see
+        # BaseQueryAdapter._get_query_plan)
+        self._query_plans = {}
+        # write generation: bumped on every write to invalidate cached query
+        # results (see enable_query_cache)
+        self._generation = 0
+        self._query_cache = None
+        # see add_listener
+        self._listeners = []
+
     def __iter__(self):
         raise NotImplementedError
 
@@ -78,62 +124,159 @@ class BaseStorageAdapter(object):
         raise NotImplementedError
 
     def __nonzero__(self):
-        if self.connection is not None:
-            return True
+        return self.connection is not None
 
     #----------------------+
     #  Private attributes  |
     #----------------------+
 
+    def _bump_generation(self):
+        """
+        Invalidates cached query results. Must be called by the backend after
+        every write operation.
+        """
+        self._generation += 1
+
+    def _convert_from_db(self, model, key, name, datatype, data):
+        """
+        Returns the value of given field taken from given raw record and
+        converted to given datatype.
+        """
+        value = data.get(name, None)
+        try:
+            # symmetric with doqu.document_base.Document.save
+            if not name in model.meta.skip_type_conversion:
+                value = self.value_from_db(datatype, value)
+            if name in model.meta.incoming_processors:
+                if value is not None:
+                    processor = model.meta.incoming_processors[name]
+                    value = processor(value)
+        except ValueError as e:
+            log.warn('could not convert %s.%s (primary key %s): %s'
+                     % (model.__name__, name, repr(key), e))
+            # If incoming value could not be converted to desired data
+            # type, it is left as is (and will cause invalidation of the
+            # model on save). However, user can choose to raise ValueError
+            # immediately when such broken record it retrieved:
+            if model.meta.break_on_invalid_incoming_data:
+                raise
+        return value
+
+    def _create_index(self, name, index_type):
+        """
+        Creates an index of given type (see :data:`INDEX_TYPES`) on given
+        field unless it already exists. Returns `True` if the index has been
+        created. Used by :meth:`ensure_indexes`.
+        """
+        raise NotImplementedError # pragma: nocover
+
     def _decorate(self, model, key, data):
         """
         Populates a model instance with given data and initializes its state
         object with current storage and given key.
         """
 
+        listening = bool(self._listeners)
+        if listening:
+            started = time.time()
+
         if model.meta.structure:
             pythonized_data = {}
 
             # NOTE: nested definitions are not supported here.
             # if you fix this, please check the BaseStorage.supports_nested_data
             for name, type_ in model.meta.structure.iteritems():
-                value = data.get(name, None)
-                try:
-                    # symmetric with doqu.document_base.Document.save
-                    if not name in model.meta.skip_type_conversion:
-                        value = self.value_from_db(type_, value)
-                    if name in model.meta.incoming_processors:
-                        if value is not None:
-                            processor = model.meta.incoming_processors[name]
-                            value = processor(value)
-                except ValueError as e:
-                    log.warn('could not convert %s.%s (primary key %s): %s'
-                             % (model.__name__, name, repr(key), e))
-                    # If incoming value could not be converted to desired data
-                    # type, it is left as is (and will cause invalidation of the
-                    # model on save). However, user can choose to raise ValueError
-                    # immediately when such broken record it retrieved:
-                    if model.meta.break_on_invalid_incoming_data:
-                        raise
-                pythonized_data[name] = value
+                pythonized_data[name] = self._convert_from_db(model, key, name,
+                                                              type_, data)
         else:
             # if the structure is unknown, just populate the document as is
             pythonized_data = data.copy()
+
+        if listening:
+            converted = time.time()
         instance = model(**pythonized_data)
+        if listening:
+            instrumentation.record_decoding(converted - started,
+                                            time.time() - converted)
         # FIXME access to private attribute; make it public?
         instance._saved_state.update(storage=self, key=key, data=data)
+        # the values were just loaded, nothing is changed yet
+        instance._changed_fields.clear()
         return instance
 
+    @classmethod
+    def _get_detached(cls):
+        """
+        Returns an instance of the adapter that is not connected to the
+        database. It can only be used to convert raw records to documents,
+        e.g. in a worker process (see :meth:`BaseQueryAdapter.map_batches`).
+        The instances are reused within the process.
+        """
+        if cls not in _detached_storages:
+            storage = cls.__new__(cls)
+            storage._init_state({})
+            _detached_storages[cls] = storage
+        return _detached_storages[cls]
+
     def _fetch(self, primary_key):
         """
         Returns a dictionary representing the record with given primary key.
         """
         raise NotImplementedError # pragma: nocover
 
+    def _get_declared_indexes(self, doc_class):
+        """
+        Returns a dictionary of field names and index types declared in given
+        document class (see :attr:`DocumentMetadata.indexes`). If the type is
+        not explicitly declared, it is picked depending on the field's
+        datatype: `decimal` for numbers and dates, `token` for lists and
+        `lexical` for anything else.
+        """
+        indexes = {}
+        for name, index_type in doc_class.meta.indexes.iteritems():
+            if index_type is None:
+                datatype = doc_class.meta.structure.get(name)
+                if not isinstance(datatype, type):
+                    index_type = 'lexical'
+                elif issubclass(datatype, DECIMAL_INDEX_DATATYPES):
+                    index_type = 'decimal'
+                elif issubclass(datatype, (list, tuple)):
+                    index_type = 'token'
+                else:
+                    index_type = 'lexical'
+            if index_type not in INDEX_TYPES:
+                raise ValueError('Unknown index type "{0}" for {1}.{2}'.format(
+                                 index_type, doc_class.__name__, name))
+            indexes[name] = index_type
+        return indexes
+
     #--------------+
     #  Public API  |
     #--------------+
 
+    def add_listener(self, listener):
+        """
+        Attaches given listener to the storage. The listener is notified
+        about queries (when they are started and finished) and about `get`,
+        `save` and `delete` calls, with timings, row counts and query cache
+        hits. Usage::
+
+            from doqu.utils.instrumentation import StatsCollector
+
+            stats = StatsCollector(slow_query_threshold=0.5)
+            db.add_listener(stats)
+
+        :param listener:
+            an instance of :class:`~doqu.utils.instrumentation.Listener`
+            subclass.
+
+        The operations are only timed while at least one listener is
+        attached. See :mod:`doqu.utils.instrumentation` for details.
+        """
+        if not self._listeners:
+            instrumentation.instrument(self)
+        self._listeners.append(listener)
+
     def clear(self):
         """
         Clears the whole storage from data, resets autoincrement counters.
@@ -154,6 +297,12 @@ class BaseStorageAdapter(object):
         """
         raise NotImplementedError # pragma: nocover
 
+    def disable_query_cache(self):
+        """
+        Disables caching of query results and drops the cache.
+        """
+        self._query_cache = None
+
     def disconnect(self):
         """
         Closes internal store and removes the reference to it.
@@ -163,6 +312,55 @@ class BaseStorageAdapter(object):
         #   self.connection = None
         raise NotImplementedError # pragma: nocover
 
+    def enable_query_cache(self, size=DEFAULT_QUERY_CACHE_SIZE,
+                           ttl=DEFAULT_QUERY_CACHE_TTL):
+        """
+        Enables caching of query results. Primary keys of the records that
+        match a query are stored in memory and reused by identical queries
+        (same document class, conditions and ordering) until any record is
+        written to the storage through this adapter or until `ttl` seconds
+        pass. Usage::
+
+            db.enable_query_cache(size=100, ttl=10)
+
+        :param size:
+            maximum number of cached queries. Raises ValueError if it is less
+            than 1 (use :meth:`disable_query_cache` instead).
+        :param ttl:
+            number of seconds for which cached results are considered valid.
+            Changes made by other processes are only seen after this time.
+
+        Backends that do not support the cache ignore it. It is currently
+        supported by shelve, Shove and Tokyo Cabinet adapters.
+        """
+        if size < 1:
+            raise ValueError('Query cache size must be positive, got '
+                             '{0}.'.format(size))
+        self._query_cache = QueryCache(size=size, ttl=ttl)
+
+    def ensure_indexes(self, doc_class):
+        """
+        Creates indexes declared in given document class (see
+        :attr:`DocumentMetadata.indexes`) unless they already exist. Returns
+        a dictionary of field names and types of indexes that have been
+        created. Usage::
+
+            class Person(Document):
+                structure = {'name': unicode, 'age': int, 'bio': unicode}
+                indexes = {'name': None, 'age': None, 'bio': 'q-gram'}
+
+            db.ensure_indexes(Person)   # lexical, decimal and q-gram indexes
+
+        Backends that support indexes implement :meth:`_create_index`; some of
+        them override this method (then the format of the result may
+        differ).
+        """
+        created = {}
+        for name, index_type in self._get_declared_indexes(doc_class).items():
+            if self._create_index(name, index_type):
+                created[name] = index_type
+        return created
+
     def get(self, doc_class, primary_key):
         """
         Returns document instance for given document class and primary key.
@@ -213,6 +411,15 @@ class BaseStorageAdapter(object):
         self.disconnect()
         self.connect()
 
+    def remove_listener(self, listener):
+        """
+        Detaches given listener from the storage (see :meth:`add_listener`).
+        Raises `ValueError` if the listener is not attached.
+        """
+        self._listeners.remove(listener)
+        if not self._listeners:
+            instrumentation.uninstrument(self)
+
     def save(self, model, data, primary_key=None):
         """
         Saves given model instance into the storage. Returns
@@ -230,6 +437,41 @@ class BaseStorageAdapter(object):
         """
         raise NotImplementedError # pragma: nocover
 
+    def update(self, primary_key, data):
+        """
+        Updates given fields of an existing record and leaves other fields
+        intact. Returns primary key.
+
+        :param primary_key:
+            the key of the record to be updated.
+        :param data:
+            dict containing the properties to be changed (already prepared for
+            the database).
+
+        This implementation fetches the record, merges the changes and saves
+        the whole record. Backends that support partial updates should
+        reimplement the method.
+        """
+        record = dict(self._fetch(primary_key))
+        record.update(data)
+        return self.save(data=record, primary_key=primary_key)
+
+    def save_many(self, items):
+        """
+        Saves given records into the storage. Returns a list of primary keys.
+
+        :param items:
+            an iterable of `(primary_key, data)` pairs where `data` is a dict
+            containing all properties to be saved and `primary_key` may be
+            `None` (then it will be generated).
+
+        Basically this is just a simple wrapper around
+        :meth:`~BaseStorageAdapter.save` but some backends can reimplement the
+        method in a much more efficient way.
+        """
+        return [self.save(data=data, primary_key=primary_key)
+                for primary_key, data in items]
+
     def value_from_db(self, datatype, value):
         assert self.converter_manager, 'backend must provide converter manager'
         return self.converter_manager.from_db(datatype, value)
@@ -239,15 +481,88 @@ class BaseStorageAdapter(object):
         return self.converter_manager.to_db(value, self)
 
 
+# storage adapter class --> detached instance (see _get_detached)
+_detached_storages = {}
+
+
+def _map_batch(task):
+    # runs in a worker process (see BaseQueryAdapter.map_batches)
+    storage_class, model, func, records = task
+    storage = storage_class._get_detached()
+    return [func(storage._decorate(model, key, data)) for key, data in records]
+
+
+class QueryCache(object):
+    """
+    A bounded in-memory cache with expiration for query results. Each entry
+    is tagged with the write generation of the storage at the time when the
+    query was executed; an entry from another generation is considered stale.
+
+    :param size:
+        maximum number of entries. If there's no room for a new entry, stale
+        entries are dropped; if that doesn't help, the oldest entry is dropped.
+    :param ttl:
+        number of seconds after which an entry expires.
+
+    """
+    def __init__(self, size=DEFAULT_QUERY_CACHE_SIZE,
+                 ttl=DEFAULT_QUERY_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = {}    # key --> (generation, expiration time, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, generation, now):
+        for key, (gen, expires, value) in self._entries.items():
+            if gen != generation or expires < now:
+                del self._entries[key]
+        if self.size <= len(self._entries):
+            oldest = min(self._entries, key=lambda k: self._entries[k][1])
+            del self._entries[oldest]
+
+    def clear(self):
+        "Drops all entries."
+        self._entries = {}
+
+    def get(self, key, generation):
+        """
+        Returns the value cached for given key. Raises KeyError if there is
+        no such value or if it is stale.
+        """
+        gen, expires, value = self._entries[key]
+        if gen != generation or expires < time.time():
+            self._entries.pop(key, None)
+            raise KeyError(key)
+        return value
+
+    def set(self, key, generation, value):
+        "Stores given value for given key and write generation."
+        now = time.time()
+        if key not in self._entries and self.size <= len(self._entries):
+            self._evict(generation, now)
+        self._entries[key] = generation, now + self.ttl, value
+
+
 class BaseQueryAdapter(object):
     """
     Query adapter for given backend.
+
+    Queries are lazy: the search is deferred until the results are actually
+    needed, so intermediate queries created by :meth:`where` and the like
+    are never executed. Adapters initialize the `_executed` flag in `_init`
+    and run the search in `_prepare` (see
+    :class:`~doqu.utils.data_structures.CachedIterator`) on first access.
     """
 
     #--------------------+
     #  Magic attributes  |
     #--------------------+
 
+    def __and__(self, other):
+        raise NotImplementedError # pragma: nocover
+
     def __getitem__(self, key):
         raise NotImplementedError # pragma: nocover
 
@@ -285,23 +600,129 @@ class BaseQueryAdapter(object):
     #  Private attributes  |
     #----------------------+
 
+    def _get_cache_key(self):
+        """
+        Returns a hashable representation of current query (conditions and
+        ordering) for the query result cache or `None` if the backend does not
+        support caching. Equal keys must mean equal results.
+        """
+        return None
+
+    def _get_cached(self, kind, compute):
+        """
+        Returns the result of calling `compute` (e.g. the list of primary keys
+        of matching records). If the storage has the query cache enabled, the
+        result is taken from the cache or stored there.
+
+        :param kind:
+            a string that tells apart different results for the same query
+            (e.g. "keys").
+        :param compute:
+            a callable that returns the result.
+        """
+        cache = self.storage._query_cache
+        if cache is None:
+            return compute()
+        query_key = self._get_cache_key()
+        if query_key is None:
+            return compute()
+        key = kind, self.model, query_key
+        # the generation is taken *before* the query is executed so that a
+        # concurrent write makes the result stale
+        generation = self.storage._generation
+        try:
+            value = cache.get(key, generation)
+        except KeyError:
+            value = compute()
+            cache.set(key, generation, value)
+            hit = False
+        else:
+            hit = True
+        if self.storage._listeners:
+            instrumentation.record_cache_hit(hit)
+        return value
+
+    def _is_cached(self, kind):
+        """
+        Returns `True` if the result of given kind (see :meth:`_get_cached`)
+        for current query is in the query cache.
+        """
+        cache = self.storage._query_cache
+        if cache is None:
+            return False
+        query_key = self._get_cache_key()
+        if query_key is None:
+            return False
+        try:
+            cache.get((kind, self.model, query_key), self.storage._generation)
+        except KeyError:
+            return False
+        return True
+
+    def _make_plan(self, **items):
+        """
+        Returns a query plan dictionary (see :meth:`explain`) with given items
+        and default values for the rest.
+        """
+        plan = {
+            'backend': type(self.storage).__module__,
+            'conditions': [],
+            'index': None,
+            'full_scan': None,
+            'estimated_scan': None,
+            'order_pushed_down': None,
+            'limit_pushed_down': None,
+            'native': None,
+        }
+        plan.update(items)
+        return plan
+
+    def _parse_tokyo_hint(self, hint):
+        """
+        Returns the name of the index mentioned in given Tokyo Cabinet/Tyrant
+        query hint (or `None`) and whether the hint reports a full scan.
+        """
+        hint = hint or ''
+        match = TOKYO_HINT_INDEX.search(hint)
+        index = match.group(1) if match else None
+        return index, index is None and 'scanning the whole table' in hint
+
+    def _get_raw_records(self, names=None):
+        """
+        Returns an iterator over `(primary key, raw data)` pairs for matching
+        records. The pairs can be converted to documents by the storage's
+        `_decorate` method (the key can be `None` if the data contains it).
+        Required by :meth:`map_batches` and :meth:`to_columns`.
+
+        :param names:
+            if given, only these fields are needed; the backend may omit the
+            rest of the data (and the key).
+
+        """
+        raise NotImplementedError # pragma: nocover
+
+    def _pop_batch_result(self, pending, ordered):
+        "Waits for a result of map_batches() chunk and returns it."
+        if not ordered:
+            while True:
+                for async_result in pending:
+                    if async_result.ready():
+                        pending.remove(async_result)
+                        return async_result.get()
+                pending[0].wait(0.01)
+        return pending.popleft().get()
+
     def _get_native_conditions(self, conditions, negate=False):
         """
         Returns a generator for backend-specific conditions based on a
         dictionary of backend-agnostic ones.
         """
-        for lookup, value in conditions.iteritems():
-            if '__' in lookup:
-                name, operation = lookup.split('__')    # XXX check if there are 2 parts
-            else:
-                name, operation = lookup, None
-            processor = self.storage.lookup_manager.get_processor(operation)
-            # lookup processor may (not) want to convert value to the
-            # database-friendly format; we pass the appropriate function along
-            # with the intact "pythonized" value
-            def preprocessor(x):
-                return self.storage.converter_manager.to_db(x, self.storage)
-            native = processor(name, value, preprocessor, negate)
+        # lookup processor may (not) want to convert value to the
+        # database-friendly format; we pass the appropriate function along
+        # with the intact "pythonized" value
+        preprocessor = self.storage.value_to_db
+        for lookup, name, processor in self._get_query_plan(conditions, negate):
+            native = processor(name, conditions[lookup], preprocessor, negate)
 
             # yield name/value pair(s)
             if hasattr(native, 'next') or isinstance(native, (list, tuple)):
@@ -310,6 +731,70 @@ class BaseQueryAdapter(object):
             else:
                 yield native  #(name, value)
 
+    def _get_query_plan(self, conditions, negate=False):
+        """
+        Returns a list of `(lookup, field name, lookup processor)` triples for
+        given dictionary of backend-agnostic conditions. Only the lookups (the
+        keys) matter, not the values, so the plans are cached per storage:
+        applications tend to build the same query shapes over and over again
+        with different values.
+        """
+        plans = self.storage._query_plans
+        key = (self.model, tuple(sorted(conditions)), negate)
+        try:
+            return plans[key]
+        except KeyError:
+            pass
+        plan = []
+        for lookup in key[1]:
+            if '__' in lookup:
+                name, operation = lookup.split('__')    # XXX check if there are 2 parts
+            else:
+                name, operation = lookup, None
+            processor = self.storage.lookup_manager.get_processor(operation)
+            plan.append((lookup, name, processor))
+        if QUERY_PLAN_CACHE_SIZE <= len(plans):
+            # too many shapes (probably generated); start over
+            plans.clear()
+        plans[key] = plan
+        return plan
+
+    def _check_field_name(self, name):
+        """
+        Raises KeyError if given field is not declared in the document
+        structure (unless the structure is not defined at all).
+        """
+        structure = self.model.meta.structure
+        if structure and name not in structure:
+            raise KeyError('Unknown field "{0}"'.format(name))
+
+    def _get_incremented_value(self, name, value, by):
+        """
+        Returns given database-friendly value of given field incremented by
+        given number and converted back to the database-friendly format.
+        """
+        self._check_field_name(name)
+        datatype = self.model.meta.structure.get(name) or type(by)
+        value = self.storage.value_from_db(datatype, value) or 0
+        return self.storage.value_to_db(value + by)
+
+    def _get_native_values(self, fields):
+        """
+        Returns a dictionary of given field values converted to the
+        database-friendly format exactly as :meth:`Document.save
+        <doqu.document_base.Document.save>` would convert them.
+        """
+        meta = self.model.meta
+        native = {}
+        for name, value in fields.iteritems():
+            self._check_field_name(name)
+            if name in meta.outgoing_processors and value is not None:
+                value = meta.outgoing_processors[name](value)
+            if name not in meta.skip_type_conversion:
+                value = self.storage.value_to_db(value)
+            native[name] = value
+        return native
+
     def _init(self):
         pass
 
@@ -342,6 +827,108 @@ class BaseQueryAdapter(object):
         """
         raise NotImplementedError # pragma: nocover
 
+    def explain(self):
+        """
+        Returns a dictionary that describes how the query is executed by the
+        backend. Handy to spot full scans::
+
+            plan = Person.objects(db).where(name='John').explain()
+            if plan['full_scan']:
+                ...
+
+        The keys are:
+
+        * `backend`: the backend module name;
+        * `conditions`: the native conditions (see `_get_native_conditions`);
+        * `index`: name of the index used by the search, or `None`;
+        * `full_scan`: `True` if all records are examined, `False` if not,
+          `None` if unknown;
+        * `estimated_scan`: estimated number of examined records (or `None`);
+        * `order_pushed_down`: `True` if the records are sorted by the
+          database, `False` if on client side, `None` if the query is not
+          ordered;
+        * `limit_pushed_down`: `True` if slices are fetched by the database,
+          `False` if the preceding records are skipped on client side;
+        * `native`: backend-specific information (e.g. the output of
+          MongoDB's `explain` or the Tokyo Cabinet query hint).
+
+        Some backends execute the query to obtain the information.
+        """
+        raise NotImplementedError # pragma: nocover
+
+    def increment(self, name, by=1):
+        """
+        Increments given numeric field by given number in all records that
+        match current query. A missing value is treated as zero.
+
+        This implementation fetches and saves each document. Backends should
+        reimplement the method to do it in a single operation if possible.
+        """
+        for document in self:
+            document[name] = (document.get(name) or 0) + by
+            document.save(only_changed=True)
+
+    def iterator(self):
+        """
+        Returns an iterator over the documents that match current query. Unlike
+        ordinary iteration, the documents are not cached by the query object,
+        so memory consumption does not depend on the number of documents.
+        """
+        return iter(self)    # may cache the results, override if possible
+
+    def map_batches(self, func, workers=None, chunk=DEFAULT_MAP_CHUNK_SIZE,
+                    ordered=True):
+        """
+        Calls given function for each document that matches current query in
+        a pool of worker processes and returns an iterator over the results.
+        The raw records are fetched in this process and sent to the workers
+        in chunks; the workers convert them to documents and call the
+        function. This way the CPU-bound work is not limited to a single
+        core. Usage::
+
+            def get_total(order):
+                return order.price * order.quantity
+
+            totals = Order.objects(db).map_batches(get_total, workers=8)
+
+        Only a few chunks are queued at a time, so memory consumption does not
+        depend on the number of records.
+
+        :param func:
+            a function that accepts a document. The function, the document
+            class and the results must be picklable (e.g. defined at module
+            level). The document is not bound to a connected storage, so it
+            cannot be saved or used to fetch related documents.
+        :param workers:
+            number of worker processes. Defaults to the number of CPUs.
+        :param chunk:
+            number of records sent to a worker at once.
+        :param ordered:
+            if `False`, the results of each chunk are yielded as soon as they
+            are ready, regardless of the order of records.
+
+        """
+        workers = workers or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(workers)
+        storage_class = type(self.storage)
+        records = iter(self._get_raw_records())
+        pending = deque()
+        try:
+            while True:
+                # keep each worker busy, with one chunk waiting in the queue
+                while len(pending) < workers * 2:
+                    batch = list(islice(records, chunk))
+                    if not batch:
+                        break
+                    task = storage_class, self.model, func, batch
+                    pending.append(pool.apply_async(_map_batch, (task,)))
+                if not pending:
+                    break
+                for result in self._pop_batch_result(pending, ordered):
+                    yield result
+        finally:
+            pool.terminate()
+
     def order_by(self, name):
         """
         Returns a query object with same conditions but with results sorted by
@@ -354,6 +941,57 @@ class BaseQueryAdapter(object):
         """
         raise NotImplementedError # pragma: nocover
 
+    def to_columns(self, names):
+        """
+        Returns a dictionary of typed arrays of values for given field names,
+        one item per record that matches current query. Only requested fields
+        are converted and no documents are created, so this is much faster
+        than collecting the values from documents. Usage::
+
+            columns = Order.objects(db).to_columns(['price', 'qty'])
+            total = (columns['price'] * columns['qty']).sum()
+
+        The type of each array depends on the field's declared datatype. NumPy
+        arrays are returned if NumPy is installed, otherwise `array.array` or
+        lists (see :func:`doqu.utils.columns.make_column` for details). Missing
+        values are masked (with NumPy) or represented by `None`.
+        """
+        names = list(names)
+        structure = self.model.meta.structure
+        storage = self.storage
+        values = dict((name, []) for name in names)
+        for key, data in self._get_raw_records(names):
+            for name in names:
+                if name in structure:
+                    value = storage._convert_from_db(self.model, key, name,
+                                                     structure[name], data)
+                else:
+                    value = data.get(name)
+                values[name].append(value)
+        return dict((name, make_column(structure.get(name), values[name]))
+                    for name in names)
+
+    def update(self, **fields):
+        """
+        Sets given fields to given values in all records that match current
+        query. Other fields are left intact. Usage::
+
+            Person.objects(db).where(is_active=True).update(is_active=False)
+
+        This implementation fetches and saves each document. Backends should
+        reimplement the method to do it in a single operation if possible.
+
+        .. note::
+
+            backend-specific implementations convert the values according to
+            the document class metadata but do *not* apply the validators.
+
+        """
+        for document in self:
+            for name, value in fields.iteritems():
+                document[name] = value
+            document.save(only_changed=True)
+
     def values(self, name):
         """
         Returns a list of unique values for given column name.
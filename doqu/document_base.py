@@ -155,6 +155,15 @@ class DocumentMetadata(object):
         before it is saved to the database. The backend-specific machinery
         works *after* the processor is called.
 
+    :describe indexes:
+        A dictionary of keys and index types. Tells the backend which fields
+        should be indexed (see
+        :meth:`~doqu.backend_base.BaseStorageAdapter.ensure_indexes`). The
+        index type is one of `lexical`, `decimal`, `token` and `q-gram` (the
+        latter is suitable for full-text lookups like `like`) or `None`; in
+        the latter case the type is picked depending on the field's datatype.
+        The backend may ignore index types it does not support.
+
     """
     # what attributes can be updated/inherited using methods
     # inherit() and update()
@@ -162,7 +171,7 @@ class DocumentMetadata(object):
                     'skip_type_conversion',
                     'incoming_processors', 'outgoing_processors',
                     'set_item_processors', 'get_item_processors',
-                    'referenced_by',
+                    'referenced_by', 'indexes',
                     'break_on_invalid_incoming_data',
                     'label', 'label_plural')
 
@@ -185,6 +194,7 @@ class DocumentMetadata(object):
         self.incoming_processors = {}  # field name => func (deserializer)
         self.outgoing_processors = {}  # field name => func (serializer)
         self.referenced_by = {}
+        self.indexes = {}      # field name => index type (or None)
         #use_dot_notation = True
         self.break_on_invalid_incoming_data = False
 
@@ -379,7 +389,12 @@ class Document(DotDict):
             # FIXME changes internal state!!! bad, bad, baaad
             # we need to cache the instances but keep PKs intact.
             # this will affect cloning but it's another story.
+            # (at least we don't mark the field as changed: the reference
+            # itself is the same)
+            was_changed = key in self._changed_fields
             self[key] = value
+            if not was_changed:
+                self._changed_fields.discard(key)
 
             return value
         else:
@@ -393,6 +408,10 @@ class Document(DotDict):
         # NOTE: state must be filled from outside
         self._saved_state = DocumentSavedState()
 
+        # names of fields modified via __setitem__ since the document was
+        # last fetched from or saved to the storage
+        self._changed_fields = set()
+
         self._data = dict.fromkeys(self.meta.structure)  # None per default
 
 #        errors = []
@@ -463,6 +482,7 @@ class Document(DotDict):
 
         self._validate_value(key, value)  # will raise ValidationError if wrong
         super(Document, self).__setitem__(key, value)
+        self._changed_fields.add(key)
 
     def __unicode__(self):
         return repr(self._data)
@@ -492,12 +512,24 @@ class Document(DotDict):
         for name in fields_to_copy:
             if name in self._data:
                 new_obj._data[name] = self._data[name]
+                if name in self._changed_fields:
+                    new_obj._changed_fields.add(name)
 
         if self._saved_state:
             new_obj._saved_state = self._saved_state.clone()
 
         return new_obj
 
+    def _encode_value(self, storage, name, value):
+        # symmetric with docu.backend_base.BaseStorageAdapter._decorate
+        if name in self.meta.outgoing_processors and value is not None:
+            processor = self.meta.outgoing_processors[name]
+            value = processor(value)
+
+        if name in self.meta.skip_type_conversion:
+            return value
+        return storage.value_to_db(value)
+
     def _fill_defaults(self):
         """
         Fills default values. Example::
@@ -612,6 +644,31 @@ class Document(DotDict):
         module = __import__(module_path, globals(), locals(), [attr_name], -1)
         return getattr(module, attr_name)
 
+    def _save_changed_fields(self):
+        """
+        Sends changed fields to the storage the document was fetched from.
+        Returns the primary key. Does not hit the storage if nothing was
+        changed. See :meth:`save`.
+        """
+        storage = self._saved_state.storage
+        names = self._changed_fields
+        if self.meta.structure:
+            names = [x for x in names if x in self.meta.structure]
+        if not names:
+            return self.pk
+
+        changes = {}
+        for name in names:
+            changes[name] = self._encode_value(storage, name,
+                                               self._data.get(name))
+        storage.update(self.pk, changes)
+
+        data = dict(self._saved_state.data or {})
+        data.update(changes)
+        self._saved_state.update(data=data)
+        self._changed_fields.clear()
+        return self.pk
+
     def _validate_value(self, key, value):
         # note: we intentionally provide the value instead of leaving the
         # method get it by key because the method is used to check both
@@ -637,6 +694,9 @@ class Document(DotDict):
         if value is None:
             return
         datatype = self.meta.structure.get(key)
+        if datatype is None:
+            # the field is not declared (e.g. the structure is unknown)
+            return
         if isinstance(datatype, basestring):
             # A text reference, i.e. "self" or document class name.
             return
@@ -769,14 +829,30 @@ class Document(DotDict):
                 value = repr(value)
             print template.format(key=key, value=value, width=width)
 
+    def get_changed_fields(self):
+        """
+        Returns a set of names of fields that were modified since the document
+        was fetched from the storage or saved to it. If the document has not
+        been saved yet, all known fields are considered changed.
+
+        .. note::
+
+            Only assignments are tracked (``doc.foo = x`` or ``doc['foo'] =
+            x``). In-place modification of mutable values (e.g.
+            ``doc.tags.append(x)``) cannot be detected; reassign the value or
+            save the whole document in such cases.
+
+        """
+        if not self.pk:
+            return set(self.meta.structure or self._data)
+        return set(self._changed_fields)
+
     def is_field_changed(self, name):
         if self.meta.structure:
             assert name in self.meta.structure
         if not self.pk:
             return True
-        if self.get(name) == self._saved_state.data.get(name):
-            return False
-        return True
+        return name in self._changed_fields
 
     def is_valid(self):
         try:
@@ -838,7 +914,7 @@ class Document(DotDict):
         """
         return self._saved_state.key
 
-    def save(self, storage=None, keep_key=False):   #, sync=True):
+    def save(self, storage=None, keep_key=False, only_changed=False):
         """
         Saves instance to given storage.
 
@@ -852,6 +928,14 @@ class Document(DotDict):
             records can be overwritten. You will only *need* this when copying
             a set of records that reference each other by primary key. Default
             is `False`.
+        :param only_changed:
+            if `True` and the document is being saved back to the record it
+            was fetched from, only the fields that were changed since then
+            (see :meth:`get_changed_fields`) are encoded and sent to the
+            storage as a partial update (see
+            :meth:`~doqu.backend_base.BaseStorageAdapter.update`). If nothing
+            was changed, the storage is not accessed at all. In all other cases
+            the whole record is saved. Default is `False`.
 
         """
 
@@ -877,6 +961,10 @@ class Document(DotDict):
 
         self.validate()    # will raise ValidationError if something is wrong
 
+        is_same_record = (self.pk and storage == self._saved_state.storage)
+        if only_changed and is_same_record:
+            return self._save_changed_fields()
+
         # Dictionary self._data only keeps known properties. The database
         # record may contain other data. The original data is kept in the
         # dictionary self._saved_state.data. Now we copy the original record, update
@@ -892,15 +980,7 @@ class Document(DotDict):
             pairs = self._data.items()
 
         for name, value in pairs:
-            # symmetric with docu.backend_base.BaseStorageAdapter._decorate
-            if name in self.meta.outgoing_processors and value is not None:
-                processor = self.meta.outgoing_processors[name]
-                value = processor(value)
-
-            if name in self.meta.skip_type_conversion:
-                data[name] = value
-            else:
-                data[name] = storage.value_to_db(value)
+            data[name] = self._encode_value(storage, name, value)
 
         # TODO: make sure we don't overwrite any attrs that could be added to this
         # document meanwhile. The chances are rather high because the same document
@@ -928,6 +1008,7 @@ class Document(DotDict):
         # okay, update our internal representation of the record with what have
         # been just successfully saved to the database
         self._saved_state.update(key=key, storage=storage, data=data)
+        self._changed_fields.clear()
         # ...and return the key, yep
         assert key == self.pk    # TODO: move this to tests
         return key
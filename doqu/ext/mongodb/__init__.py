@@ -43,23 +43,83 @@ A storage/query backend for MongoDB.
 from doqu import dist
 dist.check_dependencies(__name__)
 
+import logging
+import threading
+
 import pymongo
 
 from doqu.backend_base import BaseStorageAdapter, BaseQueryAdapter
 from doqu.utils.data_structures import CachedIterator
+from doqu.utils.instrumentation import observed
 
 from converters import converter_manager
 from lookups import lookup_manager
 
 
+log = logging.getLogger(__name__)
+
+
+# Process-wide registry of MongoDB connections. Storage adapters pointing to
+# the same server (with same connection options) share a single connection
+# and its socket pool regardless of the database and collection they use.
+#   (host, port, sorted options) --> [connection, number of adapters]
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def _acquire_connection(key):
+    """
+    Returns a shared `pymongo.Connection` for given registry key, creating it
+    if needed, and increments its reference counter.
+    """
+    with _connections_lock:
+        if key not in _connections:
+            host, port, options = key
+            connection = pymongo.Connection(host, port, **dict(options))
+            _connections[key] = [connection, 0]
+        _connections[key][1] += 1
+        return _connections[key][0]
+
+
+def _release_connection(key):
+    """
+    Decrements the reference counter of the shared connection for given
+    registry key and closes the connection when it is no longer used.
+    """
+    with _connections_lock:
+        connection, users = _connections[key]
+        if users <= 1:
+            del _connections[key]
+            connection.disconnect()
+        else:
+            _connections[key][1] = users - 1
+
+
+def _get_plan_stages(plan):
+    "Returns a flat list of stages of given MongoDB query plan."
+    stages = [plan]
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            stages.extend(_get_plan_stages(child))
+    return stages
+
+
 class StorageAdapter(BaseStorageAdapter):
     """
     :param host:
     :param port:
     :param database:
     :param collection:
+    :param pool_size:
+        maximum number of sockets kept open by the connection. Note that
+        adapters connected to the same server with the same `pool_size` and
+        `connection_options` share a single connection (and its pool).
+    :param connection_options:
+        a dictionary of extra keyword arguments for `pymongo.Connection`
+        (e.g. `network_timeout`).
     """
     supports_nested_data = True
+    is_thread_safe = True
 
     converter_manager = converter_manager
     lookup_manager = lookup_manager
@@ -94,6 +154,16 @@ class StorageAdapter(BaseStorageAdapter):
             primary_key = self._object_id_to_string(key)
         return super(StorageAdapter, self)._decorate(model, primary_key, data)
 
+    def _get_existing_indexes(self):
+        "Returns a list of key specifications of existing indexes."
+        indexes = []
+        for info in self.connection.index_information().itervalues():
+            # pymongo >= 1.7 wraps the key in a dictionary
+            if isinstance(info, dict):
+                info = info['key']
+            indexes.append([tuple(x) for x in info])
+        return indexes
+
     def _object_id_to_string(self, pk):
         if isinstance(pk, pymongo.objectid.ObjectId):
             return u'x-objectid-{0}'.format(pk)
@@ -121,14 +191,26 @@ class StorageAdapter(BaseStorageAdapter):
         Clears the whole storage from data.
         """
         self.connection.remove()
+        self._bump_generation()
 
     def connect(self):
+        """
+        Acquires the shared connection. Does nothing if the adapter is
+        already connected, so the connection is never counted twice.
+        """
+        if self.connection is not None:
+            return
+
         host = self._connection_options.get('host', '127.0.0.1')
         port = self._connection_options.get('port', 27017)
         database_name = self._connection_options.get('database', 'default')
         collection_name = self._connection_options.get('collection', 'default')
+        options = dict(self._connection_options.get('connection_options', {}))
+        if self._connection_options.get('pool_size'):
+            options['pool_size'] = self._connection_options['pool_size']
 
-        self._mongo_connection = pymongo.Connection(host, port)
+        self._registry_key = (host, port, tuple(sorted(options.items())))
+        self._mongo_connection = _acquire_connection(self._registry_key)
         self._mongo_database = self._mongo_connection[database_name]
         self._mongo_collection = self._mongo_database[collection_name]
         self.connection = self._mongo_collection
@@ -139,14 +221,85 @@ class StorageAdapter(BaseStorageAdapter):
         """
         primary_key = self._string_to_object_id(primary_key)
         self.connection.remove({'_id': primary_key})
+        self._bump_generation()
 
     def disconnect(self):
-        self._mongo_connection.disconnect()
+        """
+        Releases the shared connection. The connection is actually closed
+        when no other storage adapter uses it. Does nothing if the adapter is
+        not connected.
+        """
+        if self.connection is None:
+            return
+        _release_connection(self._registry_key)
+        self._registry_key = None
         self._mongo_connection = None
         self._mongo_database = None
         self._mongo_collection = None
         self.connection = None
 
+    def ensure_indexes(self, doc_class, order_by=None, dry_run=False):
+        """
+        Creates indexes that are needed for typical queries on given document
+        class unless they already exist. Returns a dictionary of names and key
+        specifications of the indexes that have been created.
+
+        :param doc_class:
+            the :class:`~doqu.document_base.Document` subclass. The indexes are
+            derived from its metadata:
+
+            * fields that are used by :meth:`Document.objects` to filter the
+              records (see `filter_query` of validators like
+              :class:`~doqu.validators.Required`) make up a compound index;
+            * each field mentioned in `indexes` gets its own index (index types
+              are ignored: all indexes are ascending, lists are indexed by
+              items).
+
+        :param order_by:
+            a list of field names by which the documents are often sorted.
+            A compound index is created for each of them: the filter fields
+            followed by the sorting field (either direction can use it).
+        :param dry_run:
+            if `True`, the indexes are not created; the result shows what
+            would be done.
+
+        An index is considered existing if some existing index starts with the
+        same keys. Usage::
+
+            >>> db.ensure_indexes(Person, order_by=['age'], dry_run=True)
+            {'name_1_age_1': [('name', 1), ('age', 1)]}
+
+        """
+        filter_fields = sorted(name for name, validators
+                               in doc_class.meta.validators.iteritems()
+                               if any(hasattr(v, 'filter_query')
+                                      for v in validators))
+        asc = lambda names: [(name, pymongo.ASCENDING) for name in names]
+
+        # longer specs go first so that their prefixes are not created
+        specs = []
+        for name in order_by or []:
+            specs.append(asc([x for x in filter_fields if x != name] + [name]))
+        if filter_fields:
+            specs.append(asc(filter_fields))
+        for name in sorted(self._get_declared_indexes(doc_class)):
+            specs.append(asc([name]))
+
+        existing = self._get_existing_indexes()
+        created = {}
+        for spec in specs:
+            if any(index[:len(spec)] == spec for index in existing):
+                continue
+            name = '_'.join('{0}_{1}'.format(*key) for key in spec)
+            if dry_run:
+                log.info('would create index {0}'.format(name))
+            else:
+                log.info('creating index {0}'.format(name))
+                self.connection.create_index(spec, name=name)
+            created[name] = spec
+            existing.append(spec)
+        return created
+
     def get(self, model, primary_key):
         """
         Returns model instance for given model and primary key.
@@ -200,73 +353,140 @@ class StorageAdapter(BaseStorageAdapter):
             outgoing.update({'_id': self._string_to_object_id(primary_key)})
 #        print outgoing
         obj_id = self.connection.save(outgoing)
+        self._bump_generation()
         return self._object_id_to_string(obj_id) or primary_key
 #        return unicode(self.connection.save(outgoing) or primary_key)
 
     def get_query(self, model):
         return QueryAdapter(storage=self, model=model)
 
+    def update(self, primary_key, data):
+        """
+        Updates given fields of an existing record and leaves other fields
+        intact (uses the ``$set`` modifier). Returns primary key.
+
+        :param primary_key:
+            the key of the record to be updated.
+        :param data:
+            dict containing the properties to be changed.
+        """
+        obj_id = self._string_to_object_id(primary_key)
+        self.connection.update({'_id': obj_id}, {'$set': data})
+        self._bump_generation()
+        return primary_key
+
 
 class QueryAdapter(CachedIterator, BaseQueryAdapter):
+    """
+    The Query class. Supports set operations that are translated to a single
+    MongoDB query::
 
+        q1 & q2    # records that match both queries (same as chained where())
+        q1 | q2    # records that match any of the queries (``$or``)
+        q1 - q2    # records that match q1 but not q2 (``$nor``)
+
+    The resulting query inherits the ordering of the left operand.
+
+    .. note::
+
+        ``$or`` and ``$nor`` require MongoDB 1.6; intersection of two unions
+        requires ``$and`` (MongoDB 2.0).
+
+    """
     #--------------------+
     #  Magic attributes  |
     #--------------------+
 
-    # ...
+    def __and__(self, other):
+        assert isinstance(other, self.__class__)
+        return self._clone(extra_conditions=other._conditions)
+
+    def __or__(self, other):
+        assert isinstance(other, self.__class__)
+        conditions = [{'$or': [self._get_spec(), other._get_spec()]}]
+        return self.__class__(self.storage, self.model,
+                              conditions=conditions, ordering=self._ordering,
+                              batch_size=self._batch_size)
+
+    def __sub__(self, other):
+        assert isinstance(other, self.__class__)
+        return self._clone(extra_conditions=[{'$nor': [other._get_spec()]}])
 
     #----------------------+
     #  Private attributes  |
     #----------------------+
 
     def _do_search(self, **kwargs):
-        # TODO: slicing? MongoDB supports it since 1.5.1
-        # http://www.mongodb.org/display/DOCS/Advanced+Queries#AdvancedQueries-%24sliceoperator
-        spec = self.storage.lookup_manager.combine_conditions(self._conditions)
+        cursor = self._get_cursor(**kwargs)
+        return iter(cursor) if cursor is not None else []
+
+    def _fetch_range(self, start, stop):
+        # slices and indices are translated to `skip` and `limit` on the
+        # cursor so that only the requested documents are transferred
+        limit = 0 if stop is None else stop - start    # 0 means no limit
+        cursor = self._get_cursor(skip=start, limit=limit)
+        return list(cursor) if cursor is not None else []
+
+    def _get_cursor(self, **kwargs):
+        """
+        Returns a MongoDB cursor for current query. The keyword arguments are
+        passed to `find()` as is (e.g. `skip`, `limit` or `fields`). The
+        query is not sent to the server until the cursor is iterated or
+        counted.
+        """
+        spec = self._get_spec()
         if self._ordering:
             kwargs.setdefault('sort',  self._ordering)
         cursor = self.storage.connection.find(spec, **kwargs)
-        self._cursor = cursor  # used in count()    XXX that's a mess
-        return iter(cursor) if cursor is not None else []
+        if cursor is not None and self._batch_size:
+            cursor = cursor.batch_size(self._batch_size)
+        return cursor
 
-    def _init(self, storage, model, conditions=None, ordering=None):
+    def _get_spec(self):
+        "Returns the MongoDB query document for current conditions."
+        return self.storage.lookup_manager.combine_conditions(self._conditions)
+
+    def _init(self, storage, model, conditions=None, ordering=None,
+              batch_size=None):
         self.storage = storage
         self.model = model
         self._conditions = conditions or []
         self._ordering = ordering
-        #self._query = self.storage.connection.find()
-        self._iter = self._do_search()
-
-    # XXX can this be inherited?
-#    def _clone(self, inner_query=None):
-#        clone = self.__class__(self.storage, self.model)
-#        clone._query = self._query.clone() if inner_query is None else inner_query
-#        return clone
-
-    def _clone(self, extra_conditions=None, extra_ordering=None):
+        self._batch_size = batch_size
+        if batch_size:
+            # fetch from the cursor as much as the server sends at once
+            self._chunk_size = batch_size
+        self._executed = False
+
+    def _clone(self, extra_conditions=None, extra_ordering=None,
+               batch_size=None):
         return self.__class__(
             self.storage,
             self.model,
             conditions = self._conditions + (extra_conditions or []),
             ordering = extra_ordering or self._ordering,
+            batch_size = batch_size or self._batch_size,
         )
 
+    def _get_raw_iterator(self):
+        return self._do_search()
+
+    def _get_raw_records(self, names=None):
+        # the primary key is taken from the data by StorageAdapter._decorate
+        if names:
+            # only transfer the requested fields
+            records = self._do_search(fields=list(names))
+        else:
+            records = self._get_raw_iterator()
+        return ((None, data) for data in records)
+
     def _prepare(self):
-        # XXX this seems to be [a bit] wrong; check the CachedIterator workflow
-        # (hint: if this meth is empty, query breaks on empty result set
-        # because self._iter appears to be None in that case)
-        # (Note: same crap in in doqu.ext.shelve_db.QueryAdapter.)
-
-        # also note that we have to ensure that _cache is not empty because
-        # otherwise it would be filled over and over again (and not even
-        # refilled but appended to).
-        # _iter can be None in two cases: a) initial state, and b) the iterable
-        # is exhausted, cache filled.
-        # but what if the iterable is just empty? _iter=None, _cache=[] and we
-        # start over and over.
-        # this must be fixed.
-        if self._iter is None and not self._cache:   # XXX important for all backends!
-            self._iter = self._do_search()
+        # _iter is None in two cases: a) initial state, and b) the iterable is
+        # exhausted (even if the result set is empty). The flag tells them
+        # apart so that the search is only run once.
+        if not self._executed:
+            self._iter = self._get_raw_iterator()
+            self._executed = True
 
     def _prepare_item(self, raw_data):
         return self.storage._decorate(self.model, None, raw_data)
@@ -279,8 +499,20 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
     #  Public API  |
     #--------------+
 
+    def batch_size(self, size):
+        """
+        Returns a query object with same conditions but with results fetched
+        from the server in batches of given size. Larger batches mean fewer
+        round trips, smaller ones mean less memory per batch.
+        """
+        return self._clone(batch_size=size)
+
+    @observed
     def count(self):
-        return self._cursor.count()
+        """
+        Returns the number of matching records. Does not fetch the records.
+        """
+        return self._get_cursor().count()
 
     def where(self, **conditions):
         """
@@ -314,6 +546,55 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
 #    def count(self):
 #        return self._query.count()
 
+    def explain(self):
+        """
+        Returns the query plan (see
+        :meth:`~doqu.backend_base.BaseQueryAdapter.explain`) based on the
+        output of MongoDB's `explain` (in both the legacy format and the
+        query planner format of MongoDB 3.0+). Ordering and limits are
+        always applied by the server, although the sorting may be done in
+        memory if no index supports it (see `native`).
+        """
+        cursor = self._get_cursor()
+        native = cursor.explain() if cursor is not None else {}
+        if 'queryPlanner' in native:
+            stages = _get_plan_stages(native['queryPlanner'].get('winningPlan',
+                                                                 {}))
+            names = [x.get('indexName') for x in stages
+                     if x.get('stage') == 'IXSCAN']
+            index = names[0] if names else None
+            full_scan = any(x.get('stage') == 'COLLSCAN' for x in stages)
+            stats = native.get('executionStats', {})
+            scanned = stats.get('totalDocsExamined')
+        else:
+            # e.g. "BtreeCursor name_1" or "BasicCursor"
+            cursor_name = native.get('cursor', '')
+            index = None
+            if cursor_name.startswith('BtreeCursor '):
+                index = cursor_name.split(' ', 1)[1]
+            full_scan = cursor_name.startswith('BasicCursor')
+            scanned = native.get('nscannedObjects', native.get('nscanned'))
+        return self._make_plan(
+            conditions = self._get_spec(),
+            index = index,
+            full_scan = full_scan if native else None,
+            estimated_scan = scanned,
+            order_pushed_down = True if self._ordering else None,
+            limit_pushed_down = True,
+            native = native,
+        )
+
+    def increment(self, name, by=1):
+        """
+        Increments given numeric field by given number in all records that
+        match current query (uses the ``$inc`` modifier). Raises KeyError if
+        the field is not declared in the document structure.
+        """
+        self._check_field_name(name)
+        spec = self._get_spec()
+        self.storage.connection.update(spec, {'$inc': {name: by}}, multi=True)
+        self.storage._bump_generation()
+
     def order_by(self, names, reverse=False):
         # TODO: MongoDB supports per-key directions. Support them somehow?
         direction = pymongo.DESCENDING if reverse else pymongo.ASCENDING
@@ -322,6 +603,17 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
         ordering = [(name, direction) for name in names]
         return self._clone(extra_ordering=ordering)
 
+    def update(self, **fields):
+        """
+        Sets given fields to given values in all records that match current
+        query (uses the ``$set`` modifier).
+        """
+        spec = self._get_spec()
+        native = self._get_native_values(fields)
+        self.storage.connection.update(spec, {'$set': native}, multi=True)
+        self.storage._bump_generation()
+
+    @observed
     def values(self, name):
         """
         Returns distinct values for given field.
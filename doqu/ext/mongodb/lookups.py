@@ -51,7 +51,17 @@ class MongoLookupManager(LookupManager):
         spec = {}
         for condition in conditions:
             for name, clause in condition.iteritems():
-                if isinstance(clause, dict):
+                if name == '$nor':
+                    # "neither A nor B" and "neither C" = "neither A, B nor C"
+                    spec.setdefault(name, []).extend(clause)
+                elif name.startswith('$'):
+                    # an operator that combines queries (see set operations
+                    # in QueryAdapter); two of them must be nested to be ANDed
+                    if name in spec:
+                        spec.setdefault('$and', []).append({name: clause})
+                    else:
+                        spec[name] = clause
+                elif isinstance(clause, dict):
                     spec.setdefault(name, {}).update(clause)
                 else:
                     # exact or regex. Specifying multiple conditions against
@@ -51,23 +51,40 @@ This extension wraps the standard Python library and provides
 """
 
 import atexit
+from itertools import islice
 import shelve
 import uuid
 
 from doqu.backend_base import BaseStorageAdapter, BaseQueryAdapter
 from doqu.utils.data_structures import CachedIterator, LazySorted
+from doqu.utils.instrumentation import observed
 
 from converters import converter_manager
 from lookups import lookup_manager
+import vectorized
 
 
 __all__ = ['StorageAdapter']
 
 
+# number of records checked at once by the vectorized engine
+DEFAULT_BATCH_SIZE = 10000
+
+# connection options that only affect queries
+QUERY_OPTIONS = ('vectorized', 'batch_size')
+
+
 class StorageAdapter(BaseStorageAdapter):
     """
     :param path:
         relative or absolute path to the database file (e.g. `test.db`)
+    :param vectorized:
+        if `True`, the query conditions are evaluated over batches of records
+        using NumPy instead of calling a function for each record. This is
+        much faster for numeric and string comparisons. Requires NumPy.
+    :param batch_size:
+        number of records checked at once in the vectorized mode. Default is
+        10000.
 
     """
 
@@ -102,6 +119,7 @@ class StorageAdapter(BaseStorageAdapter):
         Clears the whole storage from data.
         """
         self.connection.clear()
+        self._bump_generation()
 
     def connect(self):
         """
@@ -136,6 +154,7 @@ class StorageAdapter(BaseStorageAdapter):
         Permanently deletes the record with given primary key from the database.
         """
         del self.connection[primary_key]
+        self._bump_generation()
 
     def get(self, model, primary_key):
         """
@@ -170,15 +189,54 @@ class StorageAdapter(BaseStorageAdapter):
         if sync:
             self.connection.sync()
 
+        self._bump_generation()
         return primary_key
 
     def get_query(self, model):
         return QueryAdapter(storage=self, model=model)
 
+    def update(self, primary_key, data, sync=False):
+        """
+        Updates given fields of an existing record and leaves other fields
+        intact. Returns primary key.
+
+        :param primary_key:
+            the key of the record to be updated.
+        :param data:
+            dict containing the properties to be changed.
+        :param sync:
+            see :meth:`StorageAdapter.save`.
+
+        .. note::
+
+            shelve stores each record as a single pickled value so the record
+            is still unpickled and written back as a whole; however, the
+            document fields are neither converted nor validated again.
+
+        """
+        primary_key = str(primary_key)
+        record = self.connection[primary_key]
+        record.update(data)
+        self.connection[primary_key] = record
+
+        if sync:
+            self.connection.sync()
+
+        self._bump_generation()
+        return primary_key
+
 
 class QueryAdapter(CachedIterator, BaseQueryAdapter):
     """
-    The Query class.
+    The Query class. Supports set operations::
+
+        q1 & q2    # records that match both queries (same as chained where())
+        q1 | q2    # records that match any of the queries
+        q1 - q2    # records that match q1 but not q2
+
+    The conditions of both queries are combined, so the resulting query still
+    iterates the records only once. It inherits the ordering of the left
+    operand.
     """
     #--------------------+
     #  Magic attributes  |
@@ -186,10 +244,35 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
 
     # (see CachedIterator)
 
+    def __and__(self, other):
+        assert isinstance(other, self.__class__)
+        return self._clone(extra_conditions=other._conditions,
+                           extra_signature=[('&', other._signature)])
+
+    def __or__(self, other):
+        assert isinstance(other, self.__class__)
+        def union(data):
+            return self._check(data) or other._check(data)
+        return self.__class__(self.storage, self.model, conditions=[union],
+                              ordering=self._ordering,
+                              signature=[('|', self._signature,
+                                          other._signature)])
+
+    def __sub__(self, other):
+        assert isinstance(other, self.__class__)
+        def difference(data):
+            return not other._check(data)
+        return self._clone(extra_conditions=[difference],
+                           extra_signature=[('-', other._signature)])
+
     #----------------------+
     #  Private attributes  |
     #----------------------+
 
+    def _check(self, data):
+        "Returns `True` if given record conforms to collected conditions."
+        return all(check(data) for check in self._conditions)
+
     def _do_search(self):
         """
         Iterates the full set of records, applies collected conditions to each
@@ -198,12 +281,29 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
         :meth:`where` and :meth:`where_not`.
         """
         assert hasattr(self._conditions, '__iter__')
+        options = self.storage._connection_options
         def finder():
             for pk in self.storage.connection:
                 data = self.storage.connection[pk]
                 # call check functions; if none fails, yield the key
-                if all(check(data) for check in self._conditions):
+                if self._check(data):
                     yield pk
+        def vectorized_finder():
+            connection = self.storage.connection
+            batch_size = options.get('batch_size', DEFAULT_BATCH_SIZE)
+            keys = iter(connection)
+            while True:
+                batch = list(islice(keys, batch_size))
+                if not batch:
+                    break
+                records = [connection[pk] for pk in batch]
+                mask = vectorized.check_batch(self._conditions, records)
+                for i in mask.nonzero()[0]:
+                    yield batch[i]
+        if options.get('vectorized') and self._conditions:
+            if vectorized.numpy is None:
+                raise ImportError('NumPy is not installed.')
+            finder = vectorized_finder
         if self._ordering:
             def make_sort_key(pk):
                 data = self.storage.connection[pk]
@@ -219,25 +319,59 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
             ))
         return finder()
 
-    def _init(self, storage, model, conditions=None, ordering=None):
+    def _get_cache_key(self):
+        # the conditions are functions, so we use their description
+        return repr((self._signature, sorted(self._ordering.items())))
+
+    def _get_keys(self):
+        "Returns the (possibly cached) list of keys of matching records."
+        return self._get_cached('keys', lambda: list(self._do_search()))
+
+    def _init(self, storage, model, conditions=None, ordering=None,
+              signature=None):
         self.storage = storage
         self.model = model
         self._conditions = conditions or []
         self._ordering = ordering or {}
-        # this is safe because the adapter is instantiated already with final
-        # conditions; if a condition is added, that's another adapter
-        self._iter = self._do_search()
+        # backend-agnostic description of the conditions (for query cache)
+        self._signature = signature or []
+        self._executed = False
+
+    def _get_raw_iterator(self):
+        if self.storage._query_cache is None:
+            return self._do_search()
+        return iter(self._get_keys())
+
+    def _get_raw_records(self, names=None):
+        connection = self.storage.connection
+        return ((pk, connection[pk]) for pk in self._get_raw_iterator())
 
     def _prepare(self):
-        # XXX this seems to be [a bit] wrong; check the CachedIterator workflow
-        # (hint: if this meth is empty, query breaks on empty result set
-        # because self._iter appears to be None in that case)
-        if self._iter is None:
-            self._iter = self._do_search()
+        # this is safe because the adapter is instantiated already with final
+        # conditions; if a condition is added, that's another adapter
+        if not self._executed:
+            self._iter = self._get_raw_iterator()
+            self._executed = True
 
     def _prepare_item(self, key):
         return self.storage.get(self.model, key)
 
+    def _rewrite(self, modify):
+        """
+        Iterates the full set of records, applies given function to each
+        record that conforms to collected conditions and writes the record
+        back. The function must modify the record in place.
+        """
+        connection = self.storage.connection
+        # keys are collected in advance because some dbm flavours do not
+        # like the database being modified while it's being iterated
+        for pk in list(connection):
+            data = connection[pk]
+            if self._check(data):
+                modify(data)
+                connection[pk] = data
+        self.storage._bump_generation()
+
     def _where(self, lookups, negate=False):
         """
         Returns Query instance filtered by given conditions.
@@ -245,14 +379,18 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
         See pyrant.query.Query.filter documentation for details.
         """
         conditions = list(self._get_native_conditions(lookups, negate))
-        return self._clone(extra_conditions=conditions)
+        signature = [(negate, sorted(lookups.items()))]
+        return self._clone(extra_conditions=conditions,
+                           extra_signature=signature)
 
-    def _clone(self, extra_conditions=None, extra_ordering=None):
+    def _clone(self, extra_conditions=None, extra_ordering=None,
+               extra_signature=None):
         return self.__class__(
             self.storage,
             self.model,
             conditions = self._conditions + (extra_conditions or []),
             ordering = extra_ordering or self._ordering,
+            signature = self._signature + (extra_signature or []),
         )
 
     #--------------+
@@ -274,13 +412,19 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
         """
         return self._where(conditions, negate=True)
 
+    @observed
     def count(self):
         """
         Same as ``__len__`` but a bit faster.
         """
+        if self._executed and self._iter is None and \
+           not (self._cache_size or self._offset):
+            # all results are already cached (and the cache is not trimmed)
+            return len(self._cache)
         # len(self) would fetch all data, not just keys
-        return len(list(self._do_search()))
+        return len(self._get_keys())
 
+    @observed
     def values(self, name):
         """
         Returns an iterator that yields distinct values for given column name.
@@ -336,6 +480,38 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
         for pk in self._do_search():
             self.storage.delete(pk)
 
+    def explain(self):
+        """
+        Returns the query plan (see
+        :meth:`~doqu.backend_base.BaseQueryAdapter.explain`). There are no
+        indexes, so all records are scanned unless the keys of matching
+        records are in the query cache. Ordering and slicing are done on
+        client side.
+        """
+        cached = self._is_cached('keys')
+        options = self.storage._connection_options
+        return self._make_plan(
+            conditions = [getattr(c, 'lookup', c) for c in self._conditions],
+            full_scan = not cached,
+            estimated_scan = 0 if cached else len(self.storage),
+            order_pushed_down = False if self._ordering else None,
+            limit_pushed_down = False,
+            native = {
+                'cached': cached,
+                'vectorized': bool(options.get('vectorized')),
+                'batch_size': options.get('batch_size', DEFAULT_BATCH_SIZE),
+            },
+        )
+
+    def increment(self, name, by=1):
+        """
+        Increments given numeric field by given number in all records that
+        match current query. Iterates the whole set of records once.
+        """
+        def modify(data):
+            data[name] = self._get_incremented_value(name, data.get(name), by)
+        self._rewrite(modify)
+
     def order_by(self, names, reverse=False):
         """
         Defines order in which results should be retrieved.
@@ -375,3 +551,11 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
         #print 'new sort spec:', sort_spec
 
         return self._clone(extra_ordering=sort_spec)
+
+    def update(self, **fields):
+        """
+        Sets given fields to given values in all records that match current
+        query. Iterates the whole set of records once.
+        """
+        native = self._get_native_values(fields)
+        self._rewrite(lambda data: data.update(native))
@@ -56,7 +56,7 @@ mapping = {
     'day':          lambda a,b: b and b.day == a,
 
 }
-def autonegated_processor(processor):
+def autonegated_processor(processor, operation=None):
     "decorator for processors; handles negation"
     @wraps(processor)
     def inner(name, value, data_processor, negated):
@@ -67,11 +67,13 @@ def autonegated_processor(processor):
             else:
                 matches = False
             return not matches if negated else matches
+        # the description is used by the vectorized engine (see vectorized.py)
+        condition.lookup = operation, name, value, negated
         return condition
     return inner
 
 for operation, processor in mapping.items():
     is_default = operation == DEFAULT_OPERATION
-    processor = autonegated_processor(processor)
+    processor = autonegated_processor(processor, operation)
     lookup_manager.register(operation, default=is_default)(processor)
 
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+#    Doqu is a lightweight schema/query framework for document databases.
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of Docu.
+#
+#    Doqu is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Doqu is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with Docu.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Vectorized evaluation of query conditions over batches of records. The values
+of a field are projected into a NumPy array and the condition is evaluated as
+a single mask operation instead of calling a function for each record.
+
+Only numeric and string fields are vectorized, and only for some lookups
+(see `OPERATIONS`). Other conditions, or batches with values of other types,
+are evaluated record by record as usual, so the results are always the same.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+__all__ = ['check_batch']
+
+
+# lookup --> function(column, value) that returns a boolean mask
+OPERATIONS = {
+    'between':    lambda c,v: (v[0] <= c) & (c <= v[1]),
+    'equals':     lambda c,v: c == v,
+    'gt':         lambda c,v: c > v,
+    'gte':        lambda c,v: c >= v,
+    'in':         lambda c,v: numpy.in1d(c, list(v)),
+    'lt':         lambda c,v: c < v,
+    'lte':        lambda c,v: c <= v,
+    # an empty string does not match (same as the row-wise lookup)
+    'startswith': lambda c,v: (numpy.char.startswith(c, v) &
+                               (numpy.char.str_len(c) > 0)),
+}
+
+NONE_TYPE = type(None)
+NUMBER_TYPES = frozenset([bool, int, long, float])
+
+
+def _get_operands(operation, value):
+    "Returns the list of scalar values the column is compared with."
+    if operation in ('between', 'in'):
+        return list(value)
+    return [value]
+
+
+def _make_column(values, operands):
+    """
+    Returns a typed NumPy array of given values and a mask of values that are
+    not `None`. Returns `None` if the values and the operands they are
+    compared with are not all numbers or all strings of the same type.
+    """
+    types = set(map(type, values)) | set(map(type, operands))
+    types.discard(NONE_TYPE)
+    if types <= NUMBER_TYPES:
+        dtype = float if float in types else 'int64'
+        placeholder = 0
+    elif types in (set([unicode]), set([str])):
+        dtype = types.pop()
+        placeholder = dtype()
+    else:
+        return None
+    raw = numpy.empty(len(values), dtype=object)
+    raw[:] = values
+    valid = numpy.not_equal(raw, None)
+    raw[~valid] = placeholder
+    try:
+        column = raw.astype(dtype)
+    except OverflowError:
+        # numbers that do not fit in int64
+        return None
+    return column, valid
+
+
+def _evaluate(condition, records):
+    """
+    Returns a boolean mask for given condition evaluated over given records,
+    or `None` if the condition cannot be vectorized for these records.
+    """
+    lookup = getattr(condition, 'lookup', None)
+    if lookup is None:
+        # e.g. a union of queries
+        return None
+    operation, name, value, negated = lookup
+    operation = operation or 'equals'
+
+    if operation == 'exists':
+        matches = numpy.array([name in data for data in records], dtype=bool)
+    else:
+        if operation not in OPERATIONS:
+            return None
+        if operation == 'startswith' and not isinstance(value, basestring):
+            return None
+        operands = _get_operands(operation, value)
+        if None in operands:
+            return None
+        # a missing field and a `None` value never match these lookups
+        values = [data.get(name) for data in records]
+        result = _make_column(values, operands)
+        if result is None:
+            return None
+        column, valid = result
+        if operation == 'startswith' and column.dtype.kind not in 'SU':
+            return None
+        matches = valid & OPERATIONS[operation](column, value)
+    return ~matches if negated else matches
+
+
+def check_batch(conditions, records):
+    """
+    Returns a boolean NumPy array: `True` for each record (a dictionary) that
+    conforms to all given conditions.
+    """
+    mask = numpy.ones(len(records), dtype=bool)
+    for condition in conditions:
+        result = _evaluate(condition, records)
+        if result is None:
+            # fall back to row-wise evaluation (only for remaining records)
+            for i in mask.nonzero()[0]:
+                if not condition(records[i]):
+                    mask[i] = False
+        else:
+            mask &= result
+        if not mask.any():
+            break
+    return mask
@@ -83,6 +83,9 @@ class StorageAdapter(shelve_db.StorageAdapter):
     The URI format for a backend is documented in its module (see the `shove`_
     documentation). The URI form is the same as `SQLAlchemy's`_.
 
+    The query options `vectorized` and `batch_size` are the same as in
+    :class:`doqu.ext.shelve_db.StorageAdapter`.
+
     .. _SQLAlchemy's: http://www.sqlalchemy.org/docs/04/dbengine.html#dbengine_establishing
 
     """
@@ -104,7 +107,10 @@ class StorageAdapter(shelve_db.StorageAdapter):
         if self.connection is not None:
             raise RuntimeError('already connected')
 
-        self.connection = Shove(**self._connection_options)
+        options = dict(self._connection_options)
+        for name in shelve_db.QUERY_OPTIONS:
+            options.pop(name, None)
+        self.connection = Shove(**options)
 
     #--------------+
     #  Public API  |
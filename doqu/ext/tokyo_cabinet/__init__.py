@@ -47,10 +47,6 @@ concurrent access is required. Please use Tokyo Tyrant for such environments.
 
     this module should not depend on Pyrant; just needs some refactoring.
 
-.. note::
-
-    support for metasearch is planned.
-
 Usage::
 
     >>> import os
@@ -86,12 +82,15 @@ Usage::
 from doqu import dist
 dist.check_dependencies(__name__)
 
+from contextlib import contextmanager
 from decimal import Decimal    # for order_by introspection
+from itertools import islice
 
 import tokyo.cabinet as tc
 
 from doqu.backend_base import BaseStorageAdapter, BaseQueryAdapter
 from doqu.utils.data_structures import CachedIterator
+from doqu.utils.instrumentation import observed
 
 from converters import converter_manager
 from lookups import lookup_manager
@@ -108,10 +107,28 @@ except ImportError:  # pragma: nocover
 __all__ = ['StorageAdapter']
 
 
+# number of records saved by save_many() within a single transaction
+DEFAULT_BATCH_SIZE = 1000
+
+# Doqu index type --> Tokyo Cabinet index type
+INDEX_TYPES = {
+    'lexical': tc.TDBITLEXICAL,
+    'decimal': tc.TDBITDECIMAL,
+    'token':   tc.TDBITTOKEN,
+    'q-gram':  tc.TDBITQGRAM,
+}
+
+# Tokyo Cabinet error code meaning "existing record" (e.g. existing index)
+ERROR_KEEP = getattr(tc, 'TCEKEEP', 21)
+
+
 class StorageAdapter(BaseStorageAdapter):
     """
     :param path:
         relative or absolute path to the database file (e.g. `test.tct`)
+    :param batch_size:
+        number of records written by :meth:`~StorageAdapter.save_many` within
+        a single transaction (default is 1000).
 
     .. note::
 
@@ -138,6 +155,35 @@ class StorageAdapter(BaseStorageAdapter):
     def __len__(self):
         return len(self.connection)
 
+    #----------------------+
+    #  Private attributes  |
+    #----------------------+
+
+    _transaction_depth = 0
+
+    def _create_index(self, name, index_type):
+        try:
+            self.connection.setindex(name, INDEX_TYPES[index_type] |
+                                           tc.TDBITKEEP)
+        except tc.Error as e:
+            # tokyo-python passes (error code, message) as arguments
+            if e.args and e.args[0] == ERROR_KEEP:
+                # the index already exists
+                return False
+            raise
+        return True
+
+    def _sanitize_data(self, data):
+        # sanitize data for Tokyo Cabinet:
+        # None-->'None' is wrong, force None-->''
+        for key in data:
+            if data[key] is None:
+                data[key] = ''
+            try:
+                data[key] = str(data[key])
+            except UnicodeEncodeError:
+                data[key] = unicode(data[key]).encode('UTF-8')
+
     #--------------+
     #  Public API  |
     #--------------+
@@ -147,6 +193,7 @@ class StorageAdapter(BaseStorageAdapter):
         Clears the whole storage from data, resets autoincrement counters.
         """
         self.connection.clear()
+        self._bump_generation()
 
     def connect(self):
         """
@@ -166,6 +213,7 @@ class StorageAdapter(BaseStorageAdapter):
         Permanently deletes the record with given primary key from the database.
         """
         del self.connection[primary_key]
+        self._bump_generation()
 
     def disconnect(self):
         """
@@ -194,29 +242,111 @@ class StorageAdapter(BaseStorageAdapter):
         which is already in the database in order to update it instead of
         copying it.
         """
-        # sanitize data for Tokyo Cabinet:
-        # None-->'None' is wrong, force None-->''
-        for key in data:
-            if data[key] is None:
-                data[key] = ''
-            try:
-                data[key] = str(data[key])
-            except UnicodeEncodeError:
-                data[key] = unicode(data[key]).encode('UTF-8')
+        self._sanitize_data(data)
 
         primary_key = primary_key or unicode(self.connection.uid())
 
         self.connection[primary_key] = data
 
+        self._bump_generation()
         return primary_key
 
     def get_query(self, model):
         return QueryAdapter(storage=self, model=model)
 
+    def save_many(self, items):
+        """
+        Saves given records into the storage. Returns a list of primary keys.
+        The records are written in batches, each within a transaction (see
+        :meth:`StorageAdapter.transaction`), which is much faster than saving
+        them one by one. The batch size can be set with the `batch_size`
+        connection option. If called within a transaction, all records are
+        saved within it.
+
+        :param items:
+            an iterable of `(primary_key, data)` pairs where `data` is a dict
+            containing all properties to be saved and `primary_key` may be
+            `None` (then it will be generated).
+        """
+        if self._transaction_depth:
+            return [self.save(data=data, primary_key=primary_key)
+                    for primary_key, data in items]
+
+        batch_size = self._connection_options.get('batch_size',
+                                                  DEFAULT_BATCH_SIZE)
+        keys = []
+        items = iter(items)
+        while True:
+            # a transaction is only started if there are records left
+            batch = list(islice(items, batch_size))
+            if not batch:
+                return keys
+            with self.transaction():
+                for primary_key, data in batch:
+                    keys.append(self.save(data=data, primary_key=primary_key))
+
+    @contextmanager
+    def transaction(self):
+        """
+        Returns a context manager. All changes made within the block are
+        committed when the block is left or discarded if an exception is
+        raised. Usage::
+
+            with db.transaction():
+                for note in notes:
+                    note.save(db)
+
+        Besides atomicity this gives a considerable speed-up for bulk writes.
+        Nested blocks are merged into the outermost one.
+        """
+        if self._transaction_depth:
+            self._transaction_depth += 1
+            try:
+                yield
+            finally:
+                self._transaction_depth -= 1
+            return
+
+        self.connection.tranbegin()
+        self._transaction_depth = 1
+        try:
+            yield
+        except:
+            self._transaction_depth = 0
+            self.connection.tranabort()
+            raise
+        self._transaction_depth = 0
+        self.connection.trancommit()
+
+    def update(self, primary_key, data):
+        """
+        Updates given columns of an existing record and leaves other columns
+        intact (the "put-cat" mode of Tokyo Cabinet table database). Returns
+        primary key.
+
+        :param primary_key:
+            the key of the record to be updated.
+        :param data:
+            dict containing the properties to be changed.
+        """
+        data = dict(data)
+        self._sanitize_data(data)
+        self.connection.putcat(primary_key, data)
+        self._bump_generation()
+        return primary_key
+
 
 class QueryAdapter(CachedIterator, BaseQueryAdapter):
     """
-    The Query class.
+    The Query class. Supports set operations::
+
+        q1 & q2    # records that match both queries
+        q1 | q2    # records that match any of the queries
+        q1 - q2    # records that match q1 but not q2
+
+    The operations are performed by the database (metasearch) in a single
+    request. The resulting query is ordered as the left operand. Conditions
+    added to the resulting query apply to the result as a whole.
     """
     #--------------------+
     #  Magic attributes  |
@@ -224,34 +354,129 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
 
     # (see CachedIterator)
 
+    def __and__(self, other):
+        return self._combine(other, tc.TDBMSISECT)
+
+    def __or__(self, other):
+        return self._combine(other, tc.TDBMSUNION)
+
+    def __sub__(self, other):
+        return self._combine(other, tc.TDBMSDIFF)
+
     #----------------------+
     #  Private attributes  |
     #----------------------+
 
-    def _init(self, storage, model, conditions=None, ordering=None):
+    def _combine(self, other, operation):
+        """
+        Returns a query that combines this query with given one using given
+        metasearch operation.
+        """
+        assert isinstance(other, self.__class__)
+        queries = [self, other]
+        if self._combined and self._combined[0] == operation:
+            # (q1 | q2) | q3 --> union of q1, q2, q3; same for intersection;
+            # (q1 - q2) - q3 --> q1 minus union of q2 and q3 (as TC does it)
+            queries = self._combined[1] + [other]
+        return self.__class__(self.storage, self.model,
+                              combined=(operation, queries))
+
+    def _get_cache_key(self):
+        if self._combined:
+            operation, queries = self._combined
+            return operation, tuple(q._get_cache_key() for q in queries)
+        ordering = None
+        if self._ordering:
+            ordering = self._ordering.name, self._ordering.type
+        return repr((self._conditions, ordering))
+
+    def _get_keys(self):
+        """
+        Returns the list of primary keys of matching records.
+        """
+        if not self._combined:
+            return self._query.search()
+
+        operation, queries = self._combined
+        if not any(q._combined for q in queries):
+            first = queries[0]._query
+            return first.metasearch([q._query for q in queries[1:]],
+                                    operation)
+
+        # nested combinations, e.g. (q1 | q2) & q3, cannot be expressed as a
+        # single metasearch; merge the keys here preserving the order
+        key_lists = [q._get_keys() for q in queries]
+        if operation == tc.TDBMSUNION:
+            seen = set()
+            keys = []
+            for pk in (pk for pks in key_lists for pk in pks):
+                if pk not in seen:
+                    seen.add(pk)
+                    keys.append(pk)
+            return keys
+        if operation == tc.TDBMSISECT:
+            others = [set(pks) for pks in key_lists[1:]]
+            return [pk for pk in key_lists[0]
+                    if all(pk in pks for pks in others)]
+        others = set(pk for pks in key_lists[1:] for pk in pks)
+        return [pk for pk in key_lists[0] if pk not in others]
+
+    def _init(self, storage, model, conditions=None, ordering=None,
+              combined=None):
         self.storage = storage
         self.model = model
         self._conditions = conditions or []
         self._ordering = ordering
-        # TODO: make this closer to the Pyrant's internal mechanism so that
-        # metasearch can be used via storage.metasearch([q1, q2, .., qN], meth)
-        if self._iter is None:
-            self._query = self.storage.connection.query()
-            for condition in self._conditions:
-#                print 'condition:', condition
-                col, op, expr = condition  #.prepare()
-                if not isinstance(expr, basestring):
-                    expr = str(expr)
-                self._query.filter(col, op, expr)
-            if self._ordering:
-                self._query.sort(self._ordering.name,
-                                 self._ordering.type)
-                                             # TODO: make this lazy  (it fetches the keys)
-            self._iter = iter(self._query.search())
+        # (metasearch operation, list of queries) or None
+        self._combined = combined
+        # (building the query is cheap, it is not executed until needed)
+        self._query = self.storage.connection.query()
+        for condition in self._conditions:
+            col, op, expr = condition  #.prepare()
+            if not isinstance(expr, basestring):
+                expr = str(expr)
+            self._query.filter(col, op, expr)
+        if self._ordering:
+            self._query.sort(self._ordering.name,
+                             self._ordering.type)
+        self._executed = self._iter is not None
+        self._keys = list(self._iter or [])
+        if self._executed:
+            self._iter = iter(self._keys)
+
+    def _fetch_range(self, start, stop):
+        # the keys are known after the search; only the requested records
+        # are fetched (the preceding ones are skipped)
+        return self._keys[start:stop]
+
+    def _get_raw_iterator(self):
+        # the list of keys is small compared to the records
+        self._prepare()
+        return iter(self._keys)
+
+    def _get_raw_records(self, names=None):
+        connection = self.storage.connection
+        return ((pk, connection[pk]) for pk in self._get_raw_iterator())
+
+    def _prepare(self):
+        if not self._executed:
+            self._keys = self._get_cached('keys', self._get_keys)
+            self._iter = iter(self._keys)
+            self._executed = True
 
     def _prepare_item(self, key):
         return self.storage.get(self.model, key)
 
+    def _rewrite(self, get_changes):
+        """
+        Calls given function for the primary key of each record that matches
+        current query and writes the returned dictionary of changed columns
+        back to the record. All changes are made within a single transaction.
+        """
+        with self.storage.transaction():
+            for pk in self._get_keys():
+                self.storage.update(pk, get_changes(pk))
+
     def _where(self, lookups, negate=False):
         """
         Returns Query instance filtered by given conditions.
@@ -268,6 +493,19 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
         return self._clone(extra_conditions=conditions)
 
     def _clone(self, extra_conditions=None, extra_ordering=None):
+        if self._combined:
+            # conditions must apply to the whole result: for a union they are
+            # added to each query, otherwise to the first one; the ordering
+            # is defined by the first query
+            operation, queries = self._combined
+            queries = list(queries)
+            queries[0] = queries[0]._clone(extra_conditions, extra_ordering)
+            if operation == tc.TDBMSUNION:
+                queries[1:] = [q._clone(extra_conditions)
+                               for q in queries[1:]]
+            return self.__class__(self.storage, self.model,
+                                  combined=(operation, queries))
+
         return self.__class__(
             self.storage,
             self.model,
@@ -294,11 +532,73 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
         """
         return self._where(conditions, negate=True)
 
+    @observed
     def count(self):
         """
         Same as ``__len__`` but without fetching the records (i.e. faster).
         """
-        return self._query.count()
+        if self._executed and self._iter is None and \
+           not (self._cache_size or self._offset):
+            # all results are already cached (and the cache is not trimmed)
+            return len(self._cache)
+        if self._combined:
+            return len(self._get_cached('keys', self._get_keys))
+        return self._get_cached('count', self._query.count)
+
+    def explain(self):
+        """
+        Returns the query plan (see
+        :meth:`~doqu.backend_base.BaseQueryAdapter.explain`). The search is
+        executed to obtain the hint from Tokyo Cabinet, which tells whether
+        an index is used. If the hint is not available, the index is guessed
+        from the indexes declared in the document class.
+
+        Ordering is done by the database. Slices are taken from the list of
+        keys of all matching records, so the limit is not pushed down but the
+        preceding records are not fetched.
+        """
+        if self._combined:
+            operation, queries = self._combined
+            plans = [q.explain() for q in queries]
+            full_scans = [plan['full_scan'] for plan in plans]
+            return self._make_plan(
+                full_scan = None if None in full_scans else any(full_scans),
+                order_pushed_down = plans[0]['order_pushed_down'],
+                limit_pushed_down = False,
+                native = {'metasearch': operation, 'queries': plans},
+            )
+
+        self._query.search()
+        hint = getattr(self._query, 'hint', None)
+        if callable(hint):
+            hint = hint()
+        if hint:
+            index, full_scan = self._parse_tokyo_hint(hint)
+        else:
+            declared = self.storage._get_declared_indexes(self.model)
+            names = [name for name, op, expr in self._conditions
+                     if name in declared]
+            index = names[0] if names else None
+            full_scan = index is None
+        return self._make_plan(
+            conditions = list(self._conditions),
+            index = index,
+            full_scan = full_scan,
+            estimated_scan = len(self.storage) if full_scan else None,
+            order_pushed_down = True if self._ordering else None,
+            limit_pushed_down = False,
+            native = {'hint': hint},
+        )
+
+    def increment(self, name, by=1):
+        """
+        Increments given numeric field by given number in all records that
+        match current query. The changes are made in a single transaction.
+        """
+        def get_changes(pk):
+            value = self.storage.connection[pk].get(name)
+            return {name: self._get_incremented_value(name, value, by)}
+        self._rewrite(get_changes)
 
     def order_by(self, names, reverse=False):
         """
@@ -335,6 +635,15 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
 
         return self._clone(extra_ordering=ordering)
 
+    def update(self, **fields):
+        """
+        Sets given fields to given values in all records that match current
+        query. The changes are made in a single transaction.
+        """
+        native = self._get_native_values(fields)
+        self._rewrite(lambda pk: native)
+
+    @observed
     def values(self, name):
         """
         Returns an iterator that yields distinct values for given column name.
@@ -359,4 +668,10 @@ class QueryAdapter(CachedIterator, BaseQueryAdapter):
         """
         Deletes all records that match current query.
         """
-        self._query.remove()
+        if self._combined:
+            with self.storage.transaction():
+                for pk in self._get_keys():
+                    self.storage.delete(pk)
+        else:
+            self._query.remove()
+        self.storage._bump_generation()
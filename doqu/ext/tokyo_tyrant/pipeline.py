@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+#    Doqu is a lightweight schema/query framework for document databases.
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of Docu.
+#
+#    Doqu is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Doqu is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with Docu.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Pipelined requests for Tokyo Tyrant. Many commands are written to the socket
+at once and the responses are read afterwards in the same order, so a batch
+costs one network round trip instead of one per record.
+"""
+
+from pyrant import exceptions
+from pyrant.protocol import TyrantProtocol, _pack, _ulen
+
+
+__all__ = ['Pipeline']
+
+
+# Number of commands sent at once. The server writes responses while we are
+# still sending; if we never read them, both sides may end up waiting for each
+# other to drain the socket buffers. Sending large batches in chunks prevents
+# such deadlock and keeps the buffers small.
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _read_status(sock):
+    code = ord(sock.get_byte())
+    if code:
+        return exceptions.get_for_code(code)
+
+def _read_get(sock, literal):
+    error = _read_status(sock)
+    if error:
+        return error
+    return sock.get_str() if literal else sock.get_unicode()
+
+def _read_misc(sock):
+    error = _read_status(sock)
+    # the list is sent even if the function has failed
+    values = [sock.get_unicode() for i in xrange(sock.get_int())]
+    return error or values
+
+
+class Pipeline(object):
+    """
+    A queue of Tokyo Tyrant requests. The methods mimic those of
+    :class:`pyrant.protocol.TyrantProtocol` but they only enqueue the request
+    and return nothing. Call :meth:`execute` to send the requests and fetch
+    the results::
+
+        pipeline = Pipeline()
+        pipeline.get('foo')
+        pipeline.out('bar')
+        foo, bar = pipeline.execute(tyrant.proto)
+
+    :param chunk_size:
+        maximum number of requests sent without reading the responses.
+
+    """
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._requests = []    # (packed request, response reader, args)
+
+    def __len__(self):
+        return len(self._requests)
+
+    def _add(self, request, reader, *args):
+        self._requests.append((request, reader, args))
+
+    def clear(self):
+        "Discards all pending requests."
+        self._requests = []
+
+    def execute(self, proto):
+        """
+        Sends all pending requests through given `TyrantProtocol` instance and
+        returns the list of results. If a request has failed, the result is
+        an instance of :class:`pyrant.exceptions.TyrantError` instead of
+        being raised: the responses to subsequent requests must be read anyway
+        to keep the connection usable.
+        """
+        raw_sock = proto._sock._sock
+        results = []
+        requests = self._requests
+        for start in xrange(0, len(requests), self.chunk_size):
+            chunk = requests[start:start+self.chunk_size]
+            raw_sock.sendall(''.join(request for request, _, _ in chunk))
+            for _, reader, args in chunk:
+                results.append(reader(proto._sock, *args))
+        self.clear()
+        return results
+
+    def get(self, key, literal=False):
+        self._add(_pack(TyrantProtocol.GET, _ulen(key), key), _read_get,
+                  literal)
+
+    def misc(self, func, args, opts=0):
+        self._add(_pack(TyrantProtocol.MISC, len(func), opts, len(args), func,
+                        args), _read_misc)
+
+    def out(self, key):
+        self._add(_pack(TyrantProtocol.OUT, _ulen(key), key), _read_status)
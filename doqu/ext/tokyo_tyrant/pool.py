@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#
+#    Doqu is a lightweight schema/query framework for document databases.
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of Docu.
+#
+#    Doqu is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Doqu is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with Docu.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Connection pool for Tokyo Tyrant. Allows to share a storage adapter between
+threads without serializing all database traffic through a single socket.
+"""
+
+import errno
+import socket
+import threading
+import time
+
+from pyrant import Tyrant
+from pyrant import exceptions, protocol
+from pyrant.protocol import TyrantProtocol
+
+from doqu.utils import cached_property
+
+
+__all__ = ['ProtocolPool', 'PooledTyrant', 'UnixSocketProtocol']
+
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_IDLE = 30    # seconds
+
+# socket errors that mean that an idle socket was closed by the server
+BROKEN_SOCKET_ERRORS = (None, errno.EPIPE, errno.ECONNRESET,
+                        errno.ECONNABORTED)
+
+
+def _close_protocol(proto):
+    "Closes the socket of given `TyrantProtocol` instance."
+    # Pyrant only closes the socket when the wrapper is garbage-collected
+    try:
+        proto._sock._sock.close()
+    except (AttributeError, socket.error):
+        pass
+
+def _read_keys(proto):
+    "Returns all keys of the database read through given connection."
+    keys = []
+    proto.iterinit()
+    try:
+        while True:
+            keys.append(proto.iternext())
+    except exceptions.TyrantError:
+        # end of iteration
+        pass
+    return keys
+
+
+class _UnixSocket(protocol._TyrantSocket):
+    "Same as Pyrant's socket wrapper but talks via a Unix domain socket."
+    def __init__(self, path, timeout=None):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if not timeout is None:
+            self._sock.settimeout(timeout)
+        self._sock.connect(path)
+
+
+class UnixSocketProtocol(TyrantProtocol):
+    """
+    Tokyo Tyrant protocol over a Unix domain socket (see the `-host` option
+    of `ttserver`).
+    """
+    def __init__(self, path, timeout=None):
+        self._sock = _UnixSocket(path, timeout)
+        # expose connection info (not used internally)
+        self.host = path
+        self.port = 0
+
+
+class ProtocolPool(object):
+    """
+    A thread-safe pool of Tokyo Tyrant connections. Mimics the API of
+    :class:`pyrant.protocol.TyrantProtocol`: each method call checks out a
+    connection, performs the request and returns the connection to the pool.
+
+    :param connect:
+        a callable that returns a new `TyrantProtocol` instance.
+    :param size:
+        maximum number of open connections. If all of them are busy, the
+        caller waits until one is returned to the pool.
+    :param max_idle:
+        a connection that was idle for more than given number of seconds is
+        checked (and reopened if broken) before it is used.
+
+    If a request fails because a reused connection turns out to be broken
+    (e.g. the server was restarted), the connection is dropped and the request
+    is repeated once with a new one.
+    """
+    def __init__(self, connect, size=DEFAULT_POOL_SIZE,
+                 max_idle=DEFAULT_MAX_IDLE, host=None, port=None):
+        self._connect = connect
+        self._size = size
+        self._max_idle = max_idle
+        self._idle = []    # (connection, time of last use)
+        self._opened = 0
+        self._lock = threading.Condition()
+        # expose connection info (not used internally)
+        self.host = host
+        self.port = port
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(TyrantProtocol, name)
+        if not hasattr(attr, '__call__'):
+            # a protocol constant
+            return attr
+        def method(*args, **kwargs):
+            return self._call(name, *args, **kwargs)
+        method.__name__ = name
+        return method
+
+    def _call(self, name, *args, **kwargs):
+        return self.run(lambda proto: getattr(proto, name)(*args, **kwargs))
+
+    def _checkout(self):
+        """
+        Returns a connection and a boolean value: `True` if the connection was
+        taken from the pool and `False` if it has just been opened.
+        """
+        with self._lock:
+            while not self._idle and self._size <= self._opened:
+                self._lock.wait()
+            if self._idle:
+                proto, last_used = self._idle.pop()
+            else:
+                proto = None
+                self._opened += 1
+
+        if proto is None:
+            return self._open(), False
+
+        if self._max_idle is not None and \
+           self._max_idle < time.time() - last_used:
+            # health check
+            try:
+                proto.rnum()
+            except Exception:
+                # whatever the reason, the connection cannot be trusted
+                self._discard(proto)
+                with self._lock:
+                    self._opened += 1
+                return self._open(), False
+        return proto, True
+
+    def _checkin(self, proto):
+        with self._lock:
+            self._idle.append((proto, time.time()))
+            self._lock.notify()
+
+    def _discard(self, proto):
+        if proto is not None:
+            _close_protocol(proto)
+        with self._lock:
+            self._opened -= 1
+            self._lock.notify()
+
+    def _open(self):
+        try:
+            return self._connect()
+        except:
+            # the slot was reserved but the connection was not opened
+            self._discard(None)
+            raise
+
+    def close(self):
+        """
+        Closes all idle connections. The pool stays usable: new connections
+        are opened on demand. Connections that are checked out at the moment
+        are returned to the pool as usual.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+            self._lock.notify_all()
+        for proto, last_used in idle:
+            _close_protocol(proto)
+
+    def run(self, func):
+        """
+        Checks out a connection, calls `func` with it as the only argument and
+        returns the result. Allows to send a series of requests (e.g. a
+        pipeline) through the same connection.
+        """
+        for attempt in 1, 2:
+            proto, reused = self._checkout()
+            try:
+                result = func(proto)
+            except exceptions.TyrantError:
+                # the server has responded, the socket is fine
+                self._checkin(proto)
+                raise
+            except socket.error as e:
+                self._discard(proto)
+                if (reused and attempt == 1 and
+                    getattr(e, 'errno', None) in BROKEN_SOCKET_ERRORS):
+                    continue
+                raise
+            except:
+                # the response may have been read partially; we cannot reuse
+                # the socket as it may be out of sync with the server
+                self._discard(proto)
+                raise
+            else:
+                self._checkin(proto)
+                return result
+
+
+class PooledTyrant(Tyrant):
+    """
+    Same as :class:`pyrant.Tyrant` but sends each request through a
+    connection taken from given :class:`ProtocolPool`.
+
+    The server keeps the state of key iteration for each connection, so all
+    keys are read at once through a single connection.
+    """
+    def __init__(self, pool, separator=None, literal=False):
+        # NOTE: Tyrant.__init__ is not called because it opens a socket
+        self.proto = pool
+
+        self.separator = separator
+        if not separator and self.table_enabled:
+            self.separator = protocol.TABLE_COLUMN_SEP
+
+        self.literal = literal
+
+    @cached_property
+    def db_type(self):
+        # Pyrant asks the server for every record; the type doesn't change
+        return super(PooledTyrant, self).db_type
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.proto.run(_read_keys)
@@ -21,6 +21,9 @@
 import uuid
 
 from doqu.backend_base import BaseQueryAdapter
+from doqu.utils.concurrency import Prefetcher
+from doqu.utils.data_structures import ITER_CHUNK_SIZE, PREFETCH_DEPTH
+from doqu.utils.instrumentation import observed
 
 
 class QueryAdapter(BaseQueryAdapter):
@@ -44,6 +47,10 @@ class QueryAdapter(BaseQueryAdapter):
             return self.storage._decorate(self.model, key, data)
 
     def __iter__(self):
+        if self._prefetch_depth:
+            for document in self.iterator():
+                yield document
+            return
         for key, data in self._query:
             yield self.storage._decorate(self.model, key, data)
 
@@ -61,8 +68,15 @@ class QueryAdapter(BaseQueryAdapter):
     #  Private attributes  |
     #----------------------+
 
+    def _get_raw_records(self, names=None):
+        if names:
+            # only fetch the requested columns (without the keys)
+            return ((None, data) for data in self._query.columns(*names))
+        return iter(self._query)
+
     def _init(self):
         self._query = self.storage.connection.query
+        self._prefetch_depth = 0
     #    # by default only fetch columns specified in the Model
     #    col_names = self.model._meta.props.keys()
     #    self._query = self.storage.connection.query.columns(*col_names)
@@ -83,6 +97,7 @@ class QueryAdapter(BaseQueryAdapter):
     #  Public API  |
     #--------------+
 
+    @observed
     def count(self):
         """
         Returns the number of records that match current query. Does not fetch
@@ -95,6 +110,69 @@ class QueryAdapter(BaseQueryAdapter):
         Deletes all records that match current query.
         """
         self._query.delete()
+        self.storage._bump_generation()
+
+    def explain(self):
+        """
+        Returns the query plan (see
+        :meth:`~doqu.backend_base.BaseQueryAdapter.explain`) based on the hint
+        returned by Tokyo Tyrant (the search is executed). Ordering and
+        limits are applied by the server.
+        """
+        hint = self._query.hint() if hasattr(self._query, 'hint') else None
+        index, full_scan = self._parse_tokyo_hint(hint)
+        if not hint:
+            full_scan = None
+        # XXX Pyrant does not publish an API for conditions and ordering
+        ordering = getattr(self._query, '_ordering', None)
+        return self._make_plan(
+            conditions = list(getattr(self._query, '_conditions', [])),
+            index = index,
+            full_scan = full_scan,
+            estimated_scan = len(self.storage) if full_scan else None,
+            order_pushed_down = True if ordering else None,
+            limit_pushed_down = True,
+            native = {'hint': hint},
+        )
+
+    def increment(self, name, by=1):
+        """
+        Increments given numeric field by given number in all records that
+        match current query. Only the relevant column is fetched and written
+        back; the writes are pipelined (see
+        :meth:`~doqu.ext.tokyo_tyrant.storage.StorageAdapter.pipeline`).
+
+        .. note::
+
+            Tokyo Tyrant's `addint`/`adddouble` only work with the special
+            ``_num`` column of table databases, so the values are incremented
+            on client side.
+
+        """
+        self._check_field_name(name)
+        with self.storage.pipeline():
+            # the primary key is returned as the column with empty name
+            for data in self._query.columns('', name):
+                value = self._get_incremented_value(name, data.get(name), by)
+                self.storage.update(data[''], {name: value})
+
+    def iterator(self, chunk_size=ITER_CHUNK_SIZE):
+        """
+        Returns an iterator over the documents bypassing the cache, so that
+        memory consumption does not depend on the number of records. The keys
+        are found first, then the records are fetched in chunks of given size
+        (one round trip per chunk; see also :meth:`prefetch`).
+        """
+        keys = self._query._do_search()
+        batches = (self.storage.get_many(self.model,
+                                         keys[start:start+chunk_size])
+                   for start in xrange(0, len(keys), chunk_size))
+        if self._prefetch_depth:
+            batches = Prefetcher(batches, chunk_size=1,
+                                 depth=self._prefetch_depth)
+        for batch in batches:
+            for document in batch:
+                yield document
 
     def order_by(self, name):
         # introspect model and use numeric sorting if appropriate
@@ -104,6 +182,42 @@ class QueryAdapter(BaseQueryAdapter):
         q = self._query.order_by(name, numeric)
         return self._clone(q)
 
+    def prefetch(self, depth=PREFETCH_DEPTH):
+        """
+        Makes the records fetched in a background thread, given number of
+        chunks ahead of the consumer, and returns the query. Iteration then
+        goes through :meth:`iterator`, i.e. the documents are not cached (see
+        :meth:`~doqu.utils.data_structures.CachedIterator.prefetch`).
+
+        The thread needs a connection of its own, so prefetching only works
+        with pooled connections (see the `pool_size` option of
+        :class:`~doqu.ext.tokyo_tyrant.storage.StorageAdapter`); otherwise
+        the records are fetched synchronously as usual.
+
+        :param depth:
+            maximum number of chunks fetched in advance; `0` disables
+            prefetching.
+
+        """
+        if not self.storage.is_thread_safe:
+            depth = 0
+        self._prefetch_depth = depth
+        return self
+
+    def update(self, **fields):
+        """
+        Sets given fields to given values in all records that match current
+        query. Only the keys of matching records are fetched and only the
+        changed columns are sent to the server; the writes are pipelined (see
+        :meth:`~doqu.ext.tokyo_tyrant.storage.StorageAdapter.pipeline`).
+        """
+        native = self._get_native_values(fields)
+        with self.storage.pipeline():
+            # XXX Pyrant does not publish an API to fetch keys only
+            for key in self._query._do_search():
+                self.storage.update(key, native)
+
+    @observed
     def values(self, name):
         """
         Returns a list of unique values for given column name.
@@ -18,13 +18,20 @@
 #    You should have received a copy of the GNU Lesser General Public License
 #    along with Docu.  If not, see <http://gnu.org/licenses/>.
 
+from contextlib import contextmanager
+import itertools
+import threading
 import uuid
 
 from doqu.backend_base import BaseStorageAdapter
 from managers import converter_manager, lookup_manager
+from pipeline import Pipeline
+from pool import (ProtocolPool, PooledTyrant, UnixSocketProtocol,
+                  DEFAULT_MAX_IDLE)
 from query import QueryAdapter
 
-from pyrant import Tyrant
+from pyrant import Tyrant, exceptions, utils
+from pyrant.protocol import TyrantProtocol
 
 
 DEFAULT_HOST = '127.0.0.1'
@@ -32,6 +39,31 @@ DEFAULT_PORT = 1978
 
 
 class StorageAdapter(BaseStorageAdapter):
+    """
+    :param host:
+        the host name (default is `127.0.0.1`).
+    :param port:
+        the port number (default is 1978).
+    :param unix_socket:
+        path to the Unix domain socket of the server; if specified, `host`
+        and `port` are ignored.
+    :param pool_size:
+        if specified, the adapter keeps up to given number of connections and
+        each request is sent through a free one. This makes the adapter
+        thread-safe. By default a single connection is used.
+    :param max_idle:
+        for pooled connections: a connection idle for more than given number
+        of seconds is checked before use and reopened if it is broken.
+
+    .. note::
+
+        connection via Unix domain socket is always pooled (by default the
+        pool size is 1).
+
+    Writes can be pipelined to save on network round trips, see
+    :meth:`StorageAdapter.pipeline`.
+
+    """
     supports_nested_data = False
     converter_manager = converter_manager
     lookup_manager = lookup_manager
@@ -49,10 +81,19 @@ class StorageAdapter(BaseStorageAdapter):
     def __len__(self):
         return len(self.connection)
 
+    @property
+    def is_thread_safe(self):
+        # a plain Tyrant object talks through a single socket
+        return isinstance(self.connection, PooledTyrant)
+
     #----------------------+
     #  Private attributes  |
     #----------------------+
 
+    def _create_index(self, name, index_type):
+        return bool(self.connection.proto.add_index(name, index_type,
+                                                    keep=True))
+
     def _fetch(self, primary_key):
         """
         Returns model instance for given model and primary key.
@@ -60,6 +101,30 @@ class StorageAdapter(BaseStorageAdapter):
         """
         return self.connection[primary_key] or {}
 
+    def _get_pipeline(self):
+        "Returns the pipeline opened in current thread (if any)."
+        return getattr(self._local, 'pipeline', None)
+
+    def _get_put_args(self, primary_key, data):
+        # same as what Tyrant.__setitem__ sends for a dictionary
+        if not all(unicode(k) for k in data):
+            raise KeyError('Empty keys are not allowed (%s).' % repr(data))
+        flat = itertools.chain(*((k, utils.from_python(v))
+                                 for k, v in data.iteritems()))
+        return [primary_key] + list(flat)
+
+    def _run_pipeline(self, pipeline):
+        """
+        Sends given pipeline through a single connection and returns the
+        results.
+        """
+        if not len(pipeline):
+            return []
+        proto = self.connection.proto
+        if isinstance(proto, ProtocolPool):
+            return proto.run(pipeline.execute)
+        return pipeline.execute(proto)
+
     #--------------+
     #  Public API  |
     #--------------+
@@ -69,6 +134,7 @@ class StorageAdapter(BaseStorageAdapter):
         Clears the whole storage from data, resets autoincrement counters.
         """
         self.connection.clear()
+        self._bump_generation()
 
     def connect(self):
         """
@@ -76,23 +142,117 @@ class StorageAdapter(BaseStorageAdapter):
         closed yet. Use :meth:`StorageAdapter.reconnect` to explicitly close
         the connection and open it again.
         """
-        # TODO: sockets, etc.
         host = self._connection_options.get('host', DEFAULT_HOST)
         port = self._connection_options.get('port', DEFAULT_PORT)
-        self.connection = Tyrant(host=host, port=port)
+        path = self._connection_options.get('unix_socket')
+        pool_size = self._connection_options.get('pool_size')
+
+        # pipelines are not shared between threads
+        self._local = threading.local()
+
+        if not (pool_size or path):
+            self.connection = Tyrant(host=host, port=port)
+            return
+
+        if path:
+            connect = lambda: UnixSocketProtocol(path)
+            host, port = path, 0
+        else:
+            connect = lambda: TyrantProtocol(host, port)
+        max_idle = self._connection_options.get('max_idle', DEFAULT_MAX_IDLE)
+        pool = ProtocolPool(connect, size=pool_size or 1, max_idle=max_idle,
+                            host=host, port=port)
+        self.connection = PooledTyrant(pool)
 
     def delete(self, key):
         """
         Permanently deletes the record with given primary key from the database.
         """
-        del self.connection[key]
+        pipeline = self._get_pipeline()
+        if pipeline is not None:
+            self._local.deleted[len(pipeline)] = key
+            pipeline.out(key)
+        else:
+            del self.connection[key]
+        self._bump_generation()
 
     def disconnect(self):
+        if isinstance(self.connection, PooledTyrant):
+            self.connection.proto.close()
         self.connection = None
 
+    def get_many(self, doc_class, primary_keys):
+        """
+        Returns a list of documents with primary keys from given list. All
+        records are requested at once (see :meth:`StorageAdapter.pipeline`).
+        Raises KeyError if any of the records does not exist.
+        """
+        primary_keys = list(primary_keys)
+        pipeline = Pipeline()
+        for pk in primary_keys:
+            pipeline.get(pk, self.connection.literal)
+        results = self._run_pipeline(pipeline)
+
+        db_type = self.connection.db_type
+        separator = self.connection.separator
+        documents = []
+        for pk, value in zip(primary_keys, results):
+            if isinstance(value, exceptions.TyrantError):
+                raise KeyError(pk)
+            data = utils.to_python(value, db_type, separator) or {}
+            documents.append(self._decorate(doc_class, pk, data))
+        return documents
+
     def get_query(self, model):
         return QueryAdapter(storage=self, model=model)
 
+    @contextmanager
+    def pipeline(self):
+        """
+        Returns a context manager. Within the block, :meth:`save`,
+        :meth:`update` and :meth:`delete` do not talk to the server; instead,
+        the requests are queued and sent at once when the block is left, and
+        then the responses are read. On a network with noticeable latency
+        this is much faster than waiting for each response in turn. Usage::
+
+            with db.pipeline():
+                for note in notes:
+                    note.save(db)
+
+        Notes:
+
+        * reads within the block do not see the queued writes;
+        * primary keys for new records are still generated immediately (one
+          request per record), so it is better to use :meth:`save_many`;
+        * if a request fails, the rest of them are still performed and then
+          the first error is raised (KeyError for a missing record);
+        * if an exception is raised within the block, the queued requests are
+          discarded;
+        * nested blocks are merged into the outermost one.
+
+        """
+        if self._get_pipeline() is not None:
+            # nested block
+            yield
+            return
+
+        pipeline = self._local.pipeline = Pipeline()
+        # position of request in the pipeline --> key of deleted record
+        deleted = self._local.deleted = {}
+        try:
+            yield
+        finally:
+            self._local.pipeline = self._local.deleted = None
+
+        # send the requests only if the block was completed
+        results = self._run_pipeline(pipeline)
+        self._bump_generation()
+        for i, result in enumerate(results):
+            if isinstance(result, exceptions.TyrantError):
+                if i in deleted:
+                    raise KeyError(deleted[i])
+                raise result
+
     def save(self, data, primary_key=None):
         """
         Saves given model instance into the storage. Returns primary key.
@@ -106,6 +266,68 @@ class StorageAdapter(BaseStorageAdapter):
         """
         primary_key = primary_key or self.connection.generate_key()
 
-        self.connection[primary_key] = data
+        pipeline = self._get_pipeline()
+        if pipeline is not None:
+            pipeline.misc('put', self._get_put_args(primary_key, data))
+        else:
+            self.connection[primary_key] = data
+
+        self._bump_generation()
+        return primary_key
 
+    def save_many(self, items):
+        """
+        Saves given records into the storage. Returns a list of primary keys.
+        Keys for new records are generated and then the records are sent at
+        once (see :meth:`StorageAdapter.pipeline`).
+
+        :param items:
+            an iterable of `(primary_key, data)` pairs where `data` is a dict
+            containing all properties to be saved and `primary_key` may be
+            `None` (then it will be generated).
+        """
+        items = list(items)
+
+        # generate missing keys (in one round trip)
+        pipeline = Pipeline()
+        for primary_key, data in items:
+            if not primary_key:
+                pipeline.misc('genuid', [])
+        new_keys = iter(self._run_pipeline(pipeline))
+
+        keys = []
+        with self.pipeline():
+            for primary_key, data in items:
+                if not primary_key:
+                    result = new_keys.next()
+                    if isinstance(result, exceptions.TyrantError):
+                        raise result
+                    primary_key = result[0]
+                keys.append(self.save(data=data, primary_key=primary_key))
+        return keys
+
+    def update(self, primary_key, data):
+        """
+        Updates given columns of an existing record and leaves other columns
+        intact. Uses the "putcat" function of Tokyo Tyrant table database so
+        only the changed columns are sent over the wire. Returns primary key.
+
+        :param primary_key:
+            the key of the record to be updated.
+        :param data:
+            dict containing the properties to be changed.
+        """
+        args = [primary_key]
+        for name, value in data.iteritems():
+            if value is None:
+                value = ''
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            args.extend([name, str(value)])
+        pipeline = self._get_pipeline()
+        if pipeline is not None:
+            pipeline.misc('putcat', args)
+        else:
+            self.connection.proto.misc('putcat', args, 0)
+        self._bump_generation()
         return primary_key
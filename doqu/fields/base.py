@@ -47,10 +47,14 @@ class Field(object):
         if True, the value is preprocessed with pickle's dumps/loads functions.
         This of course breaks lookups by this field but enables storing
         arbitrary Python objects.
+    :param index:
+        if True, the field is indexed (the index type depends on the datatype).
+        Can also be an index type, e.g. `q-gram`. See
+        :attr:`DocumentMetadata.indexes`.
 
     """
     def __init__(self, datatype, essential=False, required=False, default=None,
-                 choices=None, label=None, pickled=False):
+                 choices=None, label=None, pickled=False, index=False):
         self.choices = choices
         self.datatype = datatype
         self.essential = essential
@@ -58,6 +62,7 @@ class Field(object):
         self.default = default
         self.label = label
         self.pickled = pickled
+        self.index = index
 
     skip_type_conversion = False
     # These could be defined as no-op methods but we don't need to register
@@ -85,6 +90,10 @@ class Field(object):
         if self.label is not None:
             doc_meta.labels[attr_name] = self.label
 
+        if self.index:
+            index_type = None if self.index is True else self.index
+            doc_meta.indexes[attr_name] = index_type
+
         # validation
 
         def _add_validator(validator_class, *args, **kwargs):
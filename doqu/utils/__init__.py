@@ -32,8 +32,12 @@ import re
 import sys
 from functools import wraps
 
+from migration import migrate
+from transfer import dump, load
 
-__all__ = ['get_db', 'camel_case_to_underscores', 'load_fixture']
+
+__all__ = ['get_db', 'camel_case_to_underscores', 'dump', 'load',
+           'load_fixture', 'migrate']
 
 
 def get_db(settings_dict=None, **settings_kwargs):
@@ -130,10 +134,8 @@ def load_fixture(path, db=None):
     if not os.path.isfile(path):
         raise ValueError('could not find file {0}'.format(path))
     loader = _get_fixture_loader(path)
-    f = open(path)
-    items = loader(f)
-    for item in items:
-        db.save(None, item)
+    with open(path) as f:
+        db.save_many((None, item) for item in loader(f))
     return db
 
 def _get_fixture_loader(filename):
@@ -147,7 +149,7 @@ def _get_fixture_loader(filename):
         import csv
         loader = csv.DictReader
     else:
-        raise ValueErrori('unknown data file type: {0}'.format(filename))
+        raise ValueError('unknown data file type: {0}'.format(filename))
     return loader
 
 def cached_property(function):
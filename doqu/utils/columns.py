@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+#    Doqu is a lightweight schema/query framework for document databases.
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of Docu.
+#
+#    Doqu is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Doqu is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with Docu.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Columns
+=======
+
+Typed arrays of field values (see
+:meth:`~doqu.backend_base.BaseQueryAdapter.to_columns`). NumPy is used if
+it is installed; otherwise the standard module :mod:`array` is used.
+"""
+from array import array
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+__all__ = ['make_column']
+
+
+# declared datatype --> (NumPy dtype, array typecode, placeholder for missing
+# values); the order matters because bool is a subclass of int and datetime
+# is a subclass of date
+COLUMN_TYPES = (
+    (bool,              'bool',           'B',  False),
+    ((int, long),       'int64',          'l',  0),
+    (float,             'float64',        'd',  0.0),
+    (datetime.datetime, 'datetime64[us]', None, None),
+    (datetime.date,     'datetime64[D]',  None, None),
+)
+
+
+def _get_column_type(datatype):
+    if isinstance(datatype, type):
+        for types, dtype, typecode, placeholder in COLUMN_TYPES:
+            if issubclass(datatype, types):
+                return dtype, typecode, placeholder
+    # strings, decimals, lists, etc.
+    return object, None, None
+
+
+def make_column(datatype, values):
+    """
+    Returns a typed array of given values (`None` means a missing value). The
+    type of the array depends on given declared datatype of the field:
+
+    * with NumPy: a NumPy array of matching dtype (e.g. `int64` for `int`,
+      `datetime64` for dates, `object` for strings and unknown types). If
+      some values are missing and the dtype is not `object`, a masked array
+      is returned.
+    * without NumPy: an :class:`array.array` for booleans and numbers.
+      If some values are missing or the datatype is not numeric, a list is
+      returned.
+
+    """
+    values = list(values)
+    dtype, typecode, placeholder = _get_column_type(datatype)
+    missing = [value is None for value in values]
+
+    if numpy is None:
+        if typecode is None or any(missing):
+            return values
+        return array(typecode, values)
+
+    if dtype is not object and dtype.startswith('datetime64') and \
+       not hasattr(numpy, 'datetime64'):    # NumPy < 1.7
+        dtype = object
+    if dtype is object:
+        # numpy.array() would turn a list of lists into a 2-D array
+        column = numpy.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            column[i] = value
+        return column
+    if any(missing):
+        filled = [placeholder if x is None else x for x in values]
+        return numpy.ma.array(filled, mask=missing, dtype=dtype)
+    return numpy.array(values, dtype=dtype)
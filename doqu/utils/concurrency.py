@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+#
+#    Doqu is a lightweight schema/query framework for document databases.
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of Docu.
+#
+#    Doqu is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Doqu is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with Docu.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Concurrency
+===========
+
+Minimal thread-based primitives for running storage operations in background.
+"""
+
+import atexit
+import sys
+import threading
+from Queue import Full, Queue
+
+
+__all__ = ['Future', 'Prefetcher', 'WorkerPool']
+
+
+class Future(object):
+    """
+    A placeholder for the result of an operation that is performed in
+    background. Usage::
+
+        future = pool.submit(db.get, Person, 'john')
+        ...                  # do something else meanwhile
+        john = future.result()
+
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def __repr__(self):
+        state = 'done' if self.done() else 'pending'
+        return '<Future {0}>'.format(state)
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Registers a function to be called with the future as the only argument
+        when the operation is finished. If it is already finished, the
+        function is called immediately.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        "Returns `True` if the operation is finished."
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits until the operation is finished and returns its result. If the
+        operation raised an exception, it is re-raised here. Raises
+        `RuntimeError` if the result is not ready in given number of seconds.
+        """
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise RuntimeError('operation timed out')
+        if self._exc_info:
+            exc_type, exc_value, traceback = self._exc_info
+            raise exc_type, exc_value, traceback
+        return self._result
+
+
+# stop event --> thread of each running Prefetcher
+_running = {}
+
+def _stop_running():
+    # daemon threads would otherwise run while the interpreter is torn down
+    threads = _running.items()
+    for stopped, thread in threads:
+        stopped.set()
+    for stopped, thread in threads:
+        thread.join(1)
+
+atexit.register(_stop_running)
+
+def _prefetch(iterator, chunk_size, queue, stopped, handover,
+              Full=Full, exc_info=sys.exc_info, running=_running):
+    # runs in a background thread; only gets what it needs, so that the
+    # Prefetcher can be garbage-collected while the thread is running (the
+    # names are bound as arguments because module globals may be cleared
+    # while a daemon thread is still running)
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            else:
+                return True
+        return False
+    try:
+        while True:
+            chunk = []
+            # the stop event is checked between items
+            for item in iterator:
+                chunk.append(item)
+                if chunk_size <= len(chunk) or stopped.is_set():
+                    break
+            if not put((chunk, None)):
+                # stopped by the consumer; it will read the rest itself
+                handover.append((chunk, iterator, None))
+                return
+            if not chunk:
+                # the iterator is exhausted
+                return
+    except:
+        error = exc_info()
+        # the items read before the error are passed first
+        if chunk and not put((chunk, None)):
+            handover.append((chunk, iter([]), error))
+        elif not put((None, error)):
+            handover.append(([], iter([]), error))
+    finally:
+        running.pop(stopped, None)
+
+
+def _read_rest(queue, handover):
+    """
+    Yields the items that were prefetched before the thread was stopped and
+    then the rest of the source iterator.
+    """
+    while not queue.empty():
+        chunk, exc_info = queue.get()
+        if exc_info:
+            exc_type, exc_value, traceback = exc_info
+            raise exc_type, exc_value, traceback
+        if not chunk:
+            return
+        for item in chunk:
+            yield item
+    for chunk, iterator, exc_info in handover:
+        for item in chunk:
+            yield item
+        if exc_info:
+            exc_type, exc_value, traceback = exc_info
+            raise exc_type, exc_value, traceback
+        for item in iterator:
+            yield item
+
+
+class _Stopper(object):
+    # stops the thread when the Prefetcher is garbage-collected; kept apart
+    # because an object with __del__ in a reference cycle is never collected
+    def __init__(self, event):
+        self.event = event
+
+    def __del__(self):
+        self.event.set()
+
+
+class Prefetcher(object):
+    """
+    An iterator that reads given iterable in a background thread, a few
+    chunks ahead of the consumer. While the consumer is processing an item,
+    the next ones are being fetched, so I/O and CPU-bound work overlap::
+
+        for raw_item in Prefetcher(cursor, chunk_size=100, depth=2):
+            process(raw_item)
+
+    Exceptions raised by the iterable are re-raised by the consumer. The
+    iterable is accessed from the background thread while the consumer may be
+    using the same resource (e.g. a database connection), so the resource must
+    be thread-safe.
+
+    The thread is a daemon. It stops when the prefetcher is closed or
+    garbage-collected; the iterable should not reference the prefetcher's
+    owner, otherwise the owner is kept alive by the thread until the iterable
+    is exhausted.
+
+    :param chunk_size:
+        number of items passed to the consumer at once.
+    :param depth:
+        maximum number of chunks fetched in advance.
+
+    """
+    def __init__(self, iterable, chunk_size=100, depth=2):
+        assert 1 <= chunk_size and 1 <= depth
+        self._queue = Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._stopper = _Stopper(self._stopped)
+        self._handover = []
+        self._chunk = iter([])
+        self._finished = False
+        self._thread = threading.Thread(target=_prefetch, args=(
+            iter(iterable), chunk_size, self._queue, self._stopped,
+            self._handover))
+        self._thread.daemon = True
+        _running[self._stopped] = self._thread
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        """
+        Stops fetching the items in background (e.g. if the consumer is not
+        interested). The remaining items can still be read; they are then
+        fetched synchronously.
+        """
+        self._stopped.set()
+
+    def next(self):
+        for item in self._chunk:
+            return item
+        if self._finished:
+            raise StopIteration
+        if self._stopped.is_set():
+            # the thread stops after the current item; then it's safe to
+            # access the source iterator from here
+            self._thread.join()
+            self._chunk = _read_rest(self._queue, self._handover)
+            self._finished = True
+            return self.next()
+        chunk, exc_info = self._queue.get()
+        if exc_info or not chunk:
+            self._finished = True
+            if exc_info:
+                exc_type, exc_value, traceback = exc_info
+                raise exc_type, exc_value, traceback
+            raise StopIteration
+        self._chunk = iter(chunk)
+        return self.next()
+
+
+class WorkerPool(object):
+    """
+    A fixed number of daemon threads that perform submitted calls in the
+    order they were submitted. A pool with a single worker guarantees that
+    the calls never overlap, so it can be used with objects that are not
+    thread-safe.
+    """
+    def __init__(self, workers=1):
+        assert 1 <= workers
+        self._tasks = Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                # shutdown requested
+                break
+            future, func, args, kwargs = task
+            try:
+                result = func(*args, **kwargs)
+            except:
+                future._finish(exc_info=sys.exc_info())
+            else:
+                future._finish(result=result)
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers after all pending calls are performed. If `wait` is
+        `True`, blocks until then.
+        """
+        for thread in self._threads:
+            self._tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedules given function to be called with given arguments. Returns
+        a :class:`Future`.
+        """
+        if not self._threads:
+            raise RuntimeError('the worker pool is shut down')
+        future = Future()
+        self._tasks.put((future, func, args, kwargs))
+        return future
@@ -19,6 +19,10 @@
 #    along with Docu.  If not, see <http://gnu.org/licenses/>.
 
 from collections import MutableMapping
+from itertools import islice
+
+from doqu.utils.concurrency import Prefetcher
+from doqu.utils.instrumentation import observe_iterator, observed
 
 
 __all__ = ['ProxyDict', 'DotDict', 'CachedIterator', 'LazySorted']
@@ -131,14 +135,38 @@ class DotDict(ProxyDict):
 # The CachedIterator was initially created as a part of Datashaping.
 
 ITER_CHUNK_SIZE = 100 # how many items to cache while iterating
+PREFETCH_DEPTH = 2    # how many chunks to fetch in advance (see prefetch)
 
 
 class CachedIterator(object):
+    """
+    A lazy iterable that caches the items as they are fetched from the
+    underlying iterator. Supports indexing and slicing (including negative
+    indices and steps); only as many items are fetched as needed to
+    satisfy the request, e.g. ``items[10:20]`` fetches 20 items and a
+    negative index fetches all of them.
+
+    The cache is unbounded by default. Use :meth:`cache_window` to only keep
+    a limited number of recently fetched items, or :meth:`iterator` to
+    iterate without caching at all. Use :meth:`prefetch` to fetch the items
+    in background.
+
+    Subclasses can define method ``_fetch_range(start, stop)`` that returns
+    the raw items from given range (`stop` can be `None`) without iterating
+    the preceding ones, e.g. using the database's skip/limit facilities. It
+    is then used for items that are not cached yet; such items are not
+    added to the cache.
+    """
+    # optional hook: def _fetch_range(self, start, stop)
+    _fetch_range = None
 
     def __init__(self, *args, **kw):
         self._iter  = kw.pop('iterable', None)
         self._chunk_size = kw.pop('chunk_size', ITER_CHUNK_SIZE)
         self._cache = []
+        self._cache_size = None    # unbounded
+        self._offset = 0           # number of items dropped from the cache
+        self._prefetch_depth = 0   # no background fetching
         self._init(*args, **kw)
 
     def _init(self, *args, **kw):
@@ -152,41 +180,53 @@ class CachedIterator(object):
     __len__  = lambda self: len(self._to_list())
 
     def __iter__(self):
-        if not self._cache:
-            self._fill_cache()
-        pos = 0
-        while 1:
-            upper = len(self._cache)
-            # iterate over cache
-            while pos < upper:
-                yield self._cache[pos]
-                pos += 1
-            # cache exhausted
-            if not self._iter:
-                # iterable exhausted too
-                raise StopIteration
-            # refill cache
-            self._fill_cache()
+        if self._offset:
+            # first items were dropped from the cache; fetch them again
+            for item in self.iterator():
+                yield item
+            return
+        try:
+            if not self._cache:
+                self._fill_cache()
+            pos = 0
+            while 1:
+                if pos < self._offset:
+                    # the window was moved by someone else (e.g. indexing)
+                    for item in self._fetch_uncached(pos, self._offset):
+                        yield item
+                    pos = self._offset
+                upper = self._offset + len(self._cache)
+                # iterate over cache
+                while pos < upper:
+                    yield self._cache[pos - self._offset]
+                    pos += 1
+                # cache exhausted
+                if not self._iter:
+                    # iterable exhausted too
+                    raise StopIteration
+                # refill cache
+                self._fill_cache()
+        finally:
+            # the loop is over (or abandoned by the consumer); the rest of
+            # the items, if ever needed, are fetched synchronously
+            self._stop_prefetch()
 
     def __getitem__(self, idx):
-        # fill cache up to requested index
-        upper = len(self._cache)
         if isinstance(idx, slice):
-            assert upper <= slice.start
-            # we don't fully support slices here, just fill the cache from the
-            # possible minimum till the requested maximum
-            max_elem = idx.stop
-        else:
-            max_elem = idx
-        if upper <= max_elem:
-            self._fill_cache(max_elem - upper + self._chunk_size)
-        return self._cache[idx]
-
-    def _prepare_item(self, item):
-        """
-        Prepares item just before returning it; can be useful in subclasses.
-        """
-        return item
+            start, stop, step = idx.start, idx.stop, idx.step
+            if step is not None and step < 0 or (start or 0) < 0 or \
+               stop is not None and stop < 0:
+                # reversed or counted from the end; we need all items
+                return self._to_list()[idx]
+            return self._get_range(start or 0, stop)[::step]
+
+        if idx < 0:
+            # counted from the end; we need all items
+            return self._to_list()[idx]
+        items = self._get_range(idx, idx + 1)
+        if not items:
+            raise IndexError('index out of range')
+        return items[0]
 
     #-------------------+
     #  Private methods  |
@@ -199,26 +239,194 @@ class CachedIterator(object):
         """
         pass
 
+    def _prepare_item(self, item):
+        """
+        Prepares item just before returning it; can be useful in subclasses.
+        """
+        return item
+
+    def _start_prefetch(self):
+        if self._prefetch_depth and self._iter is not None and \
+           not isinstance(self._iter, Prefetcher):
+            self._iter = Prefetcher(self._iter, chunk_size=self._chunk_size,
+                                    depth=self._prefetch_depth)
+
+    def _stop_prefetch(self):
+        if isinstance(self._iter, Prefetcher):
+            self._iter.close()
+
+    def _get_raw_iterator(self):
+        """
+        Returns a new iterator over all raw items, independent from the one
+        that fills the cache. Must be implemented by subclasses that can
+        re-fetch the items (see :meth:`iterator` and :meth:`cache_window`).
+        """
+        raise NotImplementedError('cannot fetch the items again')
+
+    @observed
+    def _fetch_uncached(self, start, stop):
+        "Returns a list of items from given range bypassing the cache."
+        if self._fetch_range:
+            raw_items = self._fetch_range(start, stop)
+        else:
+            raw_items = islice(self._get_raw_iterator(), start, stop)
+        return [self._prepare_item(x) for x in raw_items]
+
+    def _get_range(self, start, stop):
+        """
+        Returns a list of items from given range (`stop` can be `None`, the
+        indices must not be negative). Fetches as few items as possible.
+        """
+        if stop is not None and stop <= start:
+            return []
+        upper = self._offset + len(self._cache)
+        if (stop is None or upper < stop) and not self._is_exhausted():
+            if self._fetch_range:
+                # only fetch the items that are not cached yet
+                if start < self._offset:
+                    return self._fetch_uncached(start, stop)
+                cached = self._cache[start - self._offset:]
+                return cached + self._fetch_uncached(max(start, upper), stop)
+            if stop is None:
+                if not self._cache_size:
+                    return self._to_list()[start:]
+                return self._fetch_uncached(start, stop)
+            if self._cache_size and self._cache_size < stop - start:
+                # the range would not fit in the cache
+                return self._fetch_uncached(start, stop)
+            self._fill_cache(stop - upper)
+        if start < self._offset:
+            return self._fetch_uncached(start, stop)
+        return self._cache[start - self._offset:
+                           None if stop is None else stop - self._offset]
+
+    def _is_exhausted(self):
+        "Returns `True` if all items have been fetched."
+        # _iter is None both before the first iteration and after the last
+        # one; _prepare() tells these states apart
+        self._prepare()
+        return self._iter is None
+
+    @observed(standalone=False)
     def _to_list(self):
         """
-        Coerces the iterable to list, caches result and returns it.
+        Coerces the iterable to list, caches result and returns it. If the
+        cache is bounded, the list is not cached.
         """
         self._prepare()
-        self._cache = self._cache or [self._prepare_item(x) for x in self._iter]
+        self._start_prefetch()
+        if self._cache_size and (self._offset or self._iter):
+            return list(self.iterator())
+        if self._iter:
+            # the cache may be partially filled
+            self._cache.extend(self._prepare_item(x) for x in self._iter)
+            self._iter = None
         return self._cache
 
+    @observed(standalone=False)
     def _fill_cache(self, num=None):
         """
         Fills the result cache with 'num' more entries (or until the results
-        iterator is exhausted).
+        iterator is exhausted). If the cache is bounded, the oldest entries
+        are dropped.
         """
         self._prepare()
+        self._start_prefetch()
         if self._iter:
+            if num is None:
+                num = self._chunk_size
+                if self._cache_size:
+                    # iteration must not drop the items before they are
+                    # yielded
+                    num = min(num, self._cache_size)
             try:
-                for i in range(num or self._chunk_size):
+                for i in xrange(num):
                     self._cache.append(self._prepare_item(self._iter.next()))
             except StopIteration:
                 self._iter = None
+        if self._cache_size and self._cache_size < len(self._cache):
+            excess = len(self._cache) - self._cache_size
+            del self._cache[:excess]
+            self._offset += excess
+
+    #--------------+
+    #  Public API  |
+    #--------------+
+
+    def cache_window(self, size):
+        """
+        Limits the cache to given number of most recently fetched items and
+        returns the iterable. Older items are dropped from the cache and
+        fetched again if they are accessed later on. This keeps memory
+        consumption constant while iterating large result sets, yet allows
+        to access nearby items by index::
+
+            for i, item in enumerate(query.cache_window(1000)):
+                previous = query[i-1] if i else None
+
+        Must be called before the items are fetched.
+
+        :param size:
+            maximum number of cached items; `None` means no limit.
+
+        """
+        assert not self._cache and not self._offset, 'items already fetched'
+        self._cache_size = size
+        return self
+
+    def iterator(self):
+        """
+        Returns an iterator over the items bypassing the cache: the items are
+        not kept once they are consumed, so memory consumption does not
+        depend on the number of items. Handy for one-pass processing of large
+        result sets (e.g. export)::
+
+            for item in query.iterator():
+                writer.write(item)
+
+        If all items are already cached, they are taken from the cache.
+        Otherwise the items are fetched anew and the cache is not affected.
+        """
+        self._prepare()
+        if not self._offset and self._iter is None:
+            return iter(self._cache)
+        raw_items = self._get_raw_iterator()
+        if self._prefetch_depth:
+            raw_items = Prefetcher(raw_items, chunk_size=self._chunk_size,
+                                   depth=self._prefetch_depth)
+        return observe_iterator(self, (self._prepare_item(x)
+                                       for x in raw_items))
+
+    def prefetch(self, depth=PREFETCH_DEPTH):
+        """
+        Makes the items fetched from the underlying iterator in a background
+        thread, given number of chunks ahead of the consumer, and returns the
+        iterable. The backend I/O then overlaps with the processing of the
+        items (see :class:`~doqu.utils.concurrency.Prefetcher`)::
+
+            for item in query.prefetch():
+                ...
+
+        Must be called before the items are fetched. The background thread is
+        stopped when a loop over the iterable is over or when the iterable is
+        garbage-collected.
+
+        If the iterable belongs to a storage that is not thread-safe (see
+        :attr:`~doqu.backend_base.BaseStorageAdapter.is_thread_safe`), the
+        items are fetched synchronously as usual.
+
+        :param depth:
+            maximum number of chunks fetched in advance; `0` disables
+            prefetching.
+
+        """
+        assert not self._cache and not self._offset, 'items already fetched'
+        storage = getattr(self, 'storage', None)
+        if storage is not None and not storage.is_thread_safe:
+            # the thread would use the connection along with the consumer
+            depth = 0
+        self._prefetch_depth = depth
+        return self
 
 
 class LazySorted(object):
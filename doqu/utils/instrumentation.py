@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+#
+#    Doqu is a lightweight schema/query framework for document databases.
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of Docu.
+#
+#    Doqu is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Doqu is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with Docu.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Instrumentation
+===============
+
+Listeners can be attached to a storage adapter to find out where the time is
+spent (see :meth:`~doqu.backend_base.BaseStorageAdapter.add_listener`)::
+
+    from doqu.utils.instrumentation import StatsCollector
+
+    stats = StatsCollector(slow_query_threshold=0.5)
+    db.add_listener(stats)
+    ...
+    print stats.percentiles('query')    # {50: 0.002, 90: 0.013, 99: 0.41}
+    print stats.slow_queries
+
+A query is reported when its results are fetched. The event is finished when
+all results have been fetched or, if they are not consumed completely, when
+the query object is garbage-collected. Ranges fetched without caching (e.g.
+slices on some backends), uncached iteration (see
+:meth:`~doqu.utils.data_structures.CachedIterator.iterator`), `count()` and
+`values()` are reported as separate queries.
+
+The overhead is negligible when no listeners are attached.
+"""
+from collections import deque
+from functools import wraps
+import logging
+import math
+import threading
+import time
+import weakref
+
+
+__all__ = ['Event', 'Listener', 'StatsCollector']
+
+
+# number of most recent durations kept by StatsCollector for each kind
+DEFAULT_HISTORY_SIZE = 10000
+
+# number of most recent slow queries kept by StatsCollector
+DEFAULT_SLOW_QUERY_LOG_SIZE = 100
+
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+
+log = logging.getLogger(__name__)
+
+# events measured in current thread; the innermost one gets the decoding time
+_local = threading.local()
+
+
+class Event(object):
+    """
+    Describes a single operation performed by a storage adapter.
+
+    :param kind:
+        `query`, `get`, `save` or `delete`.
+    :param storage:
+        the storage adapter.
+    :param model:
+        the document class (if known).
+    :param conditions:
+        backend-specific query conditions (for queries).
+    :param operation:
+        for queries: the method that caused the fetch (e.g. `count`).
+
+    The timings (in seconds) are updated while the operation is in progress:
+
+    * `duration`: total time spent inside Doqu and the backend library;
+    * `decorate_time`: converting raw records to Python values;
+    * `validation_time`: creating and validating the documents;
+    * `io_time`: the rest of the time, i.e. the backend I/O.
+
+    Other attributes: `started` (timestamp), `rows` (number of records),
+    `cache_hit` (`True` or `False` if the query result cache was checked,
+    `None` otherwise) and `finished`.
+    """
+    def __init__(self, kind, storage, model=None, conditions=None,
+                 operation=None):
+        self.kind = kind
+        self.storage = storage
+        self.model = model
+        self.conditions = conditions
+        self.operation = operation
+        self.started = time.time()
+        self.duration = 0.0
+        self.decorate_time = 0.0
+        self.validation_time = 0.0
+        self.rows = 0
+        self.cache_hit = None
+        self.finished = False
+        # the query object is not referenced to let it be garbage-collected
+        self._query_id = None
+
+    def __repr__(self):
+        return ('<Event {0.kind} {1} {0.duration:.6f}s {0.rows} rows '
+                '{0.conditions!r}>').format(
+                    self, self.model.__name__ if self.model else None)
+
+    @property
+    def io_time(self):
+        return max(0.0, self.duration - self.decorate_time -
+                        self.validation_time)
+
+
+class Listener(object):
+    """
+    Base class for listeners. Subclasses override the methods they need.
+    The methods can be called from any thread that uses the storage.
+    """
+    def query_started(self, event):
+        "Called when a query starts fetching the results."
+
+    def query_finished(self, event):
+        "Called when a query is finished (see :class:`Event`)."
+
+    def operation_finished(self, event):
+        "Called after a `get`, `save` or `delete` call."
+
+
+class StatsCollector(Listener):
+    """
+    A listener that keeps statistics in memory: durations of recent
+    operations (for percentiles), counters, the query cache hit rate and a
+    log of slow queries.
+
+    :param history_size:
+        number of most recent durations kept for each kind of operation.
+    :param slow_query_threshold:
+        queries that take longer (in seconds) are added to `slow_queries`
+        and logged with the `doqu.utils.instrumentation` logger. `None`
+        disables the log.
+
+    """
+    def __init__(self, history_size=DEFAULT_HISTORY_SIZE,
+                 slow_query_threshold=None,
+                 slow_query_log_size=DEFAULT_SLOW_QUERY_LOG_SIZE):
+        self.history_size = history_size
+        self.slow_query_threshold = slow_query_threshold
+        self._lock = threading.Lock()
+        self.slow_queries = deque(maxlen=slow_query_log_size)
+        self.reset()
+
+    def _add(self, event):
+        with self._lock:
+            if event.kind not in self._durations:
+                self._durations[event.kind] = deque(maxlen=self.history_size)
+                self._totals[event.kind] = [0, 0.0, 0]
+            self._durations[event.kind].append(event.duration)
+            totals = self._totals[event.kind]
+            totals[0] += 1
+            totals[1] += event.duration
+            totals[2] += event.rows
+            if event.cache_hit is not None:
+                self._cache[event.cache_hit] += 1
+
+    def query_finished(self, event):
+        self._add(event)
+        threshold = self.slow_query_threshold
+        if threshold is not None and threshold <= event.duration:
+            self.slow_queries.append(event)
+            log.warning('slow query (%.3fs, %d rows): %r', event.duration,
+                        event.rows, event.conditions)
+
+    def operation_finished(self, event):
+        self._add(event)
+
+    @property
+    def cache_hit_rate(self):
+        "Share of queries served from the query cache (`None` if unknown)."
+        checked = self._cache[True] + self._cache[False]
+        return float(self._cache[True]) / checked if checked else None
+
+    def percentiles(self, kind='query', points=DEFAULT_PERCENTILES):
+        """
+        Returns a dictionary of percentiles (nearest rank) of durations of
+        recent operations of given kind, e.g. ``{50: 0.002, 99: 0.41}``.
+        """
+        with self._lock:
+            durations = sorted(self._durations.get(kind, []))
+        if not durations:
+            return {}
+        result = {}
+        for point in points:
+            rank = int(math.ceil(point / 100.0 * len(durations))) - 1
+            result[point] = durations[min(max(rank, 0), len(durations) - 1)]
+        return result
+
+    def reset(self):
+        "Forgets collected statistics."
+        with self._lock:
+            self._durations = {}      # kind --> recent durations
+            self._totals = {}         # kind --> [count, duration, rows]
+            self._cache = {True: 0, False: 0}
+            self.slow_queries.clear()
+
+    def summary(self):
+        """
+        Returns a dictionary with statistics for each kind of operation
+        (count, total time, rows, percentiles) and the cache hit rate.
+        """
+        with self._lock:
+            totals = dict((k, list(v)) for k, v in self._totals.iteritems())
+        result = {'cache_hit_rate': self.cache_hit_rate}
+        for kind, (count, duration, rows) in totals.iteritems():
+            result[kind] = dict(count=count, duration=duration, rows=rows,
+                                percentiles=self.percentiles(kind))
+        return result
+
+
+#------------------+
+#  Internal hooks  |
+#------------------+
+
+def _get_stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+def _notify(storage, method_name, event):
+    for listener in list(storage._listeners):
+        getattr(listener, method_name)(event)
+
+def _finish_query(event):
+    if not event.finished:
+        event.finished = True
+        _notify(event.storage, 'query_finished', event)
+
+def _start_query(query, operation):
+    event = Event('query', query.storage, getattr(query, 'model', None),
+                  conditions=getattr(query, '_conditions', None),
+                  operation=operation)
+    event._query_id = id(query)
+    _notify(query.storage, 'query_started', event)
+    return event
+
+def _measure(event, func, *args, **kwargs):
+    stack = _get_stack()
+    stack.append(event)
+    started = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        event.duration += time.time() - started
+        stack.pop()
+
+def _is_listening(obj):
+    storage = getattr(obj, 'storage', None)
+    return bool(storage is not None and storage._listeners)
+
+def _is_nested(query):
+    # e.g. values() iterates the same query
+    stack = _get_stack()
+    return bool(stack) and stack[-1]._query_id == id(query)
+
+def observed(method=None, standalone=True):
+    """
+    Decorator for query adapter methods that fetch data. Reports the calls
+    to the storage listeners (if any).
+
+    :param standalone:
+        if `True`, each call is a separate query. Otherwise the calls are
+        parts of a single query that is finished when the results are
+        exhausted (i.e. the query's `_iter` attribute is `None`).
+
+    """
+    if method is None:
+        return lambda method: observed(method, standalone)
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not _is_listening(self) or _is_nested(self):
+            return method(self, *args, **kwargs)
+        if standalone:
+            event = _start_query(self, method.__name__)
+        else:
+            event = self.__dict__.get('_execution')
+            if event is None:
+                event = self._execution = _start_query(self, 'fetch')
+                # report the fetched part if the results are not consumed
+                # completely; the reference lives as long as the event
+                event._ref = weakref.ref(self,
+                                         lambda ref: _finish_query(event))
+        try:
+            return _measure(event, method, self, *args, **kwargs)
+        finally:
+            if standalone or self._iter is None:
+                _finish_query(event)
+    return wrapper
+
+def observe_iterator(query, items):
+    """
+    Returns an iterator over given items fetched by given query (without
+    caching); the iteration is reported as a query.
+    """
+    if not _is_listening(query) or _is_nested(query):
+        return items
+    return _observe_iterator(_start_query(query, 'iterator'), iter(items))
+
+def _observe_iterator(event, items):
+    try:
+        while True:
+            # StopIteration ends the generator
+            item = _measure(event, items.next)
+            yield item
+    finally:
+        _finish_query(event)
+
+def record_decoding(decorate_time, validation_time):
+    "Adds the time spent on converting a record to current operation."
+    stack = _get_stack()
+    if stack:
+        event = stack[-1]
+        event.rows += 1
+        event.decorate_time += decorate_time
+        event.validation_time += validation_time
+
+def record_cache_hit(hit):
+    "Tells current operation whether its result was taken from the cache."
+    stack = _get_stack()
+    if stack:
+        stack[-1].cache_hit = hit
+
+def _make_timed(storage, kind, method):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        stack = _get_stack()
+        if stack and stack[-1].kind == 'query':
+            # e.g. the records fetched by a query are decorated by get();
+            # the time is already counted
+            return method(*args, **kwargs)
+        model = args[0] if kind == 'get' and args else None
+        event = Event(kind, storage, model)
+        result = _measure(event, method, *args, **kwargs)
+        if kind != 'get':
+            event.rows = 1
+        event.finished = True
+        _notify(storage, 'operation_finished', event)
+        return result
+    return wrapper
+
+# storage adapter methods timed when listeners are attached
+TIMED_METHODS = ('get', 'save', 'delete')
+
+def instrument(storage):
+    "Starts timing the storage operations (called when adding a listener)."
+    for name in TIMED_METHODS:
+        method = getattr(storage, name)
+        setattr(storage, name, _make_timed(storage, name, method))
+
+def uninstrument(storage):
+    "Stops timing the storage operations."
+    for name in TIMED_METHODS:
+        if name in storage.__dict__:
+            delattr(storage, name)
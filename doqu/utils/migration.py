@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+#
+#    Doqu is a lightweight schema/query framework for document databases.
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of Docu.
+#
+#    Doqu is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Doqu is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with Docu.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Migration
+=========
+
+Bulk copying of records from one storage to another (e.g. from Tokyo Tyrant
+to MongoDB). Unlike :meth:`~doqu.document_base.Document.save_as`, the records
+are streamed without caching and saved in batches; the values are decoded by
+the source storage and encoded by the destination storage, and the primary
+keys are preserved::
+
+    from doqu.utils import migrate
+
+    migrate(tyrant_db, mongo_db, [Person, Note], checkpoint='migration.json')
+
+The same can be done from the command line (the document classes are
+optional)::
+
+    $ doqu-migrate backend=doqu.ext.tokyo_tyrant,port=1978 \\
+                   backend=doqu.ext.mongodb,database=test \\
+                   -d myapp.models.Person -c migration.json
+
+"""
+from collections import deque
+from itertools import islice
+import json
+import optparse
+import os
+import sys
+
+from concurrency import WorkerPool
+
+
+__all__ = ['migrate']
+
+
+# number of records sent to the destination storage at once
+DEFAULT_BATCH_SIZE = 1000
+
+
+#-----------+
+#  Helpers  |
+#-----------+
+
+def _read_checkpoint(path):
+    "Returns a dictionary: document class name --> number of copied records."
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+def _write_checkpoint(path, state):
+    # the file is replaced atomically so that an interrupted migration never
+    # leaves a broken checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, path)
+
+def _encode(document, dst):
+    """
+    Returns the data of given document (fetched from the source storage)
+    prepared for saving into given destination storage.
+    """
+    # FIXME access to private attributes (same as in Document.save)
+    data = dict(document._saved_state.data or {})
+    structure = document.meta.structure
+    for name in (structure or document._data):
+        value = document._data.get(name)
+        data[name] = document._encode_value(dst, name, value)
+    return data
+
+def _get_batches(documents, dst, batch):
+    while True:
+        chunk = [(document.pk, _encode(document, dst))
+                 for document in islice(documents, batch)]
+        if not chunk:
+            break
+        yield chunk
+
+
+#--------------+
+#  Public API  |
+#--------------+
+
+def migrate(src, dst, doc_classes=None, batch=DEFAULT_BATCH_SIZE, workers=1,
+            checkpoint=None, progress=None):
+    """
+    Copies records from one storage adapter to another. Returns the number of
+    copied records. Existing records with the same primary keys are
+    overwritten in the destination storage.
+
+    :param doc_classes:
+        a list of document classes. Fields declared in the structure are
+        converted to Python values by the source storage and back by the
+        destination storage; other fields are copied as is. If not given, all
+        records are copied and all values are converted as if they were not
+        declared.
+    :param batch:
+        number of records sent to the destination storage at once (see
+        :meth:`~doqu.backend_base.BaseStorageAdapter.save_many`).
+    :param workers:
+        number of threads that save the batches while the next ones are being
+        read. Raises `ValueError` if more than one worker is requested for a
+        destination storage that is not thread-safe.
+    :param checkpoint:
+        path to a file where the progress is stored after each batch. If the
+        migration is interrupted, it is resumed from the last saved batch.
+        This requires that the source storage is not modified in between
+        (the records are skipped by their position). The file is removed when
+        the migration is complete.
+    :param progress:
+        a function that is called with the document class and the number of
+        records of that class copied so far after each batch.
+
+    """
+    if doc_classes is None:
+        # imported here to avoid circular dependencies
+        from doqu.document_base import Document
+        doc_classes = [Document]
+    if 1 < workers and not dst.is_thread_safe:
+        raise ValueError('Storage adapter {0} is not thread-safe and cannot '
+                         'be used by multiple workers.'.format(
+                             type(dst).__name__))
+
+    state = _read_checkpoint(checkpoint)
+    pool = WorkerPool(workers)
+    total = 0
+    try:
+        for doc_class in doc_classes:
+            name = doc_class.__name__
+            done = state.get(name, 0)
+            documents = doc_class.objects(src).iterator()
+            # skip records copied before the interruption
+            documents = islice(documents, done, None)
+            pending = deque()
+
+            def collect():
+                # batches are completed in the order they were submitted,
+                # so the checkpoint always covers a contiguous range
+                future, size = pending.popleft()
+                future.result()
+                state[name] = state.get(name, 0) + size
+                if checkpoint:
+                    _write_checkpoint(checkpoint, state)
+                if progress:
+                    progress(doc_class, state[name])
+                return size
+
+            for chunk in _get_batches(documents, dst, batch):
+                pending.append((pool.submit(dst.save_many, chunk), len(chunk)))
+                # limit the number of batches held in memory
+                while workers * 2 <= len(pending):
+                    total += collect()
+            while pending:
+                total += collect()
+    finally:
+        pool.shutdown()
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return total
+
+
+#--------------------------+
+#  Command-line interface  |
+#--------------------------+
+
+def _parse_settings(text):
+    """
+    Returns a settings dictionary for :func:`~doqu.utils.get_db` parsed from
+    a string like ``backend=doqu.ext.shelve_db,path=test.db``. Numeric values
+    are converted to integers.
+    """
+    settings = {}
+    for pair in text.split(','):
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise ValueError('expected key=value, got "{0}"'.format(pair))
+        settings[key.strip()] = int(value) if value.isdigit() else value
+    return settings
+
+def _import_class(path):
+    "Returns the object (e.g. a document class) by given dotted path."
+    module_name, sep, name = path.rpartition('.')
+    if not sep:
+        raise ValueError('expected a dotted path, got "{0}"'.format(path))
+    __import__(module_name)
+    return getattr(sys.modules[module_name], name)
+
+def main(argv=None):
+    "Entry point for the `doqu-migrate` command."
+    # imported here to avoid circular dependencies
+    from doqu.utils import get_db
+
+    parser = optparse.OptionParser(
+        usage='%prog [options] SOURCE DESTINATION',
+        description='Copies records between storages. SOURCE and DESTINATION '
+                    'are comma-separated settings, e.g. '
+                    'backend=doqu.ext.shelve_db,path=test.db')
+    parser.add_option('-d', '--document', dest='documents', action='append',
+                      metavar='PATH', help='dotted path to a document class '
+                      '(can be repeated; by default all records are copied)')
+    parser.add_option('-b', '--batch', type='int', default=DEFAULT_BATCH_SIZE,
+                      help='number of records saved at once [%default]')
+    parser.add_option('-w', '--workers', type='int', default=1,
+                      help='number of saving threads [%default]')
+    parser.add_option('-c', '--checkpoint', metavar='FILE',
+                      help='file to store the progress in and resume from')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+                      help='do not report progress')
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('expected SOURCE and DESTINATION')
+
+    try:
+        src, dst = [get_db(_parse_settings(x)) for x in args]
+        doc_classes = None
+        if options.documents:
+            doc_classes = [_import_class(x) for x in options.documents]
+    except (ValueError, ImportError, AttributeError) as e:
+        parser.error(e)
+
+    def report(doc_class, count):
+        sys.stderr.write('{0}: {1}\n'.format(doc_class.__name__, count))
+
+    total = migrate(src, dst, doc_classes, batch=options.batch,
+                    workers=options.workers, checkpoint=options.checkpoint,
+                    progress=None if options.quiet else report)
+    if not options.quiet:
+        sys.stderr.write('Copied {0} records.\n'.format(total))
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+#
+#    Doqu is a lightweight schema/query framework for document databases.
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of Docu.
+#
+#    Doqu is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Doqu is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with Docu.  If not, see <http://gnu.org/licenses/>.
+
+"""
+Data transfer
+=============
+
+Streaming export and import of records in backend-agnostic formats. The
+records are processed one by one (and written in batches), so memory
+consumption does not depend on the size of the dataset::
+
+    from doqu.utils import dump, load
+
+    with open('people.jsonl', 'w') as f:
+        dump(tyrant_db, Person, f)
+
+    with open('people.jsonl') as f:
+        load(mongo_db, f, doc_class=Person)
+
+Supported formats:
+
+* `jsonl` (JSON Lines): one JSON object per line;
+* `csv`: a header row with field names and one row per record (UTF-8).
+
+The primary key is stored in the field `_key`. Dates, times and decimals are
+written as ISO-formatted strings; when loading, they are converted back to
+the types declared in the document class (if given). Fields with outgoing
+processors (e.g. pickled ones) are written in serialized form; when loading,
+they are processed in both directions, as if the documents were fetched and
+saved again.
+"""
+import csv
+import datetime
+import decimal
+import json
+from itertools import islice
+
+
+__all__ = ['dump', 'load']
+
+
+# name of the field which contains the primary key
+KEY_FIELD = '_key'
+
+# number of records written to the storage at once
+DEFAULT_BATCH_SIZE = 10000
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+TIME_FORMATS = ('%H:%M:%S.%f', '%H:%M:%S')
+
+
+#-----------------------+
+#  Value serialization  |
+#-----------------------+
+
+def _to_json(value):
+    "Converts values which are not supported by JSON (see `json.dumps`)."
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if hasattr(value, 'pk'):
+        # a reference to another document
+        return value.pk
+    raise TypeError('{0} is not JSON serializable'.format(repr(value)))
+
+def _serialize(meta, name, value):
+    "Applies the outgoing processor of given field (if any) to given value."
+    # symmetric with _deserialize
+    if name in meta.outgoing_processors and value is not None:
+        value = meta.outgoing_processors[name](value)
+    return value
+
+def _deserialize(storage, meta, name, value):
+    """
+    Converts given value (as read from a dump) of given field to the native
+    format of given storage. The value is decoded as if it was fetched from a
+    storage and then encoded as :meth:`~doqu.document_base.Document.save`
+    would do it.
+    """
+    # symmetric with doqu.backend_base.BaseStorageAdapter._convert_from_db
+    if name not in meta.skip_type_conversion:
+        value = _from_text(meta.structure.get(name), value)
+    if name in meta.incoming_processors and value is not None:
+        value = meta.incoming_processors[name](value)
+    # symmetric with doqu.document_base.Document._encode_value
+    value = _serialize(meta, name, value)
+    if name in meta.skip_type_conversion:
+        return value
+    return storage.value_to_db(value)
+
+def _to_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value, default=_to_json)
+    if isinstance(value, (basestring, bool, int, long)):
+        return str(value)
+    return _to_cell(_to_json(value))
+
+def _parse_datetime(value, formats):
+    for fmt in formats:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('could not parse date/time "{0}"'.format(value))
+
+def _from_text(datatype, value):
+    """
+    Converts given value (as read from a dump) to given datatype. Values of
+    unknown datatypes are returned as is.
+    """
+    if value is None or not isinstance(datatype, type):
+        return value
+    if isinstance(value, datatype) and not isinstance(value, bool):
+        return value
+    if issubclass(datatype, datetime.datetime):
+        return _parse_datetime(value, DATETIME_FORMATS)
+    if issubclass(datatype, datetime.date):
+        return _parse_datetime(value, ('%Y-%m-%d',)).date()
+    if issubclass(datatype, datetime.time):
+        return _parse_datetime(value, TIME_FORMATS).time()
+    if issubclass(datatype, bool):
+        if isinstance(value, basestring):
+            return value.lower() in ('true', '1', 'yes')
+        return bool(value)
+    if issubclass(datatype, (int, long, float, decimal.Decimal)):
+        return datatype(value)
+    if issubclass(datatype, unicode):
+        return unicode(value)
+    if issubclass(datatype, str):
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+    if issubclass(datatype, (list, dict)) and isinstance(value, basestring):
+        return json.loads(value)
+    return value
+
+
+#-----------+
+#  Formats  |
+#-----------+
+
+def _write_jsonl(fp, names, records):
+    for primary_key, data in records:
+        item = dict(data)
+        item[KEY_FIELD] = primary_key
+        fp.write(json.dumps(item, default=_to_json, sort_keys=True) + '\n')
+        yield
+
+def _read_jsonl(fp):
+    for line in fp:
+        if line.strip():
+            yield json.loads(line)
+
+def _write_csv(fp, names, records):
+    if names is None:
+        raise ValueError('CSV format requires a document structure')
+    writer = csv.writer(fp)
+    writer.writerow([KEY_FIELD] + names)
+    for primary_key, data in records:
+        writer.writerow([_to_cell(primary_key)] +
+                        [_to_cell(data.get(name)) for name in names])
+        yield
+
+def _read_csv(fp):
+    reader = csv.reader(fp)
+    header = [name.decode('utf-8') for name in reader.next()]
+    for row in reader:
+        # empty cells mean missing values
+        yield dict((name, cell.decode('utf-8') if cell else None)
+                   for name, cell in zip(header, row))
+
+# format name --> (writer, reader)
+FORMATS = {
+    'jsonl': (_write_jsonl, _read_jsonl),
+    'csv': (_write_csv, _read_csv),
+}
+
+def _get_format(name):
+    try:
+        return FORMATS[name]
+    except KeyError:
+        raise ValueError('unknown format "{0}"'.format(name))
+
+
+#--------------+
+#  Public API  |
+#--------------+
+
+def dump(storage, doc_class, fp, format='jsonl', progress=None,
+         progress_every=DEFAULT_BATCH_SIZE):
+    """
+    Writes all records of given document class from given storage to given
+    file-like object. Returns the number of written records. The records are
+    fetched without caching (see
+    :meth:`~doqu.backend_base.BaseQueryAdapter.iterator`).
+
+    :param format:
+        `jsonl` or `csv`. The CSV format requires a document class with
+        defined structure.
+    :param progress:
+        a function that is called with the number of records written so far
+        (each `progress_every` records and in the end).
+
+    """
+    writer, _ = _get_format(format)
+    meta = doc_class.meta
+    names = sorted(meta.structure) or None
+
+    def get_records():
+        for document in doc_class.objects(storage).iterator():
+            # FIXME access to private attribute; we need the values as is
+            # (e.g. without resolving references)
+            data = document._data
+            yield document.pk, dict(
+                (name, _serialize(meta, name, data.get(name)))
+                for name in names or data)
+
+    count = 0
+    for _ in writer(fp, names, get_records()):
+        count += 1
+        if progress and not count % progress_every:
+            progress(count)
+    if progress:
+        progress(count)
+    return count
+
+def load(storage, fp, format='jsonl', doc_class=None,
+         batch=DEFAULT_BATCH_SIZE, progress=None):
+    """
+    Reads records from given file-like object and saves them to given
+    storage. Returns the number of saved records. The records are saved in
+    batches via :meth:`~doqu.backend_base.BaseStorageAdapter.save_many` (which
+    some backends implement much more efficiently than separate saves).
+    Primary keys are preserved if present.
+
+    .. note::
+
+        the records are neither validated nor filled with default values.
+
+    :param format:
+        `jsonl` or `csv`.
+    :param doc_class:
+        if given, the values are converted to datatypes declared in the
+        document class structure and passed through the field processors
+        (e.g. pickled fields are unpickled and pickled again). Recommended for CSV (otherwise all values
+        are saved as strings).
+    :param batch:
+        number of records sent to the storage at once.
+    :param progress:
+        a function that is called with the number of records saved so far
+        after each batch.
+
+    """
+    _, reader = _get_format(format)
+    meta = doc_class.meta if doc_class else None
+
+    def get_items():
+        for item in reader(fp):
+            primary_key = item.pop(KEY_FIELD, None)
+            data = {}
+            for name, value in item.iteritems():
+                if meta:
+                    data[name] = _deserialize(storage, meta, name, value)
+                else:
+                    data[name] = storage.value_to_db(value)
+            yield primary_key, data
+
+    items = get_items()
+    count = 0
+    while True:
+        chunk = list(islice(items, batch))
+        if not chunk:
+            break
+        storage.save_many(chunk)
+        count += len(chunk)
+        if progress:
+            progress(count)
+    return count
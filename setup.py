@@ -51,6 +51,7 @@ setup(
         'Shove': ['shove>=0.2.1'],
         'Mongo': ['pymongo>=1.7'],
         'WTForms': ['wtforms>=0.6.1dev'],  # 0.6 has bug in dateutil ext
+        'NumPy': ['numpy'],    # for query.to_columns()
     },
     entry_points = {
         'extensions': [
@@ -60,6 +61,9 @@ setup(
             'mongo = doqu.ext.mongodb [Mongo]',
             'wtforms = doqu.ext.forms [WTForms]',
         ],
+        'console_scripts': [
+            'doqu-migrate = doqu.utils.migration:main',
+        ],
     },
 
     # copyright
@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import shutil
+import tempfile
 import unittest
 
-from doqu import Document
+from doqu import Document, get_db
 from doqu import validators
 
 
@@ -191,6 +194,66 @@ class StateTestCase(unittest.TestCase):
         pass
 
 
+class ChangedFieldsTestCase(unittest.TestCase):
+    "Tracking of changed fields and partial updates"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = get_db(backend='doqu.ext.shelve_db',
+                         path=os.path.join(self.tmp_dir, 'test.db'))
+
+    def tearDown(self):
+        self.db.disconnect()
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_doc_class(self):
+        class Doc(Document):
+            structure = {'name': unicode, 'count': int}
+        return Doc
+
+    def test_unsaved(self):
+        "all fields are considered changed until the document is saved"
+        Doc = self._make_doc_class()
+        doc = Doc(name=u'foo')
+        self.assertEqual(doc.get_changed_fields(), set(['name', 'count']))
+        assert doc.is_field_changed('count')
+
+    def test_tracking(self):
+        "assignments are tracked since the document was fetched or saved"
+        Doc = self._make_doc_class()
+        doc = Doc(name=u'foo', count=1)
+        doc.save(self.db)
+        self.assertEqual(doc.get_changed_fields(), set())
+        doc.count = 2
+        self.assertEqual(doc.get_changed_fields(), set(['count']))
+        fetched = self.db.get(Doc, doc.pk)
+        self.assertEqual(fetched.get_changed_fields(), set())
+
+    def test_partial_update(self):
+        "only changed fields are written, other fields in record are kept"
+        Doc = self._make_doc_class()
+        doc = Doc(name=u'foo', count=1)
+        pk = doc.save(self.db)
+        # the record is modified behind our back
+        record = self.db.connection[pk]
+        record['name'] = u'bar'
+        self.db.connection[pk] = record
+        doc.count = 2
+        self.assertEqual(doc.save(only_changed=True), pk)
+        self.assertEqual(self.db.connection[pk],
+                         {'name': u'bar', 'count': 2})
+        self.assertEqual(doc.get_changed_fields(), set())
+
+    def test_partial_update_nothing_changed(self):
+        "the storage is not accessed if nothing was changed"
+        Doc = self._make_doc_class()
+        doc = Doc(name=u'foo', count=1)
+        pk = doc.save(self.db)
+        del self.db.connection[pk]
+        self.assertEqual(doc.save(only_changed=True), pk)
+        assert pk not in self.db
+
+
 class ReferenceTestCase(unittest.TestCase):
     "References between documents"
 
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the MongoDB backend. A server is not needed: the `pymongo` module
+is replaced by a small in-memory stub.
+"""
+import sys
+import types
+import unittest
+
+from doqu import Document, dist
+from doqu.fields import Field
+from doqu.validators import Exists
+
+
+#------------------+
+#  pymongo stub    |
+#------------------+
+
+OPERATORS = {
+    '$gt':  lambda a, b: a is not None and a > b,
+    '$gte': lambda a, b: a is not None and a >= b,
+    '$lt':  lambda a, b: a is not None and a < b,
+    '$lte': lambda a, b: a is not None and a <= b,
+    '$in':  lambda a, b: a in b,
+    '$ne':  lambda a, b: a != b,
+}
+
+def matches(spec, data):
+    for name, clause in (spec or {}).iteritems():
+        value = data.get(name)
+        if isinstance(clause, dict):
+            if not all(OPERATORS[op](value, x) for op, x in clause.items()):
+                return False
+        elif value != clause:
+            return False
+    return True
+
+
+class Cursor(object):
+    def __init__(self, collection, spec, skip=0, limit=0, sort=None,
+                 fields=None):
+        self.collection = collection
+        self.spec = spec
+        self.skip = skip
+        self.limit = limit
+        self.sort = sort
+        self.size = None
+
+    def _get_results(self):
+        results = [dict(x) for x in self.collection.docs
+                   if matches(self.spec, x)]
+        for name, direction in reversed(self.sort or []):
+            results.sort(key=lambda x: x.get(name), reverse=direction < 0)
+        results = results[self.skip:]
+        return results[:self.limit] if self.limit else results
+
+    def __iter__(self):
+        # like a real cursor, the query is sent on first access
+        self.collection.fetches.append((self.skip, self.limit, self.size))
+        for data in self._get_results():
+            yield data
+
+    def batch_size(self, size):
+        self.size = size
+        return self
+
+    def count(self):
+        return len([x for x in self.collection.docs if matches(self.spec, x)])
+
+    def explain(self):
+        return {'cursor': 'BasicCursor', 'nscanned': len(self.collection.docs)}
+
+
+class Collection(object):
+    def __init__(self, name):
+        self.name = name
+        self.docs = []
+        self.fetches = []    # (skip, limit, batch size) of iterated cursors
+        self.indexes = {'_id_': {'key': [('_id', 1)]}}
+
+    def count(self):
+        return len(self.docs)
+
+    def create_index(self, spec, name=None):
+        self.indexes[name] = {'key': list(spec)}
+
+    def find(self, spec=None, **kwargs):
+        return Cursor(self, spec, **kwargs)
+
+    def find_one(self, spec):
+        for data in self.docs:
+            if matches(spec, data):
+                return dict(data)
+
+    def index_information(self):
+        return self.indexes
+
+    def remove(self, spec=None):
+        self.docs = [x for x in self.docs if spec and not matches(spec, x)]
+
+    def save(self, data):
+        data = dict(data)
+        data.setdefault('_id', u'id{0}'.format(len(self.docs)))
+        self.remove({'_id': data['_id']})
+        self.docs.append(data)
+        return data['_id']
+
+    def update(self, spec, changes, multi=False):
+        for data in self.docs:
+            if matches(spec, data):
+                for name, by in changes.get('$inc', {}).items():
+                    data[name] = data.get(name, 0) + by
+                data.update(changes.get('$set', {}))
+
+
+class Connection(object):
+    instances = []
+
+    def __init__(self, host, port, **options):
+        self.closed = False
+        self.databases = {}
+        Connection.instances.append(self)
+
+    def __getitem__(self, name):
+        collections = self.databases.setdefault(name, {})
+        database = type('Database', (dict,), {
+            '__missing__': lambda d, k: d.setdefault(k, Collection(k)),
+            'name': name})
+        return collections.setdefault('__db__', database())
+
+    def disconnect(self):
+        self.closed = True
+
+
+def make_pymongo():
+    module = types.ModuleType('pymongo')
+    module.ASCENDING = 1
+    module.DESCENDING = -1
+    module.Connection = Connection
+    module.objectid = types.ModuleType('pymongo.objectid')
+    module.objectid.ObjectId = type('ObjectId', (object,), {})
+    return module
+
+def import_backend():
+    "Imports the backend without the real library and its entry point."
+    check_dependencies = dist.check_dependencies
+    dist.check_dependencies = lambda *args, **kwargs: None
+    real = sys.modules.get('pymongo')
+    sys.modules['pymongo'] = make_pymongo()
+    try:
+        import doqu.ext.mongodb as backend
+    finally:
+        dist.check_dependencies = check_dependencies
+        if real is None:
+            del sys.modules['pymongo']
+        else:
+            sys.modules['pymongo'] = real
+    return backend
+
+mongodb = import_backend()
+
+
+#---------+
+#  Tests  |
+#---------+
+
+class Item(Document):
+    name = Field(unicode)
+    count = Field(int)
+
+
+class MongoTestCase(unittest.TestCase):
+    def setUp(self):
+        self._pymongo = mongodb.pymongo
+        mongodb.pymongo = make_pymongo()
+        mongodb._connections.clear()
+        Connection.instances = []
+        self.db = mongodb.StorageAdapter(database='test', collection='items')
+        for i in range(5):
+            Item(name=u'item {0}'.format(i), count=i).save(self.db)
+
+    def tearDown(self):
+        if self.db.connection is not None:
+            self.db.disconnect()
+        mongodb.pymongo = self._pymongo
+
+
+class ConnectionTestCase(MongoTestCase):
+    "Connections are shared between adapters and reference-counted"
+
+    def test_shared(self):
+        other = mongodb.StorageAdapter(database='test', collection='other')
+        self.assertEqual(len(Connection.instances), 1)
+        self.assertEqual(mongodb._connections.values(),
+                         [[Connection.instances[0], 2]])
+        other.disconnect()
+        self.assertFalse(Connection.instances[0].closed)
+        self.db.disconnect()
+        self.assertTrue(Connection.instances[0].closed)
+        self.assertEqual(mongodb._connections, {})
+
+    def test_different_options(self):
+        other = mongodb.StorageAdapter(database='test', port=27018)
+        self.assertEqual(len(Connection.instances), 2)
+        other.disconnect()
+        self.assertEqual(len(mongodb._connections), 1)
+
+    def test_connect_twice(self):
+        self.db.connect()
+        self.assertEqual(mongodb._connections.values()[0][1], 1)
+        self.db.disconnect()
+        self.assertEqual(mongodb._connections, {})
+
+    def test_disconnect_twice(self):
+        other = mongodb.StorageAdapter(database='test', collection='other')
+        self.db.disconnect()
+        self.db.disconnect()
+        # the connection is still used by the other adapter
+        self.assertEqual(mongodb._connections.values()[0][1], 1)
+        self.assertFalse(Connection.instances[0].closed)
+        other.disconnect()
+
+    def test_reconnect(self):
+        self.db.reconnect()
+        self.assertEqual(len(Connection.instances), 2)
+        self.assertTrue(Connection.instances[0].closed)
+        self.assertEqual(mongodb._connections.values(),
+                         [[Connection.instances[1], 1]])
+
+
+class UpdateTestCase(MongoTestCase):
+    "In-place updates of records matching a query"
+
+    def test_increment(self):
+        Item.objects(self.db).where(count__gte=3).increment('count', 10)
+        counts = sorted(x.count for x in Item.objects(self.db))
+        self.assertEqual(counts, [0, 1, 2, 13, 14])
+
+    def test_unknown_field(self):
+        query = Item.objects(self.db)
+        self.assertRaises(KeyError, lambda: query.update(foo=1))
+        self.assertRaises(KeyError, lambda: query.increment('foo'))
+
+
+class IndexTestCase(MongoTestCase):
+    "Indexes derived from the document metadata"
+
+    class Person(Document):
+        structure = {'name': unicode, 'age': int, 'tags': list}
+        validators = {'name': [Exists()]}
+        indexes = {'tags': None}
+
+    def test_dry_run(self):
+        expected = {
+            'name_1_age_1': [('name', 1), ('age', 1)],
+            'tags_1': [('tags', 1)],
+        }
+        created = self.db.ensure_indexes(self.Person, order_by=['age'],
+                                         dry_run=True)
+        # the filter index is a prefix of the ordering one
+        self.assertEqual(created, expected)
+        self.assertEqual(self.db.connection.indexes.keys(), ['_id_'])
+
+        created = self.db.ensure_indexes(self.Person, order_by=['age'])
+        self.assertEqual(created, expected)
+        self.assertEqual(sorted(self.db.connection.indexes),
+                         ['_id_', 'name_1_age_1', 'tags_1'])
+        # nothing left to do
+        self.assertEqual(self.db.ensure_indexes(self.Person, dry_run=True), {})
+
+
+class QueryTestCase(MongoTestCase):
+    "Slicing and batching are delegated to the cursor"
+
+    def setUp(self):
+        super(QueryTestCase, self).setUp()
+        self.collection = self.db.connection
+
+    def test_slice(self):
+        query = Item.objects(self.db).order_by('count')
+        self.assertEqual([x.count for x in query[1:3]], [1, 2])
+        self.assertEqual(query[4].count, 4)
+        self.assertEqual([x.count for x in query[3:]], [3, 4])
+        # nothing was fetched beyond the requested ranges
+        self.assertEqual(self.collection.fetches,
+                         [(1, 2, None), (4, 1, None), (3, 0, None)])
+
+    def test_batch_size(self):
+        query = Item.objects(self.db).batch_size(2)
+        self.assertEqual(len(list(query)), 5)
+        self.assertEqual(self.collection.fetches, [(0, 0, 2)])
+        # the setting survives further filtering
+        query = query.where(count__gte=1).order_by('count')
+        self.assertEqual([x.count for x in query[:2]], [1, 2])
+        self.assertEqual(self.collection.fetches[-1], (0, 2, 2))
+
+
+class PrefetchTestCase(MongoTestCase):
+    "Records are fetched in background"
+
+    def test_prefetch(self):
+        query = Item.objects(self.db).order_by('count').prefetch(depth=1)
+        query._chunk_size = 2
+        self.assertEqual([x.count for x in query], [0, 1, 2, 3, 4])
+        self.assertEqual(query[3].count, 3)
+
+    def test_abandoned_loop(self):
+        query = Item.objects(self.db).order_by('count').prefetch(depth=1)
+        query._chunk_size = 1
+        for item in query:
+            break
+        prefetcher = query._iter
+        prefetcher._thread.join(1)
+        self.assertFalse(prefetcher._thread.is_alive())
+        # the rest is fetched synchronously
+        self.assertEqual([x.count for x in query], [0, 1, 2, 3, 4])
@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gc
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+import unittest
+
+import doqu.utils.columns
+from doqu.ext.shelve_db import vectorized
+from doqu import Document, get_db
+from doqu.backend_async import AsyncStorageAdapter
+from doqu.fields import Field
+from doqu.utils import dump, load, migrate
+from doqu.utils.concurrency import Prefetcher
+from doqu.utils.instrumentation import Listener, StatsCollector
+
+
+class Item(Document):
+    name = Field(unicode)
+    count = Field(int)
+    is_active = Field(bool)
+
+
+class ShelveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = get_db(backend='doqu.ext.shelve_db',
+                         path=os.path.join(self.tmp_dir, 'test.db'))
+        for i in range(5):
+            Item(name=u'item {0}'.format(i), count=i,
+                 is_active=bool(i % 2)).save(self.db)
+
+    def tearDown(self):
+        self.db.disconnect()
+        shutil.rmtree(self.tmp_dir)
+
+
+class UpdateTestCase(ShelveTestCase):
+    "In-place updates of records matching a query"
+
+    def test_update(self):
+        Item.objects(self.db).where(is_active=True).update(count=100)
+        counts = sorted(x.count for x in Item.objects(self.db))
+        self.assertEqual(counts, [0, 2, 4, 100, 100])
+
+    def test_update_unknown_field(self):
+        query = Item.objects(self.db)
+        self.assertRaises(KeyError, lambda: query.update(foo=1))
+        self.assertRaises(KeyError, lambda: query.increment('foo'))
+
+    def test_increment(self):
+        Item.objects(self.db).where(count__gte=3).increment('count', 10)
+        counts = sorted(x.count for x in Item.objects(self.db))
+        self.assertEqual(counts, [0, 1, 2, 13, 14])
+
+
+class LazyQueryTestCase(ShelveTestCase):
+    "Query is not executed until the results are needed"
+
+    def test_chaining_does_not_execute(self):
+        query = Item.objects(self.db).where(count__gte=1)
+        query = query.where(is_active=True)
+        self.assertFalse(query._executed)
+        self.assertEqual(len(query), 2)
+        self.assertTrue(query._executed)
+
+    def test_executed_once(self):
+        query = Item.objects(self.db).where(count__gte=3)
+        self.assertEqual(sorted(x.count for x in query), [3, 4])
+        Item(name=u'new', count=5).save(self.db)
+        # results are cached
+        self.assertEqual(sorted(x.count for x in query), [3, 4])
+        self.assertEqual(query.count(), 2)
+
+    def test_empty(self):
+        query = Item.objects(self.db).where(count__gte=10)
+        self.assertEqual(list(query), [])
+        self.assertEqual(list(query), [])
+        self.assertEqual(query.count(), 0)
+
+
+class QueryPlanTestCase(ShelveTestCase):
+    "Query shapes are compiled once per storage"
+
+    def test_plan_reused(self):
+        query = Item.objects(self.db)
+        self.assertEqual(len(query.where(count__gte=3)), 2)
+        self.assertEqual(len(query.where(count__gte=1)), 4)
+        self.assertEqual(len(self.db._query_plans), 1)
+        self.assertEqual(len(query.where_not(count__gte=1)), 1)
+        self.assertEqual(len(self.db._query_plans), 2)
+
+
+class QueryCacheTestCase(ShelveTestCase):
+    "Query results are cached until the next write"
+
+    def setUp(self):
+        super(QueryCacheTestCase, self).setUp()
+        self.db.enable_query_cache()
+
+    def test_cached(self):
+        query = Item.objects(self.db).where(count__gte=3)
+        self.assertEqual(query.count(), 2)
+        self.assertEqual(len(self.db._query_cache), 1)
+        # the same query shape and values: cache hit
+        query = Item.objects(self.db).where(count__gte=3)
+        query._do_search = None    # must not be called
+        self.assertEqual(sorted(x.count for x in query), [3, 4])
+        # other values: cache miss
+        self.assertEqual(Item.objects(self.db).where(count__gte=4).count(), 1)
+        self.assertEqual(len(self.db._query_cache), 2)
+
+    def test_invalidated_by_write(self):
+        query = Item.objects(self.db).where(count__gte=3)
+        self.assertEqual(query.count(), 2)
+        Item(name=u'new', count=5).save(self.db)
+        query = Item.objects(self.db).where(count__gte=3)
+        self.assertEqual(query.count(), 3)
+        query.where(count=5).delete()
+        self.assertEqual(Item.objects(self.db).where(count__gte=3).count(), 2)
+
+    def test_size_bound(self):
+        self.db.enable_query_cache(size=2)
+        for i in range(5):
+            Item.objects(self.db).where(count=i).count()
+        self.assertEqual(len(self.db._query_cache), 2)
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, lambda: self.db.enable_query_cache(0))
+        # the previous cache is kept
+        self.assertEqual(Item.objects(self.db).count(), 5)
+        self.assertEqual(len(self.db._query_cache), 1)
+
+
+class SetOperationsTestCase(ShelveTestCase):
+    "Union, intersection and difference of queries"
+
+    def get_counts(self, query):
+        return sorted(x.count for x in query)
+
+    def test_union(self):
+        query = Item.objects(self.db)
+        q = query.where(count__lte=1) | query.where(count__gte=4)
+        self.assertEqual(self.get_counts(q), [0, 1, 4])
+        self.assertEqual(self.get_counts(q.where(is_active=True)), [1])
+
+    def test_intersection(self):
+        query = Item.objects(self.db)
+        q = query.where(count__gte=1) & query.where(is_active=False)
+        self.assertEqual(self.get_counts(q), [2, 4])
+
+    def test_difference(self):
+        query = Item.objects(self.db)
+        q = query - query.where(is_active=True)
+        self.assertEqual(self.get_counts(q), [0, 2, 4])
+        q = q - query.where(count=0)
+        self.assertEqual(self.get_counts(q), [2, 4])
+
+
+class SlicingTestCase(ShelveTestCase):
+    "Indexing and slicing of query results"
+
+    def setUp(self):
+        super(SlicingTestCase, self).setUp()
+        self.query = Item.objects(self.db).order_by('count')
+
+    def get_counts(self, items):
+        return [x.count for x in items]
+
+    def test_index(self):
+        self.assertEqual(self.query[0].count, 0)
+        self.assertEqual(self.query[3].count, 3)
+        self.assertEqual(self.query[-1].count, 4)
+        self.assertEqual(self.query[-5].count, 0)
+        self.assertRaises(IndexError, lambda: self.query[5])
+        self.assertRaises(IndexError, lambda: self.query[-6])
+
+    def test_slice(self):
+        self.assertEqual(self.get_counts(self.query[1:3]), [1, 2])
+        self.assertEqual(self.get_counts(self.query[3:]), [3, 4])
+        self.assertEqual(self.get_counts(self.query[:2]), [0, 1])
+        self.assertEqual(self.get_counts(self.query[3:1]), [])
+        self.assertEqual(self.get_counts(self.query[4:10]), [4])
+
+    def test_negative_slice(self):
+        self.assertEqual(self.get_counts(self.query[-2:]), [3, 4])
+        self.assertEqual(self.get_counts(self.query[1:-2]), [1, 2])
+        self.assertEqual(self.get_counts(self.query[::-2]), [4, 2, 0])
+
+    def test_step(self):
+        self.assertEqual(self.get_counts(self.query[::2]), [0, 2, 4])
+        self.assertEqual(self.get_counts(self.query[1:4:2]), [1, 3])
+
+    def test_fetches_only_needed(self):
+        self.assertEqual(self.get_counts(self.query[:2]), [0, 1])
+        self.assertEqual(len(self.query._cache), 2)
+        self.assertEqual(self.get_counts(self.query[2:3]), [2])
+        self.assertEqual(len(self.query._cache), 3)
+        # partially cached results are completed
+        self.assertEqual(self.query[-1].count, 4)
+        self.assertEqual(self.get_counts(self.query), [0, 1, 2, 3, 4])
+
+
+class StreamingTestCase(ShelveTestCase):
+    "Iteration with bounded or no cache"
+
+    def setUp(self):
+        super(StreamingTestCase, self).setUp()
+        self.query = Item.objects(self.db).order_by('count')
+
+    def test_iterator(self):
+        counts = [x.count for x in self.query.iterator()]
+        self.assertEqual(counts, [0, 1, 2, 3, 4])
+        self.assertEqual(self.query._cache, [])
+        # the cache is not affected
+        self.assertEqual(self.query[1].count, 1)
+        self.assertEqual([x.count for x in self.query.iterator()], counts)
+
+    def test_cache_window(self):
+        query = self.query.cache_window(2)
+        counts = []
+        for item in query:
+            counts.append(item.count)
+            self.assertTrue(len(query._cache) <= 2)
+        self.assertEqual(counts, [0, 1, 2, 3, 4])
+        # dropped items are fetched again
+        self.assertEqual([x.count for x in query], counts)
+        self.assertEqual(query[0].count, 0)
+        self.assertEqual([x.count for x in query[1:4]], [1, 2, 3])
+        self.assertEqual(query[-1].count, 4)
+        self.assertEqual(len(query), 5)
+        self.assertTrue(len(query._cache) <= 2)
+
+    def test_count_after_cache_window(self):
+        query = self.query.cache_window(2)
+        self.assertEqual(len(list(query)), 5)
+        # the cache only holds the last items
+        self.assertEqual(query.count(), 5)
+
+
+class PrefetchTestCase(ShelveTestCase):
+    "Records are fetched in background"
+
+    def test_not_thread_safe(self):
+        # shelve is not thread-safe: the records are fetched synchronously
+        query = Item.objects(self.db).order_by('count').prefetch(depth=1)
+        self.assertEqual(query._prefetch_depth, 0)
+        self.assertEqual([x.count for x in query], [0, 1, 2, 3, 4])
+        self.assertFalse(isinstance(query._iter, Prefetcher))
+        query = Item.objects(self.db).where(count__gte=2).order_by('count')
+        counts = [x.count for x in query.prefetch().iterator()]
+        self.assertEqual(counts, [2, 3, 4])
+
+    def test_error(self):
+        def generate():
+            yield 1
+            raise ValueError('oops')
+        items = Prefetcher(generate(), chunk_size=1)
+        self.assertEqual(items.next(), 1)
+        self.assertRaises(ValueError, items.next)
+        self.assertRaises(StopIteration, items.next)
+
+    def test_close(self):
+        items = Prefetcher(iter(range(10)), chunk_size=2, depth=1)
+        self.assertEqual([items.next() for i in range(3)], [0, 1, 2])
+        items.close()
+        items._thread.join(1)
+        self.assertFalse(items._thread.is_alive())
+        # the rest is read synchronously
+        self.assertEqual(list(items), range(3, 10))
+
+    def test_garbage_collected(self):
+        items = Prefetcher(iter(range(10)), chunk_size=2, depth=1)
+        items.next()
+        thread = items._thread
+        del items
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+
+def get_count(item):
+    return item.count
+
+
+class MapBatchesTestCase(ShelveTestCase):
+    "Documents are processed by a pool of worker processes"
+
+    def test_ordered(self):
+        query = Item.objects(self.db).order_by('count')
+        results = query.map_batches(get_count, workers=2, chunk=2)
+        self.assertEqual(list(results), [0, 1, 2, 3, 4])
+
+    def test_unordered(self):
+        query = Item.objects(self.db).where(count__gte=1)
+        results = query.map_batches(get_count, workers=2, chunk=1,
+                                    ordered=False)
+        self.assertEqual(sorted(results), [1, 2, 3, 4])
+
+
+class ColumnsTestCase(ShelveTestCase):
+    "Field values are exported as typed arrays"
+
+    def test_to_columns(self):
+        query = Item.objects(self.db).order_by('count')
+        columns = query.to_columns(['count', 'name'])
+        self.assertEqual(sorted(columns), ['count', 'name'])
+        self.assertEqual(list(columns['count']), [0, 1, 2, 3, 4])
+        self.assertEqual(list(columns['name'])[:2], [u'item 0', u'item 1'])
+        if doqu.utils.columns.numpy is None:
+            self.assertEqual(columns['count'].typecode, 'l')
+
+    def test_missing_values(self):
+        Item(name=u'new').save(self.db)
+        query = Item.objects(self.db).where(name=u'new')
+        column = query.to_columns(['count'])['count']
+        if doqu.utils.columns.numpy is None:
+            self.assertEqual(column, [None])
+        else:
+            self.assertTrue(column.mask[0])
+
+
+class VectorizedTestCase(ShelveTestCase):
+    "Conditions are evaluated over batches of records with NumPy"
+
+    def setUp(self):
+        super(VectorizedTestCase, self).setUp()
+        Item(name=u'no count').save(self.db)
+        self.db._connection_options.update(vectorized=True, batch_size=2)
+
+    def get_counts(self, **conditions):
+        query = Item.objects(self.db).where(**conditions)
+        return sorted(x.count for x in query)
+
+    def test_numbers(self):
+        self.assertEqual(self.get_counts(count__gte=3), [3, 4])
+        self.assertEqual(self.get_counts(count__between=(1, 2)), [1, 2])
+        self.assertEqual(self.get_counts(count__in=[0, 4, 10]), [0, 4])
+        query = Item.objects(self.db).where_not(count__lt=3)
+        self.assertEqual(sorted(x.name for x in query),
+                         [u'item 3', u'item 4', u'no count'])
+
+    def test_strings(self):
+        self.assertEqual(self.get_counts(name=u'item 2'), [2])
+        self.assertEqual(self.get_counts(name__startswith=u'item'),
+                         [0, 1, 2, 3, 4])
+
+    def test_fallback(self):
+        # the lookup is not vectorized
+        self.assertEqual(self.get_counts(name__endswith=u'3'), [3])
+        # mixed types are compared record by record
+        self.db.connection['odd'] = {'name': u'odd', 'count': u'5'}
+        query = Item.objects(self.db).where(count__gte=4)
+        self.assertEqual(sorted(x.name for x in query), [u'item 4', u'odd'])
+
+
+class TransferTestCase(ShelveTestCase):
+    "Records are exported to and imported from a file"
+
+    def setUp(self):
+        super(TransferTestCase, self).setUp()
+        self.other_db = get_db(backend='doqu.ext.shelve_db',
+                               path=os.path.join(self.tmp_dir, 'other.db'))
+
+    def tearDown(self):
+        self.other_db.disconnect()
+        super(TransferTestCase, self).tearDown()
+
+    def transfer(self, format):
+        f = StringIO()
+        self.assertEqual(dump(self.db, Item, f, format=format), 5)
+        f.seek(0)
+        counts = []
+        self.assertEqual(load(self.other_db, f, format=format, doc_class=Item,
+                              batch=2, progress=counts.append), 5)
+        self.assertEqual(counts, [2, 4, 5])
+
+        items = sorted(Item.objects(self.other_db), key=lambda x: x.count)
+        self.assertEqual([x.count for x in items], [0, 1, 2, 3, 4])
+        self.assertEqual([x.is_active for x in items][:2], [False, True])
+        self.assertEqual(items[0].name, u'item 0')
+        # primary keys are preserved
+        self.assertEqual(sorted(x.pk for x in items), sorted(self.db))
+
+    def test_jsonl(self):
+        self.transfer('jsonl')
+
+    def test_csv(self):
+        self.transfer('csv')
+
+    def test_pickled(self):
+        class Tagged(Document):
+            name = Field(unicode)
+            tags = Field(set, pickled=True)
+
+        Tagged(name=u'tagged', tags=set([u'a', u'b'])).save(self.db)
+        for format in 'jsonl', 'csv':
+            f = StringIO()
+            self.assertEqual(dump(self.db, Tagged, f, format=format), 6)
+            f.seek(0)
+            self.other_db.clear()
+            load(self.other_db, f, format=format, doc_class=Tagged)
+            item = Tagged.objects(self.other_db).where(name=u'tagged')[0]
+            self.assertEqual(item.tags, set([u'a', u'b']))
+
+
+class MigrationTestCase(ShelveTestCase):
+    "Records are copied directly to another storage"
+
+    def setUp(self):
+        super(MigrationTestCase, self).setUp()
+        self.other_db = get_db(backend='doqu.ext.shelve_db',
+                               path=os.path.join(self.tmp_dir, 'other.db'))
+
+    def tearDown(self):
+        self.other_db.disconnect()
+        super(MigrationTestCase, self).tearDown()
+
+    def test_migrate(self):
+        counts = []
+        self.assertEqual(migrate(self.db, self.other_db, [Item], batch=2,
+                                 progress=lambda c, n: counts.append(n)), 5)
+        self.assertEqual(counts, [2, 4, 5])
+        self.assertEqual(sorted(self.other_db), sorted(self.db))
+        item = Item.objects(self.other_db).where(count=3)[0]
+        self.assertEqual((item.name, item.is_active), (u'item 3', True))
+
+    def test_all_records(self):
+        self.assertEqual(migrate(self.db, self.other_db), 5)
+        self.assertEqual(sorted(self.other_db), sorted(self.db))
+
+    def test_resume(self):
+        path = os.path.join(self.tmp_dir, 'checkpoint.json')
+        with open(path, 'w') as f:
+            f.write('{"Item": 3}')
+        self.assertEqual(migrate(self.db, self.other_db, [Item],
+                                 checkpoint=path), 2)
+        self.assertEqual(len(self.other_db), 2)
+        self.assertFalse(os.path.exists(path))
+
+    def test_workers(self):
+        self.assertRaises(ValueError, migrate, self.db, self.other_db,
+                          workers=2)
+
+
+class EventLog(Listener):
+    def __init__(self):
+        self.events = []
+
+    def query_started(self, event):
+        self.events.append(('start', event))
+
+    def query_finished(self, event):
+        self.events.append(('end', event))
+
+    def operation_finished(self, event):
+        self.events.append((event.kind, event))
+
+
+class InstrumentationTestCase(ShelveTestCase):
+    "Listeners are notified about queries and storage operations"
+
+    def setUp(self):
+        super(InstrumentationTestCase, self).setUp()
+        self.log = EventLog()
+        self.db.add_listener(self.log)
+
+    def test_query(self):
+        items = list(Item.objects(self.db).where(count__gte=2))
+        self.assertEqual([x[0] for x in self.log.events], ['start', 'end'])
+        event = self.log.events[1][1]
+        self.assertEqual((event.kind, event.model, event.rows),
+                         ('query', Item, 3))
+        self.assertEqual(len(event.conditions), 1)
+        self.assertTrue(0 < event.decorate_time + event.validation_time
+                          <= event.duration)
+        self.assertTrue(0 <= event.io_time)
+
+    def test_partial_fetch(self):
+        query = Item.objects(self.db)
+        query[0]
+        self.assertEqual([x[0] for x in self.log.events], ['start'])
+        del query
+        # reported when the query is garbage-collected
+        gc.collect()
+        self.assertEqual([x[0] for x in self.log.events], ['start', 'end'])
+
+    def test_operations(self):
+        pk = Item(name=u'foo').save(self.db)
+        Item.object(self.db, pk)
+        self.db.delete(pk)
+        self.assertEqual([x[0] for x in self.log.events],
+                         ['save', 'get', 'delete'])
+        self.assertEqual(self.log.events[1][1].rows, 1)
+
+    def test_remove_listener(self):
+        self.db.remove_listener(self.log)
+        self.assertFalse('get' in self.db.__dict__)
+        Item.objects(self.db).count()
+        self.assertEqual(self.log.events, [])
+
+    def test_stats(self):
+        stats = StatsCollector(slow_query_threshold=0)
+        self.db.add_listener(stats)
+        self.db.enable_query_cache()
+        query = Item.objects(self.db).where(is_active=True)
+        self.assertEqual(query.count(), 2)
+        self.assertEqual(query.count(), 2)
+        self.assertEqual(stats.cache_hit_rate, 0.5)
+        self.assertEqual(sorted(stats.percentiles()), [50, 90, 95, 99])
+        self.assertEqual(stats.summary()['query']['count'], 2)
+        self.assertEqual(len(stats.slow_queries), 2)
+        stats.reset()
+        self.assertEqual(stats.percentiles(), {})
+
+
+class ExplainTestCase(ShelveTestCase):
+    "Query plans describe full scans"
+
+    def test_full_scan(self):
+        plan = Item.objects(self.db).where(count__gte=3).explain()
+        self.assertEqual(plan['backend'], 'doqu.ext.shelve_db')
+        self.assertEqual(plan['conditions'], [('gte', 'count', 3, False)])
+        self.assertEqual((plan['index'], plan['full_scan']), (None, True))
+        self.assertEqual(plan['estimated_scan'], 5)
+        self.assertEqual(plan['order_pushed_down'], None)
+        self.assertEqual(plan['limit_pushed_down'], False)
+
+    def test_ordering(self):
+        plan = Item.objects(self.db).order_by('count').explain()
+        self.assertEqual(plan['order_pushed_down'], False)
+
+    def test_cached(self):
+        self.db.enable_query_cache()
+        query = Item.objects(self.db).where(is_active=True)
+        self.assertTrue(query.explain()['full_scan'])
+        query.count()
+        plan = query.explain()
+        self.assertEqual((plan['full_scan'], plan['estimated_scan']),
+                         (False, 0))
+        self.assertTrue(plan['native']['cached'])
+
+
+class AsyncTestCase(ShelveTestCase):
+    "Operations performed in background"
+
+    def setUp(self):
+        super(AsyncTestCase, self).setUp()
+        self.async_db = AsyncStorageAdapter(self.db)
+
+    def tearDown(self):
+        self.async_db.close()
+        super(AsyncTestCase, self).tearDown()
+
+    def test_not_thread_safe(self):
+        "shelve cannot be used by multiple workers"
+        self.assertRaises(ValueError,
+                          lambda: AsyncStorageAdapter(self.db, workers=2))
+
+    def test_get_save(self):
+        pk = self.async_db.save({'name': u'new', 'count': 9}).result()
+        item = self.async_db.get(Item, pk).result()
+        self.assertEqual(item.count, 9)
+        self.assertRaises(KeyError, self.async_db.get(Item, 'x').result)
+
+    def test_query(self):
+        query = Item.objects(self.async_db).where(count__gte=2)
+        self.assertEqual(query.count().result(), 3)
+        items = query.order_by('count').fetch(0, 2).result()
+        self.assertEqual([x.count for x in items], [2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the Tokyo Cabinet backend. The `tokyo.cabinet` module is replaced
+by a small stub that keeps the records in memory and logs the transactions.
+"""
+import sys
+import types
+import unittest
+
+from doqu import Document, dist
+from doqu.fields import Field
+
+
+#----------------------+
+#  tokyo.cabinet stub  |
+#----------------------+
+
+class Error(Exception):
+    pass
+
+
+class Query(object):
+    "Supports exact string matches and numeric lower bounds."
+    def __init__(self, db):
+        self.db = db
+        self.conditions = []
+        self.searches = 0
+
+    def count(self):
+        return len(self.search())
+
+    def filter(self, column, operation, expr):
+        self.conditions.append((column, operation, expr))
+
+    def search(self):
+        self.searches += 1
+        keys = []
+        for key in sorted(self.db, key=int):
+            data = self.db[key]
+            for column, operation, expr in self.conditions:
+                if operation == TDBQCSTREQ and data.get(column) != expr:
+                    break
+                if operation == TDBQCNUMGE and \
+                   float(data.get(column) or 0) < float(expr):
+                    break
+            else:
+                keys.append(key)
+        return keys
+
+    def sort(self, column, type):
+        raise NotImplementedError
+
+
+class TDB(dict):
+    def __init__(self):
+        self.log = []    # transaction calls
+        self.counter = 0
+        self.indexes = {}
+
+    def close(self):
+        pass
+
+    def open(self, path, mode):
+        pass
+
+    def query(self):
+        return Query(self)
+
+    def setindex(self, name, type):
+        if name in self.indexes and type & TDBITKEEP:
+            raise Error(TCEKEEP, 'existing record')
+        self.indexes[name] = type & ~TDBITKEEP
+
+    def tranabort(self):
+        self.log.append('abort')
+
+    def tranbegin(self):
+        self.log.append('begin')
+
+    def trancommit(self):
+        self.log.append('commit')
+
+    def uid(self):
+        self.counter += 1
+        return self.counter
+
+
+NAMES = ('TDBITDECIMAL TDBITLEXICAL TDBITQGRAM TDBITTOKEN '
+         'TDBMSDIFF TDBMSISECT TDBMSUNION TDBOCREAT TDBOWRITER TDBQCFTSAND '
+         'TDBQCFTSEX TDBQCFTSOR TDBQCFTSPH TDBQCNEGATE TDBQCNUMBT TDBQCNUMEQ '
+         'TDBQCNUMGE TDBQCNUMGT TDBQCNUMLE TDBQCNUMLT TDBQCNUMOREQ '
+         'TDBQCSTRAND TDBQCSTRBW TDBQCSTREQ TDBQCSTREW TDBQCSTRINC '
+         'TDBQCSTROR TDBQCSTROREQ TDBQCSTRRX').split()
+TDBQCSTREQ = NAMES.index('TDBQCSTREQ')
+TDBQCNUMGE = NAMES.index('TDBQCNUMGE')
+TDBITKEEP = 1 << 24
+TCEKEEP = 21
+
+def make_stubs():
+    cabinet = types.ModuleType('tokyo.cabinet')
+    for i, name in enumerate(NAMES):
+        setattr(cabinet, name, i)
+    cabinet.TDBITKEEP = TDBITKEEP
+    cabinet.TCEKEEP = TCEKEEP
+    cabinet.TDB = TDB
+    cabinet.Error = Error
+    tokyo = types.ModuleType('tokyo')
+    tokyo.cabinet = cabinet
+    # the backend borrows the ordering class from Pyrant
+    query = types.ModuleType('pyrant.query')
+    query.Ordering = type('Ordering', (object,), {})
+    pyrant = types.ModuleType('pyrant')
+    pyrant.query = query
+    return {'tokyo': tokyo, 'tokyo.cabinet': cabinet,
+            'pyrant': pyrant, 'pyrant.query': query}
+
+def import_backend():
+    "Imports the backend without the real library and its entry point."
+    check_dependencies = dist.check_dependencies
+    dist.check_dependencies = lambda *args, **kwargs: None
+    stubs = make_stubs()
+    real = dict((name, sys.modules.get(name)) for name in stubs)
+    sys.modules.update(stubs)
+    try:
+        import doqu.ext.tokyo_cabinet as backend
+    finally:
+        dist.check_dependencies = check_dependencies
+        for name, module in real.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+    return backend
+
+tokyo_cabinet = import_backend()
+
+
+#---------+
+#  Tests  |
+#---------+
+
+class Item(Document):
+    name = Field(unicode)
+
+
+class CabinetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = tokyo_cabinet.StorageAdapter(path='test.tct', batch_size=3)
+        self.log = self.db.connection.log
+
+    def make_items(self, count):
+        return [(None, {'name': u'item {0}'.format(i)}) for i in range(count)]
+
+
+class SaveManyTestCase(CabinetTestCase):
+    "Records are saved in batches, each within a transaction"
+
+    def test_batches(self):
+        keys = self.db.save_many(iter(self.make_items(7)))
+        self.assertEqual(keys, [unicode(i) for i in range(1, 8)])
+        self.assertEqual(self.log, ['begin', 'commit'] * 3)
+        self.assertEqual(len(self.db), 7)
+
+    def test_exact_multiple(self):
+        self.db.save_many(self.make_items(6))
+        # no empty transaction after the last batch
+        self.assertEqual(self.log, ['begin', 'commit'] * 2)
+
+    def test_empty(self):
+        self.assertEqual(self.db.save_many([]), [])
+        self.assertEqual(self.log, [])
+
+    def test_within_transaction(self):
+        def save():
+            with self.db.transaction():
+                self.db.save_many(self.make_items(7))
+                raise ValueError
+        self.assertRaises(ValueError, save)
+        self.assertEqual(self.log, ['begin', 'abort'])
+
+
+class IndexTestCase(CabinetTestCase):
+    "Column indexes declared in the document class"
+
+    class Person(Document):
+        structure = {'name': unicode, 'age': int, 'bio': unicode}
+        indexes = {'name': None, 'age': None, 'bio': 'q-gram'}
+
+    def test_ensure_indexes(self):
+        expected = {'name': 'lexical', 'age': 'decimal', 'bio': 'q-gram'}
+        self.assertEqual(self.db.ensure_indexes(self.Person), expected)
+        self.assertEqual(self.db.connection.indexes, {
+            'name': tokyo_cabinet.INDEX_TYPES['lexical'],
+            'age': tokyo_cabinet.INDEX_TYPES['decimal'],
+            'bio': tokyo_cabinet.INDEX_TYPES['q-gram'],
+        })
+        # existing indexes are kept
+        self.assertEqual(self.db.ensure_indexes(self.Person), {})
+
+    def test_error(self):
+        def setindex(name, type):
+            raise Error(1, 'invalid operation')    # e.g. read-only database
+        self.db.connection.setindex = setindex
+        self.assertRaises(Error, self.db.ensure_indexes, self.Person)
+
+
+class QueryTestCase(CabinetTestCase):
+    "Counting does not rely on a trimmed cache"
+
+    def test_count_after_cache_window(self):
+        self.db.save_many(self.make_items(5))
+        query = Item.objects(self.db).cache_window(2)
+        self.assertEqual(len(list(query)), 5)
+        self.assertEqual(query.count(), 5)
@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the Tokyo Tyrant backend. A server is not needed: the `pyrant`
+package is replaced by a small stub that keeps the records in memory.
+"""
+import gc
+import json
+import sys
+import threading
+import time
+import types
+import unittest
+
+from doqu import Document, dist
+from doqu.fields import Field
+from doqu.utils import concurrency
+
+
+#----------------+
+#  pyrant stub   |
+#----------------+
+
+class TyrantError(Exception):
+    pass
+
+
+class Server(object):
+    "The records and the request log shared by all connections."
+    def __init__(self):
+        self.data = {}
+        self.indexes = {}
+        self.requests = []    # (command, key) in the order of arrival
+        self.round_trips = 0
+        self.counter = 0
+
+    def handle(self, command, args):
+        "Returns a status code and a list of values."
+        if command == 'get':
+            key, = args
+            if key not in self.data:
+                return 1, []
+            return 0, [self.data[key]]
+        if command == 'out':
+            key, = args
+            if self.data.pop(key, None) is None:
+                return 1, []
+            return 0, []
+        if command == 'put':
+            key = args[0]
+            self.data[key] = dict(zip(args[1::2], args[2::2]))
+            return 0, []
+        if command == 'putcat':
+            key = args[0]
+            self.data.setdefault(key, {}).update(zip(args[1::2], args[2::2]))
+            return 0, []
+        if command == 'genuid':
+            self.counter += 1
+            return 0, [unicode(self.counter)]
+        raise ValueError(command)
+
+
+class RawSocket(object):
+    "Parses the requests packed by the `_pack` stub and queues responses."
+    def __init__(self, server):
+        self.server = server
+        self.responses = []
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def sendall(self, buf):
+        if self.closed:
+            raise IOError('closed socket')
+        self.server.round_trips += 1
+        for line in buf.splitlines():
+            request = json.loads(line)
+            code = request[0]
+            if code == TyrantProtocol.GET:
+                command, args = 'get', request[2:]
+            elif code == TyrantProtocol.OUT:
+                command, args = 'out', request[2:]
+            else:
+                command, args = request[4], request[5]
+            self.server.requests.append((command, args and args[0]))
+            status, values = self.server.handle(command, args)
+            self.responses.append(chr(status))
+            if code == TyrantProtocol.GET:
+                self.responses.extend(values)
+            elif code == TyrantProtocol.MISC:
+                self.responses.append(len(values))
+                self.responses.extend(values)
+
+
+class ProtocolSocket(object):
+    "The reading part of `pyrant.protocol._TyrantSocket`."
+    def __init__(self, server):
+        self._sock = RawSocket(server)
+
+    def _read(self):
+        return self._sock.responses.pop(0)
+
+    get_byte = get_str = get_unicode = get_int = _read
+
+
+class TyrantProtocol(object):
+    GET = 0x30
+    MISC = 0x90
+    OUT = 0x20
+
+    server = None    # set by the tests
+
+    def __init__(self, host=None, port=None, timeout=None):
+        self._sock = ProtocolSocket(self.server)
+        self.host = host
+        self.port = port
+        self._keys = None    # the server keeps the iterator per connection
+
+    def add_index(self, name, index_type, keep=False):
+        if keep and name in self.server.indexes:
+            return False
+        self.server.indexes[name] = index_type
+        return True
+
+    def misc(self, func, args, opts=0):
+        self.server.round_trips += 1
+        self.server.requests.append((func, args and args[0]))
+        status, values = self.server.handle(func, args)
+        if status:
+            raise TyrantError(status)
+        return values
+
+    def iterinit(self):
+        self.server.round_trips += 1
+        self._keys = sorted(self.server.data)
+
+    def iternext(self):
+        self.server.round_trips += 1
+        if not self._keys:
+            raise TyrantError('no more keys')
+        return self._keys.pop(0)
+
+    def rnum(self):
+        if self._sock._sock.closed:
+            raise IOError('closed socket')
+        return len(self.server.data)
+
+
+class Query(object):
+    "A query without conditions (only what the query adapter uses)."
+    def __init__(self, server):
+        self.server = server
+        self.data = server.data
+
+    def __iter__(self):
+        for key in self._do_search():
+            yield key, dict(self.data[key])
+
+    def _do_search(self):
+        self.server.round_trips += 1
+        return sorted(self.data)
+
+    def columns(self, *names):
+        # the primary key is the column with empty name
+        self.server.round_trips += 1
+        return [dict((name, self.data[key][name] if name else key)
+                     for name in names if not name or name in self.data[key])
+                for key in sorted(self.data)]
+
+    def count(self):
+        return len(self.data)
+
+
+class Tyrant(object):
+    "A single-connection client (only what the storage adapter uses)."
+    literal = False
+    db_type = 'table'
+    separator = None
+    table_enabled = True
+
+    def __init__(self, host=None, port=None):
+        self.proto = TyrantProtocol(host, port)
+
+    @property
+    def _data(self):
+        return TyrantProtocol.server.data
+
+    @property
+    def query(self):
+        return Query(TyrantProtocol.server)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __delitem__(self, key):
+        TyrantProtocol.server.requests.append(('out', key))
+        del self._data[key]
+
+    def __getitem__(self, key):
+        return dict(self._data[key])
+
+    def __iter__(self):
+        return iter(self.iterkeys())
+
+    def __len__(self):
+        return len(self._data)
+
+    def __setitem__(self, key, data):
+        TyrantProtocol.server.requests.append(('put', key))
+        self._data[key] = dict(data)
+
+    def clear(self):
+        self._data.clear()
+
+    def iterkeys(self):
+        # same as in Pyrant: each call is a separate request
+        self.proto.iterinit()
+        try:
+            while True:
+                yield self.proto.iternext()
+        except TyrantError:
+            pass
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def generate_key(self):
+        return TyrantProtocol.server.handle('genuid', [])[1][0]
+
+
+def make_pyrant():
+    pyrant = types.ModuleType('pyrant')
+    pyrant.Tyrant = Tyrant
+    pyrant.protocol = types.ModuleType('pyrant.protocol')
+    pyrant.protocol.TyrantProtocol = TyrantProtocol
+    pyrant.protocol._TyrantSocket = ProtocolSocket
+    pyrant.protocol.TABLE_COLUMN_SEP = '\x00'
+    pyrant.protocol._pack = lambda *args: json.dumps(args) + '\n'
+    pyrant.protocol._ulen = len
+    pyrant.exceptions = types.ModuleType('pyrant.exceptions')
+    pyrant.exceptions.TyrantError = TyrantError
+    pyrant.exceptions.get_for_code = lambda code: TyrantError(code)
+    pyrant.utils = types.ModuleType('pyrant.utils')
+    pyrant.utils.from_python = unicode
+    pyrant.utils.to_python = lambda value, db_type, separator: value
+    return pyrant
+
+def import_backend():
+    "Imports the backend without the real library and its entry point."
+    check_dependencies = dist.check_dependencies
+    dist.check_dependencies = lambda *args, **kwargs: None
+    pyrant = make_pyrant()
+    stubs = {'pyrant': pyrant, 'pyrant.protocol': pyrant.protocol,
+             'pyrant.exceptions': pyrant.exceptions,
+             'pyrant.utils': pyrant.utils}
+    real = dict((name, sys.modules.get(name)) for name in stubs)
+    sys.modules.update(stubs)
+    try:
+        import doqu.ext.tokyo_tyrant as backend
+        import doqu.ext.tokyo_tyrant.pool
+    finally:
+        dist.check_dependencies = check_dependencies
+        for name, module in real.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+    return backend
+
+tokyo_tyrant = import_backend()
+pool = tokyo_tyrant.pool
+
+
+#---------+
+#  Tests  |
+#---------+
+
+class Item(Document):
+    name = Field(unicode)
+
+
+class TyrantTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = TyrantProtocol.server = Server()
+
+
+class IndexTestCase(TyrantTestCase):
+    "Column indexes declared in the document class"
+
+    class Person(Document):
+        structure = {'name': unicode, 'age': int, 'tags': list}
+        indexes = {'name': None, 'age': None, 'tags': None}
+
+    def test_ensure_indexes(self):
+        db = tokyo_tyrant.StorageAdapter()
+        expected = {'name': 'lexical', 'age': 'decimal', 'tags': 'token'}
+        self.assertEqual(db.ensure_indexes(self.Person), expected)
+        self.assertEqual(self.server.indexes, expected)
+        # existing indexes are kept
+        self.assertEqual(db.ensure_indexes(self.Person), {})
+
+
+class ProtocolPoolTestCase(TyrantTestCase):
+    "Connections are reused and closed by the pool"
+
+    def setUp(self):
+        super(ProtocolPoolTestCase, self).setUp()
+        self.opened = []
+        self.pool = pool.ProtocolPool(self.connect, size=2)
+
+    def connect(self):
+        proto = TyrantProtocol()
+        self.opened.append(proto)
+        return proto
+
+    def test_reuse(self):
+        self.assertEqual(self.pool.rnum(), 0)
+        self.assertEqual(self.pool.rnum(), 0)
+        self.assertEqual(len(self.opened), 1)
+        # the same connection is used for a series of requests
+        self.pool.run(lambda proto: self.assertTrue(proto is self.opened[0]))
+
+    def test_size(self):
+        checked_out = [self.pool._checkout()[0] for i in range(2)]
+        self.assertEqual(len(self.opened), 2)
+
+        waited = []
+        def request():
+            started = time.time()
+            self.pool.rnum()
+            waited.append(time.time() - started)
+        thread = threading.Thread(target=request)
+        thread.start()
+        time.sleep(0.1)
+        # all connections are busy, the request waits for a free one
+        self.assertEqual(waited, [])
+        self.pool._checkin(checked_out[0])
+        thread.join(1)
+        self.assertEqual(len(waited), 1)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_close(self):
+        busy, reused = self.pool._checkout()
+        self.pool.rnum()
+        idle = [x for x in self.opened if x is not busy]
+        self.pool.close()
+        self.assertTrue(idle[0]._sock._sock.closed)
+        self.assertFalse(busy._sock._sock.closed)
+        # the pool is still usable
+        self.pool._checkin(busy)
+        self.assertEqual(self.pool.rnum(), 0)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_failed_health_check(self):
+        self.pool.rnum()
+        def fail():
+            raise ValueError
+        self.opened[0].rnum = fail
+        self.pool._max_idle = -1
+        proto, reused = self.pool._checkout()
+        # the connection is replaced and its slot is not lost
+        self.assertTrue(proto is self.opened[1])
+        self.assertFalse(reused)
+        self.assertTrue(self.opened[0]._sock._sock.closed)
+        self.assertEqual(self.pool._opened, 1)
+
+    def test_discard_broken(self):
+        def fail(proto):
+            raise ValueError
+        self.assertRaises(ValueError, lambda: self.pool.run(fail))
+        self.assertTrue(self.opened[0]._sock._sock.closed)
+        self.assertEqual(self.pool._opened, 0)
+
+
+class IterationTestCase(TyrantTestCase):
+    "Keys are read through a single connection"
+
+    def test_pooled(self):
+        db = tokyo_tyrant.StorageAdapter(pool_size=2)
+        for i in range(5):
+            db.save({'name': u'item'}, 'key{0}'.format(i))
+        keys = iter(db)
+        first = keys.next()
+        # another thread uses the connection which has been used so far
+        busy, reused = db.connection.proto._checkout()
+        try:
+            self.assertEqual([first] + list(keys),
+                             ['key{0}'.format(i) for i in range(5)])
+            self.assertEqual(db.connection.keys(), sorted(self.server.data))
+        finally:
+            db.connection.proto._checkin(busy)
+
+
+class PipelineTestCase(TyrantTestCase):
+    "Writes within a pipeline block are sent at once"
+
+    def setUp(self):
+        super(PipelineTestCase, self).setUp()
+        self.db = tokyo_tyrant.StorageAdapter()
+        self.db.save({'name': u'old'}, 'old')
+        self.server.requests = []
+
+    def test_deferred(self):
+        with self.db.pipeline():
+            self.db.save({'name': u'foo'}, 'foo')
+            self.db.delete('old')
+            # nothing has been sent yet
+            self.assertEqual(self.server.requests, [])
+            self.assertTrue('foo' not in self.db)
+        self.assertEqual(self.server.requests,
+                         [('put', 'foo'), ('out', 'old')])
+        self.assertEqual(self.server.round_trips, 1)
+        self.assertEqual(self.server.data, {'foo': {'name': u'foo'}})
+
+    def test_nested(self):
+        with self.db.pipeline():
+            self.db.save({'name': u'foo'}, 'foo')
+            with self.db.pipeline():
+                self.db.save({'name': u'bar'}, 'bar')
+            self.assertEqual(self.server.requests, [])
+        self.assertEqual(self.server.round_trips, 1)
+        self.assertEqual(sorted(self.server.data), ['bar', 'foo', 'old'])
+
+    def test_exception(self):
+        def fail():
+            with self.db.pipeline():
+                self.db.save({'name': u'foo'}, 'foo')
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        # the queued requests are discarded
+        self.assertEqual(self.server.requests, [])
+        self.db.save({'name': u'bar'}, 'bar')
+        self.assertEqual(self.server.requests, [('put', 'bar')])
+
+    def test_missing_key(self):
+        def delete():
+            with self.db.pipeline():
+                self.db.delete('missing')
+                self.db.save({'name': u'foo'}, 'foo')
+        self.assertRaises(KeyError, delete)
+        # the requests after the failed one are still performed
+        self.assertTrue('foo' in self.server.data)
+
+    def test_save_many(self):
+        keys = self.db.save_many([(None, {'name': u'a'}),
+                                  ('b', {'name': u'b'})])
+        self.assertEqual(keys, [u'1', 'b'])
+        # one round trip for the new keys and one for the records
+        self.assertEqual(self.server.round_trips, 2)
+        self.assertEqual(self.server.data[u'1'], {'name': u'a'})
+
+    def test_get_many(self):
+        self.db.save({'name': u'foo'}, 'foo')
+        items = self.db.get_many(Item, ['foo', 'old'])
+        self.assertEqual([x.name for x in items], [u'foo', u'old'])
+        self.assertRaises(KeyError, lambda: self.db.get_many(Item, ['bar']))
+
+
+class UpdateTestCase(TyrantTestCase):
+    "In-place updates of records matching a query are pipelined"
+
+    class Counter(Document):
+        name = Field(unicode)
+        count = Field(int)
+
+    def setUp(self):
+        super(UpdateTestCase, self).setUp()
+        self.db = tokyo_tyrant.StorageAdapter()
+        self.db.save_many([(None, {'name': u'item', 'count': i})
+                           for i in range(5)])
+        self.server.round_trips = 0
+        self.server.requests = []
+
+    def test_increment(self):
+        self.Counter.objects(self.db).increment('count', 10)
+        # one search (only the column) and one round trip for the writes
+        self.assertEqual(self.server.round_trips, 2)
+        self.assertEqual(self.server.requests[0], ('putcat', u'1'))
+        counts = sorted(x.count for x in self.Counter.objects(self.db))
+        self.assertEqual(counts, [10, 11, 12, 13, 14])
+
+    def test_update(self):
+        self.Counter.objects(self.db).update(name=u'new')
+        self.assertEqual(set(x['name'] for x in self.server.data.values()),
+                         set(['new']))
+        # one search (only the keys) and one round trip for the writes
+        self.assertEqual(self.server.round_trips, 2)
+
+
+class PrefetchTestCase(TyrantTestCase):
+    "Records are fetched in background through pooled connections"
+
+    def setUp(self):
+        super(PrefetchTestCase, self).setUp()
+        self.db = tokyo_tyrant.StorageAdapter(pool_size=2)
+        for i in range(5):
+            Item(name=u'item {0}'.format(i)).save(self.db)
+
+    def test_prefetch(self):
+        query = Item.objects(self.db).prefetch(depth=1)
+        self.assertEqual(query._prefetch_depth, 1)
+        names = [x.name for x in query.iterator(chunk_size=2)]
+        self.assertEqual(names, [u'item {0}'.format(i) for i in range(5)])
+        self.assertEqual(len(list(query)), 5)
+
+    def test_abandoned(self):
+        documents = Item.objects(self.db).prefetch(depth=1).iterator(1)
+        documents.next()
+        self.assertEqual(len(concurrency._running), 1)
+        thread = concurrency._running.values()[0]
+        del documents
+        gc.collect()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+    def test_single_connection(self):
+        db = tokyo_tyrant.StorageAdapter()
+        query = Item.objects(db).prefetch()
+        self.assertEqual(query._prefetch_depth, 0)
+        self.assertEqual(len(list(query)), 5)
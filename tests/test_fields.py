@@ -101,6 +101,23 @@ class FieldTestCase(unittest.TestCase):
         d2 = self.db.get(D, d.pk)
         self.assertEquals(d.foo, d2.foo)
 
+    def test_indexed_field(self):
+        "Index type is picked by datatype unless explicitly specified"
+        class D(Document):
+            name = Field(unicode, index=True)
+            age = Field(int, index=True)
+            birth_date = Field(datetime.date, index=True)
+            tags = Field(list, index=True)
+            bio = Field(unicode, index='q-gram')
+            note = Field(unicode)
+        self.assertEquals(self.db._get_declared_indexes(D), {
+            'name': 'lexical',
+            'age': 'decimal',
+            'birth_date': 'decimal',
+            'tags': 'token',
+            'bio': 'q-gram',
+        })
+
 
 if __name__ == '__main__':
     unittest.main()